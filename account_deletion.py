@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+"""
+Account deletion jobs.
+
+Deleting an account touches five Supabase tables and the auth admin API. Doing
+that inline held a request worker for as long as Supabase took, opened a new
+connection per call and, if the worker died halfway, left a user with some
+tables gone and a live login. Instead, POST /api/delete-account records a job
+and answers 202 with its id; a background runner works through the steps and
+the client polls GET /api/delete-account/<job id>.
+
+Steps run in stages. Steps within a stage don't depend on each other and run
+concurrently; a stage only starts once every step before it has succeeded:
+
+    1. payments, subscriptions, user_settings, user_profiles
+    2. projects          (payments.project_id references projects)
+    3. auth user         (everything above references auth.users)
+
+Every call goes through one shared keep-alive requests.Session with connect/read
+timeouts and retries with backoff on connection errors, 429 and 5xx. Supabase
+deletes are idempotent (deleting no rows is a 204, a missing auth user a 404),
+so a step can safely run twice.
+
+Each finished step is written to the job store, and a running job holds a lease
+that the runner renews between stages. A sweeper in every worker picks up jobs
+whose lease ran out - the worker running them crashed or was restarted - and
+carries on from the first unfinished step.
+
+Backends:
+    sqlite - one database file shared by every gunicorn worker on a host (default)
+    redis  - one hash per job on a Redis server, shared across nodes
+    memory - per-process, only useful for local dev (jobs die with the worker)
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from admission import redis_client_from_env
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# (step, table, column matched against the user id); None table = auth admin delete
+STAGES = [
+    [("payments", "payments", "user_id"), ("subscriptions", "subscriptions", "user_id"),
+     ("user_settings", "user_settings", "id"), ("user_profiles", "user_profiles", "id")],
+    [("projects", "projects", "user_id")],
+    [("auth_user", None, None)],
+]
+STEPS = [step for stage in STAGES for step, _, _ in stage]
+
+
+def new_job_id():
+    return os.urandom(16).hex()
+
+
+def supabase_session(pool_size=10, retries=3, backoff=0.5):
+    """Keep-alive session for Supabase calls; retries connection errors, 429 and 5xx with backoff"""
+    retry = Retry(
+        total=retries, connect=retries, read=retries, status=retries,
+        backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "DELETE"]), respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def public_job(job):
+    """What the status endpoint shows - no user id"""
+    done = set(job["steps_done"])
+    return {
+        "jobId": job["id"],
+        "status": job["status"],
+        "steps": {step: step in done for step in STEPS},
+        "error": job.get("error"),
+        "attempts": job.get("attempts", 0),
+        "createdAt": job["created"],
+        "updatedAt": job["updated"],
+    }
+
+
+class MemoryDeletionStore:
+    def __init__(self, retention_seconds=86400):
+        self.retention_seconds = retention_seconds
+        self.jobs = {}
+        self.by_user = {}
+        self.lock = threading.Lock()
+
+    def _cleanup(self, now):
+        for job_id, job in list(self.jobs.items()):
+            if job["status"] == "done" and job["updated"] < now - self.retention_seconds:
+                del self.jobs[job_id]
+                if self.by_user.get(job["user_id"]) == job_id:
+                    del self.by_user[job["user_id"]]
+
+    def create(self, user_id):
+        """Job id for deleting user_id - an unfinished job for the same user is reused (and a failed one reset)"""
+        now = time.time()
+        with self.lock:
+            self._cleanup(now)
+            job = self.jobs.get(self.by_user.get(user_id))
+            if job and job["status"] != "done":
+                if job["status"] == "failed":
+                    job.update(status="pending", error=None, lease_until=0, updated=now)
+                return job["id"], False
+            job_id = new_job_id()
+            self.jobs[job_id] = dict(id=job_id, user_id=user_id, status="pending", steps_done=[], error=None,
+                                     attempts=0, worker=None, lease_until=0, created=now, updated=now)
+            self.by_user[user_id] = job_id
+            return job_id, True
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job, steps_done=list(job["steps_done"])) if job else None
+
+    def claim(self, job_id, worker, lease_seconds):
+        """Take (or renew) the lease on a pending/running job; False if done, failed or leased by someone else"""
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job or job["status"] in ("done", "failed"):
+                return False
+            if job["lease_until"] > now and job["worker"] != worker:
+                return False
+            if job["worker"] != worker or job["status"] != "running":
+                job["attempts"] += 1
+            job.update(status="running", worker=worker, lease_until=now + lease_seconds, updated=now)
+            return True
+
+    def stale(self):
+        """Ids of unfinished jobs nobody holds a lease on"""
+        now = time.time()
+        with self.lock:
+            return [job["id"] for job in self.jobs.values()
+                    if job["status"] in ("pending", "running") and job["lease_until"] <= now]
+
+    def complete_step(self, job_id, step):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job and step not in job["steps_done"]:
+                job["steps_done"].append(step)
+                job["updated"] = time.time()
+
+    def finish(self, job_id, status, error=None):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job:
+                job.update(status=status, error=error, worker=None, lease_until=0, updated=time.time())
+
+
+class SQLiteDeletionStore:
+    """One row per job; finished steps are a comma separated column"""
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS deletion_jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    steps_done TEXT NOT NULL DEFAULT '',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deletion_jobs_user ON deletion_jobs (user_id, status);
+CREATE INDEX IF NOT EXISTS deletion_jobs_lease ON deletion_jobs (status, lease_until);
+"""
+    COLUMNS = "id, user_id, status, steps_done, error, attempts, worker, lease_until, created, updated"
+
+    def __init__(self, path, retention_seconds=86400, cleanup_interval=600):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def _row(self, row):
+        if row is None:
+            return None
+        job = dict(zip([c.strip() for c in self.COLUMNS.split(",")], row))
+        job["steps_done"] = [step for step in job["steps_done"].split(",") if step]
+        return job
+
+    def _cleanup(self, now):
+        if now - self.last_cleanup < self.cleanup_interval:
+            return
+        self.last_cleanup = now
+        self.db.execute("DELETE FROM deletion_jobs WHERE status = 'done' AND updated < ?",
+                        (now - self.retention_seconds,))
+
+    def create(self, user_id):
+        now = time.time()
+        with self.lock:
+            self._cleanup(now)
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT id, status FROM deletion_jobs WHERE user_id = ? AND status != 'done'", (user_id,)
+                ).fetchone()
+                if row:
+                    if row[1] == "failed":
+                        self.db.execute(
+                            "UPDATE deletion_jobs SET status = 'pending', error = NULL, lease_until = 0, updated = ? "
+                            "WHERE id = ?", (now, row[0]))
+                    created = False
+                    job_id = row[0]
+                else:
+                    job_id = new_job_id()
+                    self.db.execute(
+                        "INSERT INTO deletion_jobs (id, user_id, status, created, updated) VALUES (?, ?, 'pending', ?, ?)",
+                        (job_id, user_id, now, now))
+                    created = True
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            return job_id, created
+
+    def get(self, job_id):
+        with self.lock:
+            return self._row(self.db.execute(
+                f"SELECT {self.COLUMNS} FROM deletion_jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def claim(self, job_id, worker, lease_seconds):
+        now = time.time()
+        with self.lock:
+            # One statement, so two workers sweeping the same file can't both win
+            cursor = self.db.execute(
+                "UPDATE deletion_jobs SET "
+                "attempts = attempts + (CASE WHEN worker IS ? AND status = 'running' THEN 0 ELSE 1 END), "
+                "status = 'running', worker = ?, lease_until = ?, updated = ? "
+                "WHERE id = ? AND status IN ('pending', 'running') AND (lease_until <= ? OR worker = ?)",
+                (worker, worker, now + lease_seconds, now, job_id, now, worker))
+            return cursor.rowcount == 1
+
+    def stale(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT id FROM deletion_jobs WHERE status IN ('pending', 'running') AND lease_until <= ?",
+                (time.time(),))]
+
+    def complete_step(self, job_id, step):
+        with self.lock:
+            self.db.execute(
+                "UPDATE deletion_jobs SET steps_done = CASE WHEN steps_done = '' THEN ? ELSE steps_done || ',' || ? END, "
+                "updated = ? WHERE id = ? AND ',' || steps_done || ',' NOT LIKE ?",
+                (step, step, time.time(), job_id, f"%,{step},%"))
+
+    def finish(self, job_id, status, error=None):
+        with self.lock:
+            self.db.execute(
+                "UPDATE deletion_jobs SET status = ?, error = ?, worker = NULL, lease_until = 0, updated = ? WHERE id = ?",
+                (status, error, time.time(), job_id))
+
+
+class RedisDeletionStore:
+    """Each job is a hash; unfinished jobs sit in a sorted set scored by lease expiry"""
+
+    CREATE_SCRIPT = """
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    local job = ARGV[3] .. existing
+    local status = redis.call('HGET', job, 'status')
+    if status and status ~= 'done' then
+        if status == 'failed' then
+            redis.call('HSET', job, 'status', 'pending', 'error', '', 'lease_until', 0, 'updated', ARGV[2])
+            redis.call('ZADD', KEYS[3], 0, existing)
+        end
+        return {existing, 0}
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], 'user_id', ARGV[4], 'status', 'pending', 'steps_done', '', 'error', '', 'attempts', 0,
+           'worker', '', 'lease_until', 0, 'created', ARGV[2], 'updated', ARGV[2])
+redis.call('ZADD', KEYS[3], 0, ARGV[1])
+return {ARGV[1], 1}
+"""
+    CLAIM_SCRIPT = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status ~= 'pending' and status ~= 'running' then return 0 end
+local worker = redis.call('HGET', KEYS[1], 'worker')
+if tonumber(redis.call('HGET', KEYS[1], 'lease_until')) > tonumber(ARGV[3]) and worker ~= ARGV[2] then return 0 end
+if worker ~= ARGV[2] or status ~= 'running' then redis.call('HINCRBY', KEYS[1], 'attempts', 1) end
+redis.call('HSET', KEYS[1], 'status', 'running', 'worker', ARGV[2], 'lease_until', ARGV[4], 'updated', ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+return 1
+"""
+    STEP_SCRIPT = """
+local done = redis.call('HGET', KEYS[1], 'steps_done')
+if not done then return 0 end
+if string.find(',' .. done .. ',', ',' .. ARGV[1] .. ',', 1, true) then return 0 end
+if done == '' then done = ARGV[1] else done = done .. ',' .. ARGV[1] end
+redis.call('HSET', KEYS[1], 'steps_done', done, 'updated', ARGV[2])
+return 1
+"""
+
+    def __init__(self, resp_client, retention_seconds=86400, prefix="fowazz:deletion:"):
+        self.redis = resp_client
+        self.retention_seconds = int(retention_seconds)
+        self.prefix = prefix
+        self.active_key = prefix + "active"
+
+    def create(self, user_id):
+        job_id = new_job_id()
+        result = self.redis.execute(
+            "EVAL", self.CREATE_SCRIPT, 3, self.prefix + "user:" + user_id, self.prefix + job_id, self.active_key,
+            job_id, time.time(), self.prefix, user_id)
+        existing = result[0].decode() if isinstance(result[0], bytes) else result[0]
+        return existing, result[1] == 1
+
+    def get(self, job_id):
+        values = self.redis.execute("HGETALL", self.prefix + job_id)
+        if not values:
+            return None
+        raw = {values[i].decode(): values[i + 1].decode() for i in range(0, len(values), 2)}
+        return dict(
+            id=job_id, user_id=raw["user_id"], status=raw["status"],
+            steps_done=[step for step in raw["steps_done"].split(",") if step], error=raw.get("error") or None,
+            attempts=int(raw.get("attempts", 0)), worker=raw.get("worker") or None,
+            lease_until=float(raw.get("lease_until", 0)), created=float(raw["created"]), updated=float(raw["updated"]),
+        )
+
+    def claim(self, job_id, worker, lease_seconds):
+        now = time.time()
+        return self.redis.execute("EVAL", self.CLAIM_SCRIPT, 2, self.prefix + job_id, self.active_key,
+                                  job_id, worker, now, now + lease_seconds) == 1
+
+    def stale(self):
+        return [job_id.decode() for job_id in
+                self.redis.execute("ZRANGEBYSCORE", self.active_key, "-inf", time.time(), "LIMIT", 0, 100)]
+
+    def complete_step(self, job_id, step):
+        self.redis.execute("EVAL", self.STEP_SCRIPT, 1, self.prefix + job_id, step, time.time())
+
+    def finish(self, job_id, status, error=None):
+        key = self.prefix + job_id
+        self.redis.execute("HSET", key, "status", status, "error", error or "", "worker", "", "lease_until", 0,
+                           "updated", time.time())
+        self.redis.execute("ZREM", self.active_key, job_id)
+        if status == "done":
+            # The user mapping stays until the job itself expires, so a repeated request finds it
+            user_id = self.redis.execute("HGET", key, "user_id")
+            self.redis.execute("EXPIRE", key, self.retention_seconds)
+            if user_id:
+                self.redis.execute("EXPIRE", self.prefix + "user:" + user_id.decode(), self.retention_seconds)
+
+
+class StepFailed(Exception):
+    pass
+
+
+class AccountDeleter:
+    """
+    Runs deletion jobs from a store against Supabase. submit() records a job and
+    starts it in the background; the sweeper thread resumes jobs whose lease expired.
+    """
+
+    def __init__(self, store, supabase_url, service_key, session=None, max_parallel=4, timeout=(5, 30),
+                 lease_seconds=300, sweep_interval=60):
+        self.store = store
+        self.supabase_url = (supabase_url or "").rstrip("/")
+        self.service_key = service_key
+        self.session = session or supabase_session(pool_size=max_parallel * 2)
+        self.timeout = timeout
+        self.lease_seconds = lease_seconds
+        self.sweep_interval = sweep_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="account-deletion")
+        self.worker_id = f"{os.uname().nodename}:{os.getpid()}:{new_job_id()[:8]}"
+        self.running = set()  # job ids this process is working on
+        self.sweeper_pid = None
+        self.start_lock = threading.Lock()
+
+    @property
+    def configured(self):
+        return bool(self.supabase_url and self.service_key)
+
+    def _headers(self):
+        return {'apikey': self.service_key, 'Authorization': f'Bearer {self.service_key}'}
+
+    def verify_user(self, auth_header):
+        """User id behind a Supabase JWT, or None if the token is invalid"""
+        response = self.session.get(f"{self.supabase_url}/auth/v1/user", timeout=self.timeout,
+                                    headers={'apikey': self.service_key, 'Authorization': auth_header})
+        return response.json().get("id") if response.status_code == 200 else None
+
+    def submit(self, user_id):
+        """Job id for deleting user_id, started in the background unless another worker already runs it"""
+        self.start()
+        job_id, created = self.store.create(user_id)
+        print(f"🗑️ Account deletion {job_id[:8]} {'queued' if created else 'resumed'} for user {user_id}")
+        self._spawn(job_id)
+        return job_id
+
+    def status(self, job_id):
+        self.start()
+        return self.store.get(job_id)
+
+    # Background work
+
+    def start(self):
+        """Start this process's sweeper (again after a fork)"""
+        if self.sweeper_pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.sweeper_pid == os.getpid():
+                return
+            self.sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, daemon=True).start()
+
+    def _sweep_loop(self):
+        pid = os.getpid()
+        while self.sweeper_pid == pid:
+            try:
+                for job_id in self.store.stale():
+                    print(f"🔁 Resuming account deletion {job_id[:8]}")
+                    self._spawn(job_id)
+            except Exception as e:
+                print(f"⚠️ Account deletion sweep failed: {str(e)}")
+            time.sleep(self.sweep_interval)
+
+    def _spawn(self, job_id):
+        # The lease is per process, so a second runner here would renew it rather than be refused
+        with self.start_lock:
+            if job_id in self.running:
+                return
+            self.running.add(job_id)
+        threading.Thread(target=self._run_once, args=(job_id,), daemon=True).start()
+
+    def _run_once(self, job_id):
+        try:
+            self.run(job_id)
+        finally:
+            with self.start_lock:
+                self.running.discard(job_id)
+
+    def run(self, job_id):
+        """Work through the remaining steps of one job, if its lease can be taken"""
+        if not self.store.claim(job_id, self.worker_id, self.lease_seconds):
+            return
+        job = self.store.get(job_id)
+        user_id = job["user_id"]
+        done = set(job["steps_done"])
+        try:
+            for stage in STAGES:
+                pending = [step for step in stage if step[0] not in done]
+                if not pending:
+                    continue
+                # Renew the lease before each stage; losing it means another worker took over
+                if not self.store.claim(job_id, self.worker_id, self.lease_seconds):
+                    print(f"⚠️ Account deletion {job_id[:8]} lost its lease")
+                    return
+                futures = [(step, self.executor.submit(self._delete, user_id, step)) for step in pending]
+                failures = []
+                for step, future in futures:
+                    try:
+                        future.result()
+                        self.store.complete_step(job_id, step[0])
+                        done.add(step[0])
+                    except Exception as e:
+                        failures.append(f"{step[0]}: {str(e)}")
+                if failures:
+                    raise StepFailed("; ".join(failures))
+            self.store.finish(job_id, "done")
+            print(f"✅ Account deleted: {user_id} (job {job_id[:8]})")
+        except Exception as e:
+            print(f"❌ Account deletion {job_id[:8]} failed: {str(e)}")
+            self.store.finish(job_id, "failed", str(e))
+
+    def _delete(self, user_id, step):
+        name, table, column = step
+        if table is None:
+            url, params = f"{self.supabase_url}/auth/v1/admin/users/{user_id}", None
+            ok = (200, 204, 404)  # 404: already deleted by an earlier attempt
+        else:
+            url, params = f"{self.supabase_url}/rest/v1/{table}", {column: f"eq.{user_id}"}
+            ok = (200, 204)
+        response = self.session.delete(url, params=params, headers=self._headers(), timeout=self.timeout)
+        if response.status_code not in ok:
+            raise StepFailed(f"HTTP {response.status_code} {response.text[:200]}")
+        print(f"✅ Deleted {name} for user {user_id}")
+
+
+def create_deletion_store():
+    """Build the job store selected by ACCOUNT_DELETION_STORE (sqlite, redis or memory)"""
+    retention_seconds = float(os.getenv("ACCOUNT_DELETION_RETENTION_SECONDS", "86400"))
+    backend = os.getenv("ACCOUNT_DELETION_STORE", "sqlite").lower()
+
+    if backend == "redis":
+        return RedisDeletionStore(redis_client_from_env(), retention_seconds)
+
+    if backend == "sqlite":
+        path = os.getenv("ACCOUNT_DELETION_DB", "/tmp/fowazz-account-deletions.db")
+        try:
+            return SQLiteDeletionStore(path, retention_seconds)
+        except sqlite3.Error as e:
+            print(f"⚠️ SQLite account deletion store unavailable, using in-memory store: {str(e)}")
+
+    return MemoryDeletionStore(retention_seconds)
+
+
+def create_account_deleter(supabase_url, service_key):
+    """AccountDeleter configured from ACCOUNT_DELETION_* env vars"""
+    return AccountDeleter(
+        create_deletion_store(), supabase_url, service_key,
+        max_parallel=int(os.getenv("ACCOUNT_DELETION_PARALLEL", "4")),
+        timeout=(float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5")), float(os.getenv("SUPABASE_READ_TIMEOUT", "30"))),
+        lease_seconds=float(os.getenv("ACCOUNT_DELETION_LEASE_SECONDS", "300")),
+        sweep_interval=float(os.getenv("ACCOUNT_DELETION_SWEEP_SECONDS", "60")),
+    )
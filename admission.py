@@ -0,0 +1,975 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for AI chat connections.
+
+Every backend exposes the same small interface that server.py uses:
+
+    lease = backend.try_acquire()   # lease id (truthy) or None when full
+    backend.renew(lease)            # push the lease expiry forward
+    backend.release(lease)          # give the slot back
+    backend.get_count()             # slots currently held (cluster-wide)
+    backend.max                     # the global limit
+    backend.adjust_limit(decide, min_interval)  # change the limit for every worker
+    backend.queue_poll(waiter, priority)  # (lease or None, position) for a queued request
+    backend.queue_leave(waiter)     # stop waiting
+
+Leases expire on their own after `lease_seconds`, so a worker or greenlet
+that dies mid-stream can never leak a slot for longer than that.
+
+Requests waiting for a slot are kept in the backend too, ordered by (priority,
+arrival) across every worker that shares it: only the first of them can take a
+freed slot, and try_acquire() refuses while anyone is waiting. A waiter that
+stops polling drops out after WAITER_TTL_SECONDS.
+
+Backends:
+    local  - per-process counter (the old ConnectionCounter behaviour)
+    file   - shared mmap'd slot table guarded by flock, one limit per host
+    redis  - sorted set on a Redis server, one limit across all nodes
+
+The limit itself is shared the same way (it can move at runtime, see
+AdaptiveLimiter), and changes at most once per interval however many workers
+ask for one.
+"""
+import asyncio
+import collections
+import os
+import socket
+import ssl
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+    import mmap
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False  # Windows local dev - only the local backend works
+
+
+WAITER_TTL_SECONDS = 10
+
+
+def _new_lease_id():
+    return os.urandom(8).hex()
+
+
+# Thread-safe connection counter for concurrent user limit (single process)
+class ConnectionCounter:
+    def __init__(self, max_connections=16, lease_seconds=90):
+        self.max = max_connections
+        self.lease_seconds = lease_seconds
+        self.leases = {}  # lease id -> expiry (monotonic)
+        self.waiters = {}  # waiter id -> (priority, arrival, expiry), all monotonic
+        self.lock = threading.Lock()
+        self.limit_changed = 0.0
+
+    def _purge_expired(self, now):
+        expired = [lease for lease, expiry in self.leases.items() if expiry <= now]
+        for lease in expired:
+            del self.leases[lease]
+        if expired:
+            print(f"⌛ Reclaimed {len(expired)} expired admission lease(s)")
+
+    def _take_slot(self, now):
+        if len(self.leases) >= self.max:
+            self._purge_expired(now)
+            if len(self.leases) >= self.max:
+                return None
+        lease = _new_lease_id()
+        self.leases[lease] = now + self.lease_seconds
+        return lease
+
+    def _purge_waiters(self, now):
+        for waiter in [waiter for waiter, entry in self.waiters.items() if entry[2] <= now]:
+            del self.waiters[waiter]
+
+    def try_acquire(self):
+        now = time.monotonic()
+        with self.lock:
+            self._purge_waiters(now)
+            if self.waiters:
+                return None
+            return self._take_slot(now)
+
+    def queue_poll(self, waiter, priority):
+        """
+        Keep a waiter queued (joining on the first call); returns (lease, position) -
+        a lease only once the waiter is first in line and a slot is free
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._purge_waiters(now)
+            arrival = self.waiters[waiter][1] if waiter in self.waiters else now
+            self.waiters[waiter] = (priority, arrival, now + WAITER_TTL_SECONDS)
+            key = (priority, arrival, waiter)
+            position = 1 + sum(1 for other, entry in self.waiters.items() if (entry[0], entry[1], other) < key)
+            if position > 1:
+                return None, position
+            lease = self._take_slot(now)
+            if lease:
+                del self.waiters[waiter]
+            return lease, position
+
+    def queue_leave(self, waiter):
+        with self.lock:
+            self.waiters.pop(waiter, None)
+
+    def renew(self, lease):
+        with self.lock:
+            if lease in self.leases:
+                self.leases[lease] = time.monotonic() + self.lease_seconds
+
+    def release(self, lease=None):
+        with self.lock:
+            if lease is None:
+                # Legacy callers that don't track their lease: drop the oldest one
+                if self.leases:
+                    del self.leases[next(iter(self.leases))]
+            else:
+                self.leases.pop(lease, None)
+
+    def get_count(self):
+        with self.lock:
+            self._purge_expired(time.monotonic())
+            return len(self.leases)
+
+    def adjust_limit(self, decide, min_interval):
+        """
+        Replace the limit with decide(current limit) unless it changed less than
+        min_interval seconds ago; returns (old, new) or None if nothing changed.
+        """
+        with self.lock:
+            now = time.time()
+            if now - self.limit_changed < min_interval:
+                return None
+            new = decide(self.max)
+            if new is None or new == self.max:
+                return None
+            old, self.max = self.max, new
+            self.limit_changed = now
+            return old, new
+
+
+class FileLockAdmission:
+    """Host-wide limit shared by every gunicorn worker through an mmap'd file"""
+
+    # Header: magic, slot capacity, current limit, when the limit last changed | Slot: expiry (wall clock), lease id
+    # Waiter: expiry, arrival (wall clock), priority, waiter id. The file is the header, WAITERS waiters, then the slots.
+    HEADER = struct.Struct("<8sIId")
+    SLOT = struct.Struct("<d16s")
+    WAITER = struct.Struct("<ddI16s")
+    WAITERS = 256
+    MAGIC = b"FWZADM03"
+
+    def __init__(self, path, max_connections=16, lease_seconds=90, capacity=None, keep_limit=False):
+        """
+        capacity is the most the limit may ever grow to (default max_connections). With
+        keep_limit a limit already in the file survives a worker restart, otherwise every
+        worker resets it to max_connections.
+        """
+        if not FCNTL_AVAILABLE:
+            raise RuntimeError("File admission backend needs fcntl (not available on Windows)")
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()  # serialises greenlets/threads inside this process
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self._slot_offset(0) + self.SLOT.size * max(capacity or 0, max_connections)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            current_size = os.fstat(self.fd).st_size
+            header = os.pread(self.fd, self.HEADER.size, 0) if current_size >= self.HEADER.size else b""
+            valid = len(header) == self.HEADER.size and self.HEADER.unpack(header)[0] == self.MAGIC
+            if not valid:
+                # Fresh (or foreign) file - zero every slot
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+            elif current_size < size:
+                # Grown limit: new slots are zero-filled, existing leases are kept
+                os.ftruncate(self.fd, size)
+            else:
+                size = current_size
+            self.capacity = (size - self._slot_offset(0)) // self.SLOT.size
+            limit, changed = max_connections, 0.0
+            if valid and keep_limit:
+                _, _, stored_limit, stored_changed = self.HEADER.unpack(header)
+                if 0 < stored_limit <= self.capacity:
+                    limit, changed = stored_limit, stored_changed
+            os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.capacity, limit, changed), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        self.map = mmap.mmap(self.fd, size)
+
+    @property
+    def max(self):
+        return self.HEADER.unpack_from(self.map, 0)[2]
+
+    def _slot_offset(self, index):
+        return self.HEADER.size + self.WAITERS * self.WAITER.size + index * self.SLOT.size
+
+    def _waiter_offset(self, index):
+        return self.HEADER.size + index * self.WAITER.size
+
+    def _locked(self, fn):
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                return fn()
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _find(self, lease_bytes):
+        for index in range(self.capacity):
+            expiry, lease = self.SLOT.unpack_from(self.map, self._slot_offset(index))
+            if lease == lease_bytes:
+                return index
+        return None
+
+    def _take_slot(self, now):
+        live = 0
+        free_index = None
+        for index in range(self.capacity):
+            expiry, lease = self.SLOT.unpack_from(self.map, self._slot_offset(index))
+            if expiry > now:
+                live += 1
+            elif free_index is None:
+                free_index = index
+        if live >= self.HEADER.unpack_from(self.map, 0)[2] or free_index is None:
+            return None
+        lease = _new_lease_id()
+        self.SLOT.pack_into(self.map, self._slot_offset(free_index), now + self.lease_seconds, lease.encode())
+        return lease
+
+    def _live_waiters(self, now):
+        """waiter id -> (priority, arrival, index) for every live waiter, and the first free index"""
+        waiters = {}
+        free_index = None
+        for index in range(self.WAITERS):
+            expiry, arrival, priority, waiter = self.WAITER.unpack_from(self.map, self._waiter_offset(index))
+            if expiry > now:
+                waiters[waiter.rstrip(b"\0")] = (priority, arrival, index)
+            elif free_index is None:
+                free_index = index
+        return waiters, free_index
+
+    def try_acquire(self):
+        def acquire():
+            now = time.time()
+            for index in range(self.WAITERS):
+                if self.WAITER.unpack_from(self.map, self._waiter_offset(index))[0] > now:
+                    return None  # someone is queued, in this worker or another
+            return self._take_slot(now)
+
+        return self._locked(acquire)
+
+    def queue_poll(self, waiter, priority):
+        """
+        Keep a waiter queued (joining on the first call); returns (lease, position) -
+        a lease only once the waiter is first in line and a slot is free
+        """
+        def poll():
+            now = time.time()
+            key = waiter.encode()
+            waiters, index = self._live_waiters(now)
+            if key in waiters:
+                _, arrival, index = waiters.pop(key)
+            else:
+                arrival = now
+            if index is None:
+                # Table full: wait unregistered, behind everyone who is
+                position = len(waiters) + 1
+            else:
+                self.WAITER.pack_into(self.map, self._waiter_offset(index), now + WAITER_TTL_SECONDS, arrival, priority, key)
+                position = 1 + sum(1 for other, entry in waiters.items() if (entry[0], entry[1], other) < (priority, arrival, key))
+            if position > 1:
+                return None, position
+            lease = self._take_slot(now)
+            if lease and index is not None:
+                self.WAITER.pack_into(self.map, self._waiter_offset(index), 0.0, 0.0, 0, b"")
+            return lease, position
+
+        return self._locked(poll)
+
+    def queue_leave(self, waiter):
+        def leave():
+            entry = self._live_waiters(time.time())[0].get(waiter.encode())
+            if entry is not None:
+                self.WAITER.pack_into(self.map, self._waiter_offset(entry[2]), 0.0, 0.0, 0, b"")
+
+        self._locked(leave)
+
+    def renew(self, lease):
+        def renew_slot():
+            index = self._find(lease.encode())
+            if index is not None:
+                self.SLOT.pack_into(self.map, self._slot_offset(index), time.time() + self.lease_seconds, lease.encode())
+
+        if lease:
+            self._locked(renew_slot)
+
+    def release(self, lease=None):
+        def release_slot():
+            index = self._find(lease.encode())
+            if index is not None:
+                self.SLOT.pack_into(self.map, self._slot_offset(index), 0.0, b"")
+
+        if lease:
+            self._locked(release_slot)
+
+    def get_count(self):
+        def count():
+            now = time.time()
+            return sum(
+                1 for index in range(self.capacity)
+                if self.SLOT.unpack_from(self.map, self._slot_offset(index))[0] > now
+            )
+
+        return self._locked(count)
+
+    def adjust_limit(self, decide, min_interval):
+        """
+        Replace the limit with decide(current limit) unless it changed less than
+        min_interval seconds ago; returns (old, new) or None if nothing changed.
+        """
+        def adjust():
+            magic, capacity, limit, changed = self.HEADER.unpack_from(self.map, 0)
+            now = time.time()
+            if now - changed < min_interval:
+                return None
+            new = decide(limit)
+            if new is None:
+                return None
+            new = min(max(int(new), 1), capacity)
+            if new == limit:
+                return None
+            self.HEADER.pack_into(self.map, 0, magic, capacity, new, now)
+            return limit, new
+
+        return self._locked(adjust)
+
+
+class RespClient:
+    """Minimal Redis (RESP2) client - just enough for admission scripts"""
+
+    def __init__(self, host, port=6379, password=None, use_tls=False, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+        self.scripts = {}  # script source -> sha1
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.use_tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        if self.password:
+            self._send("AUTH", self.password)
+            self._read()
+
+    def _close(self):
+        try:
+            if self.sock:
+                self.sock.close()
+        finally:
+            self.sock = None
+            self.reader = None
+
+    def _send(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self.sock.sendall(b"".join(parts))
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RespError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read() for _ in range(length)]
+        raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+    def execute(self, *args):
+        with self.lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    self._send(*args)
+                    sent = True
+                    return self._read()
+                except (OSError, ConnectionError):
+                    self._close()
+                    # Once the command is out, Redis may have run it - only a failed
+                    # connect/send (stale pooled connection) is safe to retry
+                    if attempt or sent:
+                        raise
+
+    def eval(self, script, keys, args):
+        """Run a Lua script by its SHA1, loading it first if the server doesn't have it cached"""
+        sha = self.scripts.get(script)
+        if sha is not None:
+            try:
+                return self.execute("EVALSHA", sha, len(keys), *keys, *args)
+            except RespError as e:
+                if not str(e).startswith("NOSCRIPT"):
+                    raise
+        sha = self.execute("SCRIPT", "LOAD", script)
+        sha = sha.decode() if isinstance(sha, bytes) else sha
+        self.scripts[script] = sha
+        return self.execute("EVALSHA", sha, len(keys), *keys, *args)
+
+
+class RespError(Exception):
+    pass
+
+
+class RedisAdmission:
+    """
+    Cluster-wide limit stored as a sorted set (member = lease, score = expiry).
+    Waiters live in two more: one ordered by (priority, arrival), one by expiry.
+    """
+
+    PURGE_WAITERS = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+if #expired > 0 then
+    redis.call('ZREM', KEYS[2], unpack(expired))
+    redis.call('ZREM', KEYS[3], unpack(expired))
+end
+"""
+    ACQUIRE_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[4]) then return 1 end
+""" + PURGE_WAITERS + """
+if redis.call('ZCARD', KEYS[2]) > 0 then return 0 end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+    POLL_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[4]) then
+    redis.call('ZREM', KEYS[2], ARGV[6])
+    redis.call('ZREM', KEYS[3], ARGV[6])
+    return {1, 1}
+end
+""" + PURGE_WAITERS + """
+redis.call('ZADD', KEYS[2], 'NX', ARGV[7], ARGV[6])
+redis.call('ZADD', KEYS[3], ARGV[8], ARGV[6])
+redis.call('PEXPIRE', KEYS[2], ARGV[9])
+redis.call('PEXPIRE', KEYS[3], ARGV[9])
+local position = redis.call('ZRANK', KEYS[2], ARGV[6]) + 1
+if position > 1 then return {0, position} end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], ARGV[5])
+    redis.call('ZREM', KEYS[2], ARGV[6])
+    redis.call('ZREM', KEYS[3], ARGV[6])
+    return {1, 1}
+end
+return {0, 1}
+"""
+    RENEW_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+    ADJUST_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'limit', 'changed')
+if state[2] and tonumber(ARGV[1]) - tonumber(state[2]) < tonumber(ARGV[2]) then return 0 end
+if (state[1] or ARGV[3]) ~= ARGV[3] then return 0 end
+redis.call('HSET', KEYS[1], 'limit', ARGV[4], 'changed', ARGV[1])
+return 1
+"""
+
+    def __init__(self, resp_client, max_connections=16, lease_seconds=90, key="fowazz:admission", keep_limit=False):
+        self.redis = resp_client
+        self.configured_max = max_connections
+        self.lease_seconds = lease_seconds
+        self.key = key
+        self.limit_key = key + ":limit"
+        self.queue_key = key + ":queue"
+        self.queue_expiry_key = key + ":queue:expiry"
+        self.cached_limit = (0.0, max_connections)  # (read at, limit) - re-read at most once a second
+        # If Redis is unreachable we degrade to a per-process limit instead of failing every chat
+        self.fallback = ConnectionCounter(max_connections, lease_seconds)
+        self.fallback_leases = set()
+        if not keep_limit:
+            try:
+                self.redis.execute("DEL", self.limit_key)
+            except (OSError, ConnectionError, RespError):
+                pass
+
+    def _read_limit(self):
+        try:
+            value = self.redis.execute("HGET", self.limit_key, "limit")
+        except (OSError, ConnectionError, RespError):
+            return self.cached_limit[1]
+        limit = int(value) if value else self.configured_max
+        self.cached_limit = (time.monotonic(), limit)
+        return limit
+
+    @property
+    def max(self):
+        read_at, limit = self.cached_limit
+        if time.monotonic() - read_at < 1.0:
+            return limit
+        return self._read_limit()
+
+    def adjust_limit(self, decide, min_interval):
+        """
+        Replace the limit with decide(current limit) unless it changed less than
+        min_interval seconds ago; returns (old, new) or None if nothing changed.
+        """
+        limit = self._read_limit()
+        new = decide(limit)
+        if new is None or new == limit:
+            return None
+        try:
+            changed = self.redis.eval(self.ADJUST_SCRIPT, [self.limit_key], [time.time(), min_interval, limit, new])
+        except (OSError, ConnectionError, RespError) as e:
+            print(f"⚠️ Failed to change admission limit: {str(e)}")
+            return None
+        if changed != 1:
+            return None
+        self.cached_limit = (time.monotonic(), new)
+        return limit, new
+
+    def try_acquire(self):
+        now = time.time()
+        lease = _new_lease_id()
+        ttl_ms = int(self.lease_seconds * 1000)
+        try:
+            for attempt in range(2):
+                try:
+                    acquired = self.redis.eval(
+                        self.ACQUIRE_SCRIPT, [self.key, self.queue_key, self.queue_expiry_key],
+                        [now, self.max, now + self.lease_seconds, lease, ttl_ms]
+                    )
+                    return lease if acquired == 1 else None
+                except (OSError, ConnectionError):
+                    # The reply was lost, not necessarily the command; the script returns 1
+                    # for a lease it already holds, so retrying with the same id can't take a second slot
+                    if attempt:
+                        raise
+        except (OSError, ConnectionError, RespError) as e:
+            print(f"⚠️ Redis admission unavailable, using local limit: {str(e)}")
+            lease = self.fallback.try_acquire()
+            if lease:
+                self.fallback_leases.add(lease)
+            return lease
+
+    def queue_poll(self, waiter, priority):
+        """
+        Keep a waiter queued (joining on the first call); returns (lease, position) -
+        a lease only once the waiter is first in line and a slot is free
+        """
+        now = time.time()
+        lease = _new_lease_id()
+        try:
+            for attempt in range(2):
+                try:
+                    # Lower scores go first: the priority, then the arrival time (kept by ZADD NX)
+                    acquired, position = self.redis.eval(
+                        self.POLL_SCRIPT, [self.key, self.queue_key, self.queue_expiry_key],
+                        [now, self.max, now + self.lease_seconds, lease, int(self.lease_seconds * 1000),
+                         waiter, priority * 1e10 + now, now + WAITER_TTL_SECONDS, int(WAITER_TTL_SECONDS * 1000)]
+                    )
+                    return (lease if acquired == 1 else None), position
+                except (OSError, ConnectionError):
+                    # As in try_acquire: a retried poll finds the lease it already took
+                    if attempt:
+                        raise
+        except (OSError, ConnectionError, RespError):
+            lease, position = self.fallback.queue_poll(waiter, priority)
+            if lease:
+                self.fallback_leases.add(lease)
+            return lease, position
+
+    def queue_leave(self, waiter):
+        self.fallback.queue_leave(waiter)
+        try:
+            self.redis.execute("ZREM", self.queue_key, waiter)
+            self.redis.execute("ZREM", self.queue_expiry_key, waiter)
+        except (OSError, ConnectionError, RespError) as e:
+            # The waiter drops out on its own once it stops polling
+            print(f"⚠️ Failed to leave the admission queue: {str(e)}")
+
+    def renew(self, lease):
+        if not lease:
+            return
+        if lease in self.fallback_leases:
+            self.fallback.renew(lease)
+            return
+        try:
+            self.redis.eval(
+                self.RENEW_SCRIPT, [self.key],
+                [time.time() + self.lease_seconds, lease, int(self.lease_seconds * 1000)]
+            )
+        except (OSError, ConnectionError, RespError) as e:
+            print(f"⚠️ Failed to renew admission lease: {str(e)}")
+
+    def release(self, lease=None):
+        if not lease:
+            return
+        if lease in self.fallback_leases:
+            self.fallback_leases.discard(lease)
+            self.fallback.release(lease)
+            return
+        try:
+            self.redis.execute("ZREM", self.key, lease)
+        except (OSError, ConnectionError, RespError) as e:
+            # The lease still expires on its own
+            print(f"⚠️ Failed to release admission lease: {str(e)}")
+
+    def get_count(self):
+        try:
+            return self.redis.execute("ZCOUNT", self.key, f"({time.time()}", "+inf")
+        except (OSError, ConnectionError, RespError):
+            return self.fallback.get_count()
+
+
+def redis_client_from_env():
+    """RESP client for the Redis server described by REDIS_HOST/PORT/PASSWORD/TLS"""
+    return RespClient(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+        password=os.getenv("REDIS_PASSWORD") or None,
+        use_tls=os.getenv("REDIS_TLS") == "true",
+    )
+
+
+def create_admission_backend():
+    """Build the admission backend selected by ADMISSION_BACKEND (local, file or redis)"""
+    max_connections = int(os.getenv("MAX_CONCURRENT_USERS", "16"))
+    lease_seconds = float(os.getenv("ADMISSION_LEASE_SECONDS", "90"))
+    backend = os.getenv("ADMISSION_BACKEND", "file" if FCNTL_AVAILABLE else "local").lower()
+    # An adaptive limit may grow up to ADAPTIVE_MAX_USERS and is kept across worker restarts
+    adaptive = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+    capacity = max(int(os.getenv("ADAPTIVE_MAX_USERS", "64")), max_connections) if adaptive else max_connections
+
+    if backend == "redis":
+        return RedisAdmission(redis_client_from_env(), max_connections, lease_seconds, keep_limit=adaptive)
+
+    if backend == "file":
+        path = os.getenv("ADMISSION_FILE", "/tmp/fowazz-admission.slots")
+        try:
+            return FileLockAdmission(path, max_connections, lease_seconds, capacity=capacity, keep_limit=adaptive)
+        except (OSError, RuntimeError) as e:
+            print(f"⚠️ File admission backend unavailable, using per-process limit: {str(e)}")
+
+    return ConnectionCounter(max_connections, lease_seconds)
+
+
+class AdmissionQueue:
+    """
+    Bounded priority queue in front of an admission backend.
+
+    Waiters are served in (priority, arrival) order - lower priority values go
+    first, so paid plans can jump ahead of free users. The order is kept by the
+    backend, so it holds across every worker (and node) sharing it: each waiter
+    polls the backend for its position, and only the first one in line gets a
+    freed slot. A waiter is woken early when a slot is released in this process;
+    slots freed by other workers or nodes are noticed on the next poll.
+    max_waiting bounds the waiters of this process.
+    """
+
+    KEEPALIVE_SECONDS = 15
+
+    def __init__(self, backend, max_waiting=64, poll_interval=0.25):
+        self.backend = backend
+        self.max_waiting = max_waiting
+        self.poll_interval = poll_interval
+        self.waiting = []  # tickets sorted by (priority, seq)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    @property
+    def max(self):
+        return self.backend.max
+
+    def get_count(self):
+        return self.backend.get_count()
+
+    def get_waiting(self):
+        with self.lock:
+            return len(self.waiting)
+
+    def renew(self, lease):
+        self.backend.renew(lease)
+
+    def adjust_limit(self, decide, min_interval):
+        result = self.backend.adjust_limit(decide, min_interval)
+        if result and result[1] > result[0]:
+            self._wake_head()  # room for whoever is waiting
+        return result
+
+    def try_acquire(self):
+        """Fast path: grab a slot only if nobody is queued (the backend checks the other workers)"""
+        with self.lock:
+            if self.waiting:
+                return None
+        return self.backend.try_acquire()
+
+    def release(self, lease=None):
+        self.backend.release(lease)
+        self._wake_head()
+
+    def enqueue(self, priority=1):
+        """Join the queue, or return None when it is already full"""
+        with self.lock:
+            if len(self.waiting) >= self.max_waiting:
+                return None
+            self.seq += 1
+            ticket = QueueTicket(priority, self.seq)
+            self.waiting.append(ticket)
+            self.waiting.sort(key=lambda t: (t.priority, t.seq))
+            return ticket
+
+    def wait(self, ticket, timeout):
+        """
+        Wait for a slot, yielding the 1-based queue position whenever it changes.
+        On return ticket.lease holds the lease, or None if the deadline passed or the ticket was cancelled.
+        """
+        deadline = time.monotonic() + timeout
+        last_position = None
+        last_yield = 0
+        try:
+            while not ticket.cancelled:
+                ticket.lease, position = self.backend.queue_poll(ticket.id, ticket.priority)
+                if ticket.lease:
+                    return
+                # Re-send an unchanged position now and then so proxies don't drop the idle stream
+                if position != last_position or time.monotonic() - last_yield > self.KEEPALIVE_SECONDS:
+                    last_position = position
+                    last_yield = time.monotonic()
+                    yield position
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                ticket.event.wait(min(self.poll_interval, remaining))
+                ticket.event.clear()
+        finally:
+            self._leave(ticket)
+            # Whoever is next now gets a chance straight away
+            self._wake_head()
+
+    async def wait_async(self, ticket, timeout):
+        """
+        wait() for an event loop (asgi.py): an async generator that sleeps between polls
+        instead of blocking a thread on the ticket. Same positions, same ticket.lease on return.
+        """
+        deadline = time.monotonic() + timeout
+        last_position = None
+        last_yield = 0
+        try:
+            while not ticket.cancelled:
+                # Backends block on Redis or a file lock
+                poll = asyncio.ensure_future(asyncio.to_thread(self.backend.queue_poll, ticket.id, ticket.priority))
+                try:
+                    ticket.lease, position = await asyncio.shield(poll)
+                except asyncio.CancelledError:
+                    poll.add_done_callback(lambda done: self._release_orphan(done, ticket))
+                    raise
+                if ticket.lease:
+                    return
+                if position != last_position or time.monotonic() - last_yield > self.KEEPALIVE_SECONDS:
+                    last_position = position
+                    last_yield = time.monotonic()
+                    yield position
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                await asyncio.sleep(min(self.poll_interval, remaining))
+        finally:
+            # In a thread rather than awaited, so a cancelled waiter still leaves the queue
+            threading.Thread(target=self._leave, args=(ticket,), daemon=True).start()
+            self._wake_head()
+
+    def _leave(self, ticket):
+        with self.lock:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+        if not ticket.lease:
+            self.backend.queue_leave(ticket.id)
+
+    def _release_orphan(self, poll, ticket):
+        # The waiter was cancelled mid-poll, which may have taken a slot or put it back in line
+        if poll.cancelled() or poll.exception() is not None:
+            return
+        lease = poll.result()[0]
+        if lease:
+            threading.Thread(target=self.release, args=(lease,), daemon=True).start()
+        else:
+            threading.Thread(target=self.backend.queue_leave, args=(ticket.id,), daemon=True).start()
+
+    def _wake_head(self):
+        with self.lock:
+            if self.waiting:
+                self.waiting[0].event.set()
+
+
+class QueueTicket:
+    def __init__(self, priority, seq):
+        self.id = _new_lease_id()  # the waiter's name in the backend's queue
+        self.priority = priority
+        self.seq = seq
+        self.lease = None
+        self.cancelled = False
+        self.event = threading.Event()
+
+    def cancel(self):
+        """Stop waiting (the client went away); wait() returns without a lease"""
+        self.cancelled = True
+        self.event.set()
+
+
+class AdaptiveLimiter:
+    """
+    Moves the admission limit with upstream latency (AIMD with a latency gradient).
+
+    Every finished stream reports its time to first token and tokens/sec. Each
+    interval the median of the recent samples is compared with a baseline (the
+    best values seen lately, drifting slowly so a permanent change is accepted):
+
+        gradient = min(baseline TTFT / recent TTFT, recent tok/s / baseline tok/s)
+
+    Below `tolerance` GLM is slowing down under our load, so the limit is cut to
+    limit * gradient (at most halved). Otherwise, if the limit is actually being
+    hit (slots all taken or people queued), it grows by one. The limit stays
+    within [min_limit, max_limit].
+    """
+
+    def __init__(self, queue, min_limit=4, max_limit=64, interval=10.0, min_samples=5, tolerance=0.8,
+                 baseline_drift=0.05):
+        self.queue = queue
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.min_samples = min_samples
+        self.tolerance = tolerance
+        self.baseline_drift = baseline_drift
+        self.lock = threading.Lock()
+        self.samples = []  # (ttft, tokens/sec) since the last decision
+        self.baseline_ttft = None
+        self.baseline_tps = None
+        self.recent = None  # (ttft, tokens/sec) medians behind the last decision
+        self.last_decision = time.monotonic()
+        self.cause = "initial"  # short label for metrics: clamped / upstream_slowing / saturated_healthy
+        self.reason = "initial limit"
+        self.changes = collections.deque(maxlen=20)  # changes made by this worker
+        self.counts = collections.Counter()  # changes made by this worker, by cause
+
+    def observe(self, ttft, tokens_per_sec):
+        """Report one finished stream; may change the limit"""
+        with self.lock:
+            self.samples.append((ttft, tokens_per_sec))
+            if len(self.samples) < self.min_samples or time.monotonic() - self.last_decision < self.interval:
+                return
+            samples, self.samples = self.samples, []
+            self.last_decision = time.monotonic()
+            ttft = _median([sample[0] for sample in samples])
+            tps = _median([sample[1] for sample in samples])
+            # The baseline is the best recent latency, loosened a little each round
+            self.baseline_ttft = ttft if self.baseline_ttft is None else min(ttft, self.baseline_ttft * (1 + self.baseline_drift))
+            self.baseline_tps = tps if self.baseline_tps is None else max(tps, self.baseline_tps * (1 - self.baseline_drift))
+            self.recent = (ttft, tps)
+        self._adjust(ttft, tps)
+
+    def _adjust(self, ttft, tps):
+        gradient = min(self.baseline_ttft / ttft if ttft else 1.0, tps / self.baseline_tps if self.baseline_tps else 1.0)
+        saturated = self.queue.get_waiting() > 0 or self.queue.get_count() >= self.queue.max - 1
+        summary = f"TTFT {ttft:.2f}s (baseline {self.baseline_ttft:.2f}s), {tps:.0f} tok/s (baseline {self.baseline_tps:.0f})"
+        cause = reason = None
+
+        def decide(limit):
+            nonlocal cause, reason
+            if limit < self.min_limit or limit > self.max_limit:
+                cause, reason = "clamped", f"limit outside [{self.min_limit}, {self.max_limit}]"
+                return min(max(limit, self.min_limit), self.max_limit)
+            if gradient < self.tolerance:
+                cause, reason = "upstream_slowing", f"upstream slowing: {summary}"
+                return max(self.min_limit, min(limit - 1, int(limit * max(gradient, 0.5))))
+            if saturated and limit < self.max_limit:
+                cause, reason = "saturated_healthy", f"limit reached and upstream healthy: {summary}"
+                return limit + 1
+            return None
+
+        result = self.queue.adjust_limit(decide, self.interval)
+        if result:
+            old, new = result
+            with self.lock:
+                self.cause, self.reason = cause, reason
+                self.counts[cause] += 1
+                self.changes.append({"time": time.time(), "from": old, "to": new, "cause": cause, "reason": reason})
+            print(f"🎚️ Admission limit {old} -> {new}: {reason}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": self.queue.max,
+                "min": self.min_limit,
+                "max": self.max_limit,
+                "cause": self.cause,
+                "reason": self.reason,
+                "baseline": {"ttft": self.baseline_ttft, "tokens_per_sec": self.baseline_tps},
+                "recent": {"ttft": self.recent[0], "tokens_per_sec": self.recent[1]} if self.recent else None,
+                "pending_samples": len(self.samples),
+                "changes": list(self.changes),
+                "changes_by_cause": dict(self.counts),
+            }
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def create_adaptive_limiter(queue):
+    """AdaptiveLimiter from ADAPTIVE_* environment variables, or None unless ADAPTIVE_CONCURRENCY=true"""
+    if os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() != "true":
+        return None
+    return AdaptiveLimiter(
+        queue,
+        min_limit=int(os.getenv("ADAPTIVE_MIN_USERS", "4")),
+        max_limit=max(int(os.getenv("ADAPTIVE_MAX_USERS", "64")), 1),
+        interval=float(os.getenv("ADAPTIVE_INTERVAL_SECONDS", "10")),
+        min_samples=int(os.getenv("ADAPTIVE_MIN_SAMPLES", "5")),
+        tolerance=float(os.getenv("ADAPTIVE_TOLERANCE", "0.8")),
+    )
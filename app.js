@@ -1599,8 +1599,10 @@ window.handleSurpriseMe = async function() {
   try {
     const response = await fetch(API_ENDPOINT, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ messages: conversationHistory })
+      // Stream v2: the final event carries a hash instead of repeating the whole response
+      headers: { 'Content-Type': 'application/json', 'X-Fowazz-Stream-Version': '2', ...(await getAuthHeaders()) },
+      // "Surprise me" prompts repeat a lot - let the server answer from its response cache
+      body: JSON.stringify({ messages: conversationHistory, cache: true, thinkingProgress: true, artifactEvents: true })
     });
 
     if (!response.ok) {
@@ -1641,24 +1643,60 @@ window.handleSurpriseMe = async function() {
           try {
             const jsonData = JSON.parse(line.slice(6));
 
+            // Site is busy - we're waiting in line for a free slot
+            if (jsonData.queued) {
+              console.log(`⏳ Waiting in queue, position ${jsonData.position}`);
+            }
+
+            // Parallel build - per-page status while pages generate side by side
+            if (jsonData.progress) {
+              console.log(`🏗️ ${jsonData.progress.page}: ${jsonData.progress.status}`);
+            }
+
+            // Model is still reasoning - show how far along it is instead of a bare spinner
+            if (jsonData.thinking) {
+              const buildStatus = document.getElementById('build-status');
+              if (buildStatus && !jsonData.thinking.done) {
+                buildStatus.textContent = `Thinking... (${Math.round(jsonData.thinking.seconds)}s)`;
+              }
+            }
+
             if (jsonData.chunk) {
               accumulatedContent += jsonData.chunk;
 
-              // Check for building indicators
+              // Check for building indicators - only in the newest text, not the whole response again
               if (!hasUpgradedToBuildProgress) {
-                const hasPlanningKeyword = /\*\*Planned subpages?:\*\*|^#+\s*(planned subpages|site structure|pages)/im.test(accumulatedContent);
-                const hasArtifactStart = /\[ARTIFACT:START:/i.test(accumulatedContent);
-                const hasBuildingPhrase = /(?:let's build|i'll build|building|creating|generating).{0,30}(?:website|site|page)/i.test(accumulatedContent);
+                const recentText = accumulatedContent.slice(-(jsonData.chunk.length + 60));
+                const hasPlanningKeyword = /\*\*Planned subpages?:\*\*|^#+\s*(planned subpages|site structure|pages)/im.test(recentText);
+                const hasBuildingPhrase = /(?:let's build|i'll build|building|creating|generating).{0,30}(?:website|site|page)/i.test(recentText);
 
-                if (hasPlanningKeyword || hasArtifactStart || hasBuildingPhrase) {
+                if (hasPlanningKeyword || hasBuildingPhrase) {
                   removeTypingIndicator();
                   showTypingIndicator(true);
                   hasUpgradedToBuildProgress = true;
                 }
               }
+            }
+
+            // Page code arrives as artifact_delta events (we asked for artifactEvents)
+            if (jsonData.artifact_delta) {
+              accumulatedContent += jsonData.artifact_delta.text;
+            }
 
-              // Phase 1: Show intro message when we detect first artifact starting
-              if (!introShown && /\[ARTIFACT:START:/i.test(accumulatedContent)) {
+            if (jsonData.title) {
+              updateChatTitle(jsonData.title);
+            }
+
+            if (jsonData.artifact_start) {
+              console.log(`📄 Building ${jsonData.artifact_start.name}`);
+              if (!hasUpgradedToBuildProgress) {
+                removeTypingIndicator();
+                showTypingIndicator(true);
+                hasUpgradedToBuildProgress = true;
+              }
+
+              // Phase 1: Show intro message when the first artifact starts
+              if (!introShown) {
                 const firstArtifactPos = accumulatedContent.indexOf('[ARTIFACT:START:');
                 const introText = accumulatedContent.substring(0, firstArtifactPos).trim();
 
@@ -1678,13 +1716,17 @@ window.handleSurpriseMe = async function() {
                   introShown = true;
                 }
               }
-
             }
 
             if (jsonData.done) {
               const finalContent = jsonData.content || accumulatedContent;
               removeTypingIndicator();
 
+              if (jsonData.error === 'SITE_FULL') {
+                addMessage('assistant', typeof t === 'function' ? t('siteFull') : '🚦 ' + jsonData.message);
+                streamComplete = true;
+                break;
+              }
               if (jsonData.error) {
                 addMessage('assistant', '⚠️ Error: ' + jsonData.error);
                 streamComplete = true;
@@ -2158,8 +2200,9 @@ async function sendMessage() {
   try {
     const response = await fetch(API_ENDPOINT, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ messages: conversationHistory })
+      // Stream v2: the final event carries a hash instead of repeating the whole response
+      headers: { 'Content-Type': 'application/json', 'X-Fowazz-Stream-Version': '2', ...(await getAuthHeaders()) },
+      body: JSON.stringify({ messages: conversationHistory, thinkingProgress: true, artifactEvents: true })
     });
 
     if (!response.ok) {
@@ -2200,24 +2243,60 @@ async function sendMessage() {
           try {
             const jsonData = JSON.parse(line.slice(6));
 
+            // Site is busy - we're waiting in line for a free slot
+            if (jsonData.queued) {
+              console.log(`⏳ Waiting in queue, position ${jsonData.position}`);
+            }
+
+            // Parallel build - per-page status while pages generate side by side
+            if (jsonData.progress) {
+              console.log(`🏗️ ${jsonData.progress.page}: ${jsonData.progress.status}`);
+            }
+
+            // Model is still reasoning - show how far along it is instead of a bare spinner
+            if (jsonData.thinking) {
+              const buildStatus = document.getElementById('build-status');
+              if (buildStatus && !jsonData.thinking.done) {
+                buildStatus.textContent = `Thinking... (${Math.round(jsonData.thinking.seconds)}s)`;
+              }
+            }
+
             if (jsonData.chunk) {
               accumulatedContent += jsonData.chunk;
 
-              // Check for building indicators
+              // Check for building indicators - only in the newest text, not the whole response again
               if (!hasUpgradedToBuildProgress) {
-                const hasPlanningKeyword = /\*\*Planned subpages?:\*\*|^#+\s*(planned subpages|site structure|pages)/im.test(accumulatedContent);
-                const hasArtifactStart = /\[ARTIFACT:START:/i.test(accumulatedContent);
-                const hasBuildingPhrase = /(?:let's build|i'll build|building|creating|generating).{0,30}(?:website|site|page)/i.test(accumulatedContent);
+                const recentText = accumulatedContent.slice(-(jsonData.chunk.length + 60));
+                const hasPlanningKeyword = /\*\*Planned subpages?:\*\*|^#+\s*(planned subpages|site structure|pages)/im.test(recentText);
+                const hasBuildingPhrase = /(?:let's build|i'll build|building|creating|generating).{0,30}(?:website|site|page)/i.test(recentText);
 
-                if (hasPlanningKeyword || hasArtifactStart || hasBuildingPhrase) {
+                if (hasPlanningKeyword || hasBuildingPhrase) {
                   removeTypingIndicator();
                   showTypingIndicator(true);
                   hasUpgradedToBuildProgress = true;
                 }
               }
+            }
+
+            // Page code arrives as artifact_delta events (we asked for artifactEvents)
+            if (jsonData.artifact_delta) {
+              accumulatedContent += jsonData.artifact_delta.text;
+            }
+
+            if (jsonData.title) {
+              updateChatTitle(jsonData.title);
+            }
+
+            if (jsonData.artifact_start) {
+              console.log(`📄 Building ${jsonData.artifact_start.name}`);
+              if (!hasUpgradedToBuildProgress) {
+                removeTypingIndicator();
+                showTypingIndicator(true);
+                hasUpgradedToBuildProgress = true;
+              }
 
-              // Phase 1: Show intro message when we detect first artifact starting
-              if (!introShown && /\[ARTIFACT:START:/i.test(accumulatedContent)) {
+              // Phase 1: Show intro message when the first artifact starts
+              if (!introShown) {
                 const firstArtifactPos = accumulatedContent.indexOf('[ARTIFACT:START:');
                 const introText = accumulatedContent.substring(0, firstArtifactPos).trim();
 
@@ -2243,6 +2322,11 @@ async function sendMessage() {
               const finalContent = jsonData.content || accumulatedContent;
               removeTypingIndicator();
 
+              if (jsonData.error === 'SITE_FULL') {
+                addMessage('assistant', typeof t === 'function' ? t('siteFull') : '🚦 ' + jsonData.message);
+                streamComplete = true;
+                break;
+              }
               if (jsonData.error) {
                 addMessage('assistant', '⚠️ Error: ' + jsonData.error);
                 streamComplete = true;
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Artifact registry helpers and the patch ("edit mode") output protocol.
+
+For small edits the model can answer with a patch instead of a whole page:
+
+    [ARTIFACT:PATCH:index.html]
+    <<<<<<< SEARCH
+    <h1>Old heading</h1>
+    =======
+    <h1>New heading</h1>
+    >>>>>>> REPLACE
+    [ARTIFACT:END]
+
+PatchStreamRewriter sits between the upstream stream and the client: normal
+text and [ARTIFACT:START:...] blocks pass straight through, while patch blocks
+are held back, applied to the stored page and streamed out as the full,
+updated [ARTIFACT:START:...] block - so clients never see the patch syntax.
+
+ContinuationStitcher joins the output of an automatic continuation call onto
+a response that was cut off by the token limit.
+
+ArtifactEventParser splits the outgoing stream into typed events (title,
+artifact start/delta/end) so clients don't have to re-scan the whole response
+with a regex on every chunk.
+"""
+import hashlib
+import re
+
+ARTIFACT_RE = re.compile(r"\[ARTIFACT:START:(.+?)\]\n?([\s\S]*?)\n?\[ARTIFACT:END\]")
+ARTIFACT_START = "[ARTIFACT:START:"
+PATCH_START = "[ARTIFACT:PATCH:"
+ARTIFACT_END = "[ARTIFACT:END]"
+TITLE_START = "[TITLE:"
+MAX_MARKER_LENGTH = 200  # a "[TITLE:" or "[ARTIFACT:START:" with no "]" this far on is just text
+SEARCH_REPLACE_RE = re.compile(
+    r"<<<<<<< SEARCH\n([\s\S]*?)\n=======\n([\s\S]*?)\n?>>>>>>> REPLACE"
+)
+
+
+class PatchError(Exception):
+    pass
+
+
+def extract_artifacts(text):
+    """name -> content for every complete artifact in text (later copies win)"""
+    return {match.group(1).strip(): match.group(2) for match in ARTIFACT_RE.finditer(text or "")}
+
+
+def latest_artifacts(messages):
+    """The newest version of every page built so far in a conversation"""
+    artifacts = {}
+    for message in messages:
+        content = message.get("content")
+        if message.get("role") == "assistant" and isinstance(content, str) and "[ARTIFACT:START:" in content:
+            artifacts.update(extract_artifacts(content))
+    return artifacts
+
+
+def format_artifact(name, content):
+    return f"[ARTIFACT:START:{name}]\n{content}\n[ARTIFACT:END]"
+
+
+def _replace_fuzzy(content, search, replace):
+    """Match the search lines ignoring leading/trailing whitespace on each line"""
+    lines = content.split("\n")
+    search_lines = [line.strip() for line in search.strip("\n").split("\n")]
+    window = len(search_lines)
+    for start in range(len(lines) - window + 1):
+        if [line.strip() for line in lines[start:start + window]] == search_lines:
+            replace_lines = replace.split("\n") if replace else []
+            return "\n".join(lines[:start] + replace_lines + lines[start + window:])
+    return None
+
+
+def apply_patch(content, patch_body):
+    """Apply every SEARCH/REPLACE block of a patch, raising PatchError if one doesn't match"""
+    blocks = SEARCH_REPLACE_RE.findall(patch_body)
+    if not blocks:
+        raise PatchError("patch has no SEARCH/REPLACE blocks")
+    for search, replace in blocks:
+        if not search.strip():
+            raise PatchError("empty SEARCH block")
+        if not replace:
+            # A deletion removes the whole lines SEARCH covers instead of leaving them blank
+            patched = _replace_fuzzy(content, search, replace)
+            if patched is not None:
+                content = patched
+                continue
+        if search in content:
+            content = content.replace(search, replace, 1)
+            continue
+        patched = _replace_fuzzy(content, search, replace)
+        if patched is None:
+            raise PatchError(f"SEARCH block not found: {search.strip()[:80]!r}")
+        content = patched
+    return content
+
+
+class PatchStreamRewriter:
+    """
+    Incrementally rewrites streamed model output, expanding patch blocks into full pages.
+    Markers may be split across any number of deltas.
+    """
+
+    def __init__(self, artifacts):
+        self.artifacts = dict(artifacts)  # name -> current content, updated as patches apply
+        self.pending = ""
+        self.patch_name = None  # set while inside a patch block
+        self.applied = []
+        self.failed = []
+
+    def _held_back(self, text, marker):
+        """Length of the longest suffix of text that could be the start of marker"""
+        tail = text[-(len(marker) - 1):]
+        index = tail.find("[")
+        while index != -1:
+            if marker.startswith(tail[index:]):
+                return len(tail) - index
+            index = tail.find("[", index + 1)
+        return 0
+
+    def feed(self, text):
+        self.pending += text
+        output = []
+        while True:
+            if self.patch_name is None:
+                index = self.pending.find(PATCH_START)
+                if index == -1:
+                    keep = self._held_back(self.pending, PATCH_START)
+                    output.append(self.pending[:len(self.pending) - keep])
+                    self.pending = self.pending[len(self.pending) - keep:]
+                    break
+                header_end = self.pending.find("]", index)
+                if header_end == -1:
+                    output.append(self.pending[:index])
+                    self.pending = self.pending[index:]
+                    break
+                output.append(self.pending[:index])
+                self.patch_name = self.pending[index + len(PATCH_START):header_end].strip()
+                self.pending = self.pending[header_end + 1:]
+            else:
+                index = self.pending.find(ARTIFACT_END)
+                if index == -1:
+                    break  # keep buffering the patch body
+                body = self.pending[:index]
+                self.pending = self.pending[index + len(ARTIFACT_END):]
+                output.append(self._apply(self.patch_name, body))
+                self.patch_name = None
+        return "".join(output)
+
+    def _apply(self, name, body):
+        current = self.artifacts.get(name)
+        if current is None:
+            self.failed.append(name)
+            return f"\n⚠️ Couldn't edit {name} - that page doesn't exist yet.\n"
+        try:
+            updated = apply_patch(current, body)
+        except PatchError as e:
+            print(f"⚠️ Patch for {name} failed: {str(e)}")
+            self.failed.append(name)
+            return f"\n⚠️ Couldn't apply one of the edits to {name} - ask me to try again.\n"
+        self.artifacts[name] = updated
+        self.applied.append(name)
+        return format_artifact(name, updated)
+
+    def finish(self):
+        """Flush whatever is left when the stream ends (an unterminated patch is dropped)"""
+        if self.patch_name is not None:
+            self.failed.append(self.patch_name)
+            output = f"\n⚠️ The edit to {self.patch_name} was cut off before it finished.\n"
+        else:
+            output = self.pending
+        self.pending = ""
+        self.patch_name = None
+        return output
+
+
+def open_artifact_name(text):
+    """Name of the artifact left unclosed at the end of text, if any"""
+    start = text.rfind("[ARTIFACT:START:")
+    if start == -1 or text.find(ARTIFACT_END, start) != -1:
+        return None
+    header_end = text.find("]", start)
+    return text[start + len("[ARTIFACT:START:"):header_end].strip() if header_end != -1 else None
+
+
+class ContinuationStitcher:
+    """
+    Cleans up the first few hundred characters of a continuation so it joins the
+    cut-off output seamlessly: drops a re-opened [ARTIFACT:START:...] for the page
+    that was being written, a repeated [TITLE:...], and the lines the model
+    repeated to restart the line it was cut off in.
+    """
+
+    WINDOW = 300
+    MIN_OVERLAP = 16
+
+    def __init__(self, previous):
+        self.previous_tail = previous[-2000:]
+        self.open_artifact = open_artifact_name(previous)
+        self.buffer = ""
+        self.resolved = False
+
+    def feed(self, text):
+        if self.resolved:
+            return text
+        self.buffer += text
+        if len(self.buffer) < self.WINDOW:
+            return ""
+        return self._resolve()
+
+    def finish(self):
+        return "" if self.resolved else self._resolve()
+
+    def _resolve(self):
+        self.resolved = True
+        text, self.buffer = self.buffer, ""
+
+        stripped = text.lstrip()
+        if stripped.startswith("[TITLE:") and "]" in stripped:
+            stripped = stripped[stripped.index("]") + 1:].lstrip()
+            text = stripped
+        if self.open_artifact:
+            marker = f"[ARTIFACT:START:{self.open_artifact}]"
+            if stripped.startswith(marker):
+                text = stripped[len(marker):].lstrip("\n")
+
+        # Only a repeat that runs through the point where the output was cut off is trimmed: it
+        # has to start on a line boundary and cover the unfinished last line. Output cut off on a
+        # line boundary is left alone, since a repeated line (a second <br>, say) may be meant.
+        partial = self.previous_tail[self.previous_tail.rfind("\n") + 1:]
+        if not partial:
+            return text
+        tail_length = len(self.previous_tail)
+        for overlap in range(min(len(text), tail_length), max(self.MIN_OVERLAP, len(partial)) - 1, -1):
+            start = tail_length - overlap
+            if (start == 0 or self.previous_tail[start - 1] == "\n") and self.previous_tail.endswith(text[:overlap]):
+                return text[overlap:]
+        return text
+
+
+def _partial_marker(text, markers):
+    """Length of the longest suffix of text that could be the start of one of markers"""
+    longest = max(len(marker) for marker in markers)
+    tail = text[-(longest - 1):]
+    index = tail.find("[")
+    while index != -1:
+        if any(marker.startswith(tail[index:]) for marker in markers):
+            return len(tail) - index
+        index = tail.find("[", index + 1)
+    return 0
+
+
+class ArtifactEventParser:
+    """
+    Incrementally splits response text into typed events; markers may be split across
+    any number of deltas. feed() and finish() return lists of:
+
+        ("chunk", text)                                - text outside artifact bodies, markers included
+        ("title", title)                               - a [TITLE:...] marker was completed
+        ("artifact_start", {"name"})
+        ("artifact_delta", {"name", "text"})           - artifact body text
+        ("artifact_end", {"name", "sha256", "bytes"})
+        ("incomplete", {"name", "sha256", "bytes"})    - the text ended inside an artifact
+
+    Concatenating every chunk and artifact_delta text gives back exactly the input.
+    sha256/bytes are those of the page content as extract_artifacts() returns it.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        self.name = None  # set while inside an artifact body
+        self.hash = None
+        self.bytes = 0
+        self.body_started = False
+        self.newline_held = False  # a trailing "\n" that isn't part of the page if [ARTIFACT:END] follows
+
+    def feed(self, text):
+        self.pending += text
+        events = []
+        while self.pending:
+            if self.name is None:
+                if not self._feed_text(events):
+                    break
+            elif not self._feed_body(events):
+                break
+        return events
+
+    def _feed_text(self, events):
+        """Emit text up to and including the next complete marker; False when more input is needed"""
+        starts = [index for index in (self.pending.find(ARTIFACT_START), self.pending.find(TITLE_START)) if index != -1]
+        if not starts:
+            keep = _partial_marker(self.pending, (ARTIFACT_START, TITLE_START))
+            self._emit_chunk(events, len(self.pending) - keep)
+            return False
+        start = min(starts)
+        header_end = self.pending.find("]", start)
+        if header_end == -1:
+            if len(self.pending) - start <= MAX_MARKER_LENGTH:
+                self._emit_chunk(events, start)
+                return False
+            self._emit_chunk(events, start + 1)  # not a marker after all
+            return True
+        is_artifact = self.pending.startswith(ARTIFACT_START, start)
+        value = self.pending[start + len(ARTIFACT_START if is_artifact else TITLE_START):header_end].strip()
+        self._emit_chunk(events, header_end + 1)
+        if not is_artifact:
+            events.append(("title", value))
+            return True
+        self.name = value
+        self.hash = hashlib.sha256()
+        self.bytes = 0
+        self.body_started = False
+        self.newline_held = False
+        events.append(("artifact_start", {"name": value}))
+        return True
+
+    def _feed_body(self, events):
+        index = self.pending.find(ARTIFACT_END)
+        if index == -1:
+            keep = _partial_marker(self.pending, (ARTIFACT_END,))
+            self._emit_body(events, len(self.pending) - keep)
+            return False
+        self._emit_body(events, index)
+        events.append(("artifact_end", self._close()))
+        return True  # the end marker itself goes out with the next chunk
+
+    def _emit_chunk(self, events, length):
+        if length > 0:
+            events.append(("chunk", self.pending[:length]))
+            self.pending = self.pending[length:]
+
+    def _emit_body(self, events, length):
+        if length <= 0:
+            return
+        text, self.pending = self.pending[:length], self.pending[length:]
+        events.append(("artifact_delta", {"name": self.name, "text": text}))
+        # Hash the page as extract_artifacts() sees it: without one leading and one trailing newline
+        content = text
+        if not self.body_started:
+            self.body_started = True
+            if content.startswith("\n"):
+                content = content[1:]
+        if self.newline_held:
+            content = "\n" + content
+        self.newline_held = content.endswith("\n")
+        if self.newline_held:
+            content = content[:-1]
+        data = content.encode("utf-8")
+        self.hash.update(data)
+        self.bytes += len(data)
+
+    def _close(self):
+        info = {"name": self.name, "sha256": self.hash.hexdigest(), "bytes": self.bytes}
+        self.name = None
+        self.hash = None
+        return info
+
+    def finish(self):
+        """Flush held-back text; an artifact still open is reported as incomplete"""
+        events = []
+        if self.name is not None:
+            self._emit_body(events, len(self.pending))
+            info = {"name": self.name, "sha256": self.hash.hexdigest(), "bytes": self.bytes}
+            self.name = None
+            self.hash = None
+            events.append(("incomplete", info))
+        self._emit_chunk(events, len(self.pending))
+        return events
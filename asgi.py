@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI entry point: /api/message streamed natively on asyncio, every other route
+served by the Flask app.
+
+The gevent deployment holds one greenlet (or, under waitress, one of 16 threads)
+per open stream and talks to GLM through the synchronous zai SDK. Here a new
+generation is one coroutine reading GLM over httpx (glm_async.py): a worker can
+hold thousands of streams that mostly sit waiting on the model, each costing a
+few kilobytes plus the answer it is building, and local runs behave like
+production.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 4 --timeout-keep-alive 75
+    python asgi.py                      # local, http://127.0.0.1:5000
+
+Served natively: POST /api/message for new generations - queueing, response
+cache hits, edit-mode patches, continuations, thinking/artifact events,
+conversations, stream traces and /metrics timing, with the same events as the
+Flask handler. A client that disconnects cancels its generation at once.
+
+Handed to Flask (a2wsgi, on ASGI_WSGI_THREADS threads): every other route, and
+/api/message requests that need the stream store - resumes (Last-Event-ID),
+resumable streams (X-Fowazz-Resumable: 1) and parallel builds. Natively served
+requests don't take part in single flight. Each of those streams holds a thread
+until it ends, so at most ASGI_FLASK_STREAMS (default half the threads) run at
+once and the rest get SITE_FULL.
+
+Both paths build their events with the same functions from server.py
+(GLMRounds, response_events, closing_events). Admission backends may block on
+Redis or a file lock, so they're only called through asyncio.to_thread.
+"""
+import os
+
+os.environ["GEVENT_MONKEY_PATCH"] = "false"  # before server is imported - asyncio needs the real sockets
+
+import asyncio
+import json
+import time
+
+from a2wsgi import WSGIMiddleware
+
+import server
+from artifacts import PatchStreamRewriter
+from attachments import AttachmentError, expand_attachments
+from context_budget import compact_messages, estimate_messages_tokens, estimate_text_tokens
+from glm_pool import UpstreamUnavailable
+from sse import sse_event
+
+PING_INTERVAL = float(os.getenv("ASGI_PING_SECONDS", "15"))  # SSE comment on idle streams, for proxies
+STALE_FLUSH_INTERVAL = 0.5  # how often a stalled stream's coalesced text is checked, like streams.follow's poll
+WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "64"))
+# A /api/message handed to Flask holds one of those threads until its stream ends;
+# the rest stay free for the short routes
+FLASK_STREAM_LIMIT = int(os.getenv("ASGI_FLASK_STREAMS", str(max(WSGI_THREADS // 2, 1))))
+flask_app = WSGIMiddleware(server.app, workers=WSGI_THREADS)
+flask_streams = 0
+
+
+async def stream_glm_async(model, zai_messages, stats, keep_alive=None, thinking=True, thinking_interval=None,
+                           trace=None):
+    """server.stream_glm on the event loop: the same rounds (server.GLMRounds), events, stats and traces"""
+    rounds = server.GLMRounds(zai_messages, stats, thinking, thinking_interval)
+
+    while True:
+        round_messages, round_thinking = rounds.start_round()
+        trace_round = trace.round(stats["continuations"], round_thinking) if trace else None
+        try:
+            stream, upstream = await server.glm_pool.create_async(
+                model,
+                estimate_messages_tokens(round_messages),
+                messages=round_messages,
+                max_tokens=server.GLM_MAX_TOKENS,
+                temperature=server.GLM_TEMPERATURE,
+                stream=True,
+                thinking={"type": "enabled" if round_thinking else "disabled"}
+            )
+        except Exception as e:
+            if trace_round:
+                trace_round.failed(e)
+            raise
+        stats.setdefault("connected_at", time.monotonic())
+        if trace_round:
+            trace_round.connected()
+
+        error = None
+        try:
+            async for chunk in stream:
+                upstream.first_token()
+                if trace_round:
+                    delta = chunk.choices[0].delta
+                    trace_round.chunk(delta.reasoning_content, delta.content, chunk.choices[0].finish_reason)
+                if keep_alive:
+                    keep_alive()
+                for event in rounds.chunk(chunk):
+                    yield event
+        except Exception as e:
+            # (a cancelled task raises CancelledError, which isn't the key's fault and isn't caught here)
+            error = e
+            if trace_round:
+                trace_round.failed(e)
+            raise
+        finally:
+            await stream.aclose()
+            if error is not None:
+                upstream.fail(error, rounds.round_output_tokens())
+            else:
+                upstream.release(rounds.round_output_tokens())
+
+        for text in rounds.end_round():
+            yield text
+        if not rounds.next_round():
+            return
+
+
+async def generate(req, ticket, held, timing, received_at, stream_version):
+    """server.message()'s generate() as an async generator of SSE events; admission leases go into held"""
+    if ticket is not None:
+        async for position in server.active_connections.wait_async(ticket, req.max_wait):
+            yield sse_event({'queued': True, 'position': position, 'done': False})
+        if not ticket.lease:
+            print(f"🚫 Queue wait expired after {req.max_wait:g}s")
+            timing["outcome"] = "queue_timeout"
+            yield sse_event(server.site_full_payload(done=True))
+            return
+        held.append(ticket.lease)
+        print(f"✅ Connection acquired from queue ({await asyncio.to_thread(admission_summary)})")
+
+    timing["admission_wait"] = round(time.monotonic() - received_at, 3)
+    events = None
+    trace = None
+    full_content = ""
+    stream_stats = {}
+    cancelled = False
+    renewals = []
+    try:
+        history_budget = server.CONTEXT_TOKEN_BUDGET - server.SYSTEM_PROMPT_TOKENS - (server.EDIT_MODE_PROMPT_TOKENS if req.edit_mode else 0)
+        compacted, context_stats = await asyncio.to_thread(compact_messages, req.messages, history_budget, server.CONTEXT_KEEP_RECENT)
+        if context_stats["saved_tokens"]:
+            print(f"✂️ Context compacted to ~{context_stats['estimated_tokens']} tokens (saved ~{context_stats['saved_tokens']}, dropped {context_stats['dropped_messages']} messages)")
+        zai_messages = [{"role": "system", "content": req.system_prompt}] + \
+            await asyncio.to_thread(expand_attachments, server.attachment_store, compacted)
+        patcher = PatchStreamRewriter(req.artifacts) if req.edit_mode else None
+
+        last_renewal = time.monotonic()
+
+        def keep_alive():
+            # Renewing may wait on Redis or a file lock - off the event loop, in the background
+            nonlocal last_renewal
+            if time.monotonic() - last_renewal > server.LEASE_RENEW_INTERVAL:
+                last_renewal = time.monotonic()
+                renewals.append(asyncio.create_task(asyncio.to_thread(renew_leases, list(held))))
+                renewals[:] = [task for task in renewals if not task.done()]
+
+        if server.stream_recorder:
+            trace = server.stream_recorder.start("serial")
+        events = stream_glm_async(req.selected_model, zai_messages, stream_stats, keep_alive,
+                                  thinking_interval=server.THINKING_PROGRESS_INTERVAL if req.thinking_events else None,
+                                  trace=trace)
+
+        async for event in events:
+            kind, text = event if isinstance(event, tuple) else ("chunk", event)
+            out, text = server.response_events(req, patcher, kind, text)
+            full_content += text
+            if out:
+                yield "".join(out)  # one write, so a stale flush can't land between them
+
+        if server.concurrency_limiter and "first_token_at" in stream_stats:
+            server.observe_stream_speed(stream_stats, full_content)
+
+        out, text = server.closing_events(req, patcher, stream_stats)
+        full_content += text
+        if out:
+            yield "".join(out)
+
+        await asyncio.to_thread(server.remember_exchange, req, full_content, stream_stats["finish_reason"], context_stats)
+        yield await asyncio.to_thread(server.final_event, full_content, stream_version, context=context_stats,
+                                      continuations=stream_stats["continuations"])
+        timing["outcome"] = "completed"
+    except asyncio.CancelledError:
+        cancelled = True
+        timing["outcome"] = "cancelled"
+        raise
+    except Exception as e:
+        timing["outcome"] = "error"
+        flushed = req.framer.flush(finish=True)
+        if flushed:
+            yield "".join(flushed)
+        error = 'UPSTREAM_UNAVAILABLE' if isinstance(e, UpstreamUnavailable) else str(e)
+        yield sse_event({'error': error, 'done': True})
+    finally:
+        if events is not None:
+            await events.aclose()
+        for task in renewals:
+            task.cancel()
+        output_tokens = estimate_text_tokens(full_content) + stream_stats.get("reasoning_chars", 0) // 4
+        server.record_generation(output_tokens, aborted=cancelled)
+        timing.update(server.stream_timing(stream_stats, full_content), finish_reason=stream_stats.get("finish_reason"))
+        if trace:
+            await asyncio.to_thread(server.stream_recorder.write, trace, timing)
+
+
+def renew_leases(leases):
+    for lease in leases:
+        server.active_connections.renew(lease)
+
+
+def release_leases(leases):
+    for lease in leases:
+        server.active_connections.release(lease)
+    return admission_summary()
+
+
+def admission_summary():
+    """"n/max active" for the logs - the count may come from Redis, so it's read off the event loop"""
+    return f"{server.active_connections.get_count()}/{server.active_connections.max} active"
+
+
+def needs_flask(data, headers):
+    """Requests that rely on the stream store's producer threads"""
+    return bool(headers.get("last-event-id")) or headers.get(server.RESUMABLE_HEADER.lower()) == "1" or \
+        data.get("parallelBuild") is True
+
+
+def cors_headers(headers):
+    """What flask-cors would add to this response"""
+    origin = headers.get("origin")
+    if not origin or origin not in server.allowed_origins:
+        return []
+    return [(b"access-control-allow-origin", origin.encode("latin-1")),
+            (b"access-control-allow-credentials", b"true"), (b"vary", b"Origin")]
+
+
+async def send_json(send, status, payload, headers):
+    body = json.dumps(payload).encode("utf-8")
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())
+    ] + cors_headers(headers)})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def replay_body(body, receive):
+    """receive() for Flask that hands back the body we already read, then the live channel"""
+    sent = False
+
+    async def replayed():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+    return replayed
+
+
+async def flask_stream(scope, body, receive, send, headers):
+    """Hand a streaming /api/message to Flask, unless the streams' share of the WSGI threads is taken"""
+    global flask_streams
+    if flask_streams >= FLASK_STREAM_LIMIT:
+        print(f"🚫 All {FLASK_STREAM_LIMIT} Flask stream threads busy")
+        return await send_json(send, 503, server.site_full_payload(), headers)
+    flask_streams += 1
+    try:
+        return await flask_app(scope, replay_body(body, receive), send)
+    finally:
+        flask_streams -= 1
+
+
+async def message(scope, receive, send):
+    received_at = time.monotonic()
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+    body = await read_body(receive)
+    if body is None:
+        return
+    if not server.glm_pool.upstreams:
+        return await send_json(send, 500, {
+            "error": "Server missing GLM_API_KEY. Set it in .env and restart the server."
+        }, headers)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return await flask_app(scope, replay_body(body, receive), send)
+    if needs_flask(data, headers):
+        return await flask_stream(scope, body, receive, send, headers)
+
+    try:
+        req = await asyncio.to_thread(server.MessageRequest, data, headers.get("authorization"))
+    except server.BadMessageRequest as e:
+        return await send_json(send, e.status, e.payload, headers)
+    except AttachmentError as e:
+        return await send_json(send, 400, {"error": str(e)}, headers)
+    stream_version = 2 if headers.get(server.STREAM_VERSION_HEADER.lower()) == "2" else 1
+    active_connections = server.active_connections  # backed by Redis or a file lock - only used off the event loop
+
+    ticket = None
+    held = []
+    cached = await asyncio.to_thread(server.response_cache.get, req.cache_key) if req.cache_key else None
+    if cached is not None:
+        print(f"⚡ Response cache hit {req.cache_key[:12]}")
+        events = None
+    else:
+        lease = await asyncio.to_thread(active_connections.try_acquire)
+        if lease:
+            held.append(lease)
+            print(f"✅ Connection acquired ({await asyncio.to_thread(admission_summary)})")
+        else:
+            plan = await asyncio.to_thread(server.get_user_plan, headers.get("authorization"))
+            ticket = active_connections.enqueue(server.PLAN_PRIORITY.get(plan, 2))
+            if ticket is None:
+                current_users = await asyncio.to_thread(active_connections.get_count)
+                print(f"🚫 Site at capacity! {current_users}/{active_connections.max} connections, {active_connections.get_waiting()} waiting")
+                return await send_json(send, 503, server.site_full_payload(
+                    current_users=current_users, max_users=active_connections.max
+                ), headers)
+            print(f"⏳ Site at capacity, request queued (priority {ticket.priority}, {active_connections.get_waiting()} waiting)")
+
+    print(f"📊 Using model: {req.selected_model} (with thinking mode, asyncio)")
+    timing = {"outcome": None, "model": req.selected_model, "admission_wait": None, "finish_reason": None, "bytes": 0}
+    task = asyncio.current_task()
+    disconnected = False
+    done = False  # the last body message is being sent - a disconnect now is just the end
+    last_sent = time.monotonic()
+    send_lock = asyncio.Lock()
+
+    async def write(data):
+        nonlocal last_sent
+        async with send_lock:
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+            last_sent = time.monotonic()
+
+    async def watch_disconnect():
+        nonlocal disconnected
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        if not done:
+            disconnected = True
+            task.cancel()  # stops the upstream read wherever it is - GLM stops generating for nobody
+
+    async def ping():
+        while True:
+            await asyncio.sleep(max(1.0, PING_INTERVAL - (time.monotonic() - last_sent)))
+            if not done and time.monotonic() - last_sent >= PING_INTERVAL:
+                await write(b": ping\n\n")
+
+    async def flush_stale():
+        # GLM went quiet mid-response: don't sit on deltas until the next one arrives
+        while True:
+            await asyncio.sleep(STALE_FLUSH_INTERVAL)
+            stale = req.framer.flush_stale()
+            if stale:
+                # One write for the batch: events from the generator can't slip in between
+                data = "".join(stale).encode("utf-8")
+                timing["bytes"] += len(data)
+                await write(data)
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"),
+        (server.STREAM_VERSION_HEADER.lower().encode(), str(stream_version).encode())
+    ] + cors_headers(headers)})
+    helpers = [asyncio.create_task(watch_disconnect()), asyncio.create_task(ping())]
+    if cached is not None:
+        events = iter(await asyncio.to_thread(list, server.cached_response_events(cached, req, stream_version)))
+    else:
+        events = generate(req, ticket, held, timing, received_at, stream_version)
+        helpers.append(asyncio.create_task(flush_stale()))
+    try:
+        if cached is not None:
+            for event in events:
+                await write(event.encode("utf-8"))
+        else:
+            async for event in events:
+                data = event.encode("utf-8")
+                timing["bytes"] += len(data)
+                await write(data)
+        done = True
+        async with send_lock:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+    except asyncio.CancelledError:
+        if not disconnected:
+            raise
+        print("🔌 Client disconnected, cancelling generation")
+    finally:
+        for helper in helpers:
+            helper.cancel()
+        if cached is None:
+            await events.aclose()
+            if ticket is not None and ticket.lease and ticket.lease not in held:
+                held.append(ticket.lease)
+            # Shielded: a second cancellation mustn't leave the leases held until they expire
+            summary = await asyncio.shield(asyncio.to_thread(release_leases, held))
+            print(f"🔓 Connection released ({summary})")
+            if timing["outcome"] is None and ticket is not None and not ticket.lease:
+                timing["outcome"] = "left_queue"
+            timing["outcome"] = timing["outcome"] or "interrupted"
+            timing["duration"] = round(time.monotonic() - received_at, 3)
+            server.record_stream_timing(timing)
+
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            for upstream in server.glm_pool.upstreams:
+                if upstream.async_client:
+                    await upstream.async_client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http" and scope["path"] == "/api/message" and scope["method"] == "POST":
+        return await message(scope, receive, send)
+    return await flask_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    print("\n🚀 Starting Fowazz (asyncio streaming) on http://127.0.0.1:5000")
+    uvicorn.run(app, host="127.0.0.1", port=5000, timeout_keep_alive=75)
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed storage for images and PDFs sent to Fowazz.
+
+Each attachment is hashed (sha256) once on upload and stored under its digest,
+so the same file sent in several turns - or by several users - is kept once.
+Messages then refer to it instead of carrying the base64 inline:
+
+    {"type": "image", "source": {"type": "attachment", "digest": "<sha256>"}}
+
+and the server expands the reference back into a base64 block only when it
+builds the upstream GLM call.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+ATTACHMENT_BLOCK_TYPES = ("image", "document")
+
+# What can be stored, by magic bytes - the type the uploader claims is never trusted,
+# so nothing stored can be served back as HTML/SVG/script from the API origin
+MEDIA_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+)
+ALLOWED_MEDIA_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp", "application/pdf")
+MEDIA_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/gif": "gif", "image/webp": "webp",
+                    "application/pdf": "pdf"}
+
+
+def sniff_media_type(data):
+    """Media type of a PNG/JPEG/GIF/WebP image or PDF from its first bytes, None for anything else"""
+    for signature, media_type in MEDIA_SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class AttachmentError(Exception):
+    pass
+
+
+class AttachmentQuotaError(AttachmentError):
+    pass
+
+
+class LocalDiskAttachmentStore:
+    """
+    Files live at <root>/<first 2 hex chars>/<digest>; an SQLite index next to them
+    (shared by the workers on a host) keeps each file's type, size, last use and
+    who uploaded it. Uploads count against the uploader's quota for as long as the
+    file is kept. Files unused for ttl_seconds are removed, and the least recently
+    used go first once the store is over max_total_bytes.
+    """
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS attachments (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    media_type TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attachments_last_used ON attachments (last_used);
+CREATE TABLE IF NOT EXISTS attachment_owners (
+    digest TEXT NOT NULL REFERENCES attachments(digest) ON DELETE CASCADE,
+    owner TEXT NOT NULL,
+    PRIMARY KEY (digest, owner)
+);
+CREATE INDEX IF NOT EXISTS attachment_owners_owner ON attachment_owners (owner);
+"""
+    TOUCH_INTERVAL = 60  # seconds between last_used updates of the same file
+
+    def __init__(self, root, max_bytes=20 * 1024 * 1024, user_quota_bytes=100 * 1024 * 1024,
+                 max_total_bytes=2 * 1024 * 1024 * 1024, ttl_seconds=30 * 86400, cleanup_interval=600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.max_total_bytes = max_total_bytes
+        self.ttl_seconds = ttl_seconds
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = 0
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(root, "index.db"), timeout=10, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(self.SCHEMA)
+
+    def _path(self, digest):
+        if not DIGEST_RE.match(digest or ""):
+            raise AttachmentError(f"Invalid attachment digest: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _write_atomic(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def put(self, data, media_type=None, owner=None):
+        """
+        Store bytes and return their digest (no-op if we already have them). The
+        type comes from the bytes themselves; media_type is only the uploader's claim.
+        """
+        if len(data) > self.max_bytes:
+            raise AttachmentError(f"Attachment too large ({len(data)} bytes, max {self.max_bytes})")
+        detected = sniff_media_type(data)
+        if detected is None:
+            raise AttachmentError(
+                f"Unsupported attachment type {media_type or 'unknown'} (allowed: {', '.join(ALLOWED_MEDIA_TYPES)})"
+            )
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if owner is not None:
+                    used = self.db.execute(
+                        "SELECT COALESCE(SUM(a.size), 0), COALESCE(MAX(a.digest = ?), 0) FROM attachments a "
+                        "JOIN attachment_owners o ON o.digest = a.digest WHERE o.owner = ?", (digest, owner)
+                    ).fetchone()
+                    if not used[1] and used[0] + len(data) > self.user_quota_bytes:
+                        raise AttachmentQuotaError(
+                            f"Attachment quota exceeded ({used[0]} of {self.user_quota_bytes} bytes used)"
+                        )
+                if not os.path.exists(path):
+                    self._write_atomic(path, data)
+                self.db.execute(
+                    "INSERT INTO attachments (digest, size, media_type, created, last_used) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(digest) DO UPDATE SET last_used = excluded.last_used",
+                    (digest, len(data), detected, now, now)
+                )
+                if owner is not None:
+                    self.db.execute("INSERT OR IGNORE INTO attachment_owners (digest, owner) VALUES (?, ?)",
+                                    (digest, owner))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self._evict(now, keep=digest)
+        return digest
+
+    def _evict(self, now, keep=None):
+        # Expired files at most once per interval; over-budget files whenever a put pushes past it
+        expired = []
+        if now - self.last_cleanup >= self.cleanup_interval:
+            self.last_cleanup = now
+            expired = [row[0] for row in self.db.execute(
+                "SELECT digest FROM attachments WHERE last_used < ?", (now - self.ttl_seconds,)) if row[0] != keep]
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM attachments").fetchone()[0]
+        if total > self.max_total_bytes:
+            for digest, size in self.db.execute("SELECT digest, size FROM attachments ORDER BY last_used"):
+                if total <= self.max_total_bytes:
+                    break
+                if digest != keep and digest not in expired:
+                    expired.append(digest)
+                    total -= size
+        for digest in expired:
+            self.db.execute("DELETE FROM attachments WHERE digest = ?", (digest,))
+            for path in (self._path(digest), self._path(digest) + ".type"):  # .type: written by older versions
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        if expired:
+            print(f"🧹 Removed {len(expired)} attachment(s)")
+
+    def _row(self, digest, path):
+        """(media_type, last_used) for a stored file, indexing files from before the index"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT media_type, last_used FROM attachments WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                try:
+                    with open(path, "rb") as f:
+                        head = f.read(16)
+                    size = os.path.getsize(path)
+                except OSError:
+                    return None
+                row = (sniff_media_type(head) or "application/octet-stream", now)
+                self.db.execute("INSERT OR IGNORE INTO attachments (digest, size, media_type, created, last_used) "
+                                "VALUES (?, ?, ?, ?, ?)", (digest, size, row[0], now, now))
+            elif now - row[1] > self.TOUCH_INTERVAL:
+                self.db.execute("UPDATE attachments SET last_used = ? WHERE digest = ?", (now, digest))
+        return row
+
+    def exists(self, digest):
+        try:
+            path = self._path(digest)
+        except AttachmentError:
+            return False
+        return os.path.exists(path) and self._row(digest, path) is not None
+
+    def get(self, digest):
+        """Return (bytes, media_type), or None if the digest is unknown"""
+        path = self._path(digest)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        row = self._row(digest, path)
+        return data, row[0] if row else "application/octet-stream"
+
+
+def _is_attachment_block(block):
+    return (
+        isinstance(block, dict) and block.get("type") in ATTACHMENT_BLOCK_TYPES
+        and isinstance(block.get("source"), dict)
+    )
+
+
+def _attachment_blocks(message):
+    content = message.get("content") if isinstance(message, dict) else None
+    if not isinstance(content, list):
+        return []
+    return [block for block in content if _is_attachment_block(block)]
+
+
+def missing_attachments(store, messages):
+    """Digests referenced by messages that the store doesn't have"""
+    missing = []
+    for message in messages:
+        for block in _attachment_blocks(message):
+            source = block["source"]
+            if source.get("type") == "attachment" and not store.exists(source.get("digest")):
+                missing.append(source.get("digest"))
+    return missing
+
+
+def has_inline_attachments(message):
+    """Whether a message carries base64 blocks that intern_attachments() would store"""
+    return any(block["source"].get("type") == "base64" for block in _attachment_blocks(message))
+
+
+def intern_attachments(store, message, owner):
+    """
+    Move inline base64 blocks of a message into the store, returning a copy with
+    references. The files count against owner's quota, like an upload.
+    """
+    if not _attachment_blocks(message):
+        return message
+
+    content = []
+    for block in message["content"]:
+        if _is_attachment_block(block) and block["source"].get("type") == "base64":
+            source = block["source"]
+            try:
+                data = base64.b64decode(source.get("data", ""), validate=True)
+            except (binascii.Error, ValueError):
+                content.append(block)  # leave anything we can't decode untouched
+                continue
+            media_type = sniff_media_type(data)
+            if media_type is None:
+                content.append(block)  # only images/PDFs are stored
+                continue
+            digest = store.put(data, media_type, owner=owner)
+            block = dict(block, source={"type": "attachment", "digest": digest, "media_type": media_type})
+        content.append(block)
+    return dict(message, content=content)
+
+
+def expand_attachments(store, messages):
+    """
+    Copy of messages with attachment references replaced by inline base64 blocks.
+    A file that has since been evicted becomes a short text note, so an old turn
+    can't fail the whole conversation.
+    """
+    expanded = []
+    for message in messages:
+        if not any(block["source"].get("type") == "attachment" for block in _attachment_blocks(message)):
+            expanded.append(message)
+            continue
+
+        content = []
+        for block in message["content"]:
+            if _is_attachment_block(block) and block["source"].get("type") == "attachment":
+                source = block["source"]
+                stored = store.get(source.get("digest"))
+                if stored is None:
+                    content.append({"type": "text", "text": f"[{block['type']} attached earlier - no longer available]"})
+                    continue
+                data, media_type = stored
+                block = dict(block, source={
+                    "type": "base64",
+                    "media_type": source.get("media_type") or media_type,
+                    "data": base64.b64encode(data).decode("ascii"),
+                })
+            content.append(block)
+        expanded.append(dict(message, content=content))
+    return expanded
+
+
+def create_attachment_store():
+    """Build the attachment store selected by ATTACHMENT_STORE (only 'disk' for now)"""
+    backend = os.getenv("ATTACHMENT_STORE", "disk").lower()
+    if backend != "disk":
+        print(f"⚠️ Unknown ATTACHMENT_STORE '{backend}', using local disk")
+    return LocalDiskAttachmentStore(
+        os.getenv("ATTACHMENT_DIR", "/tmp/fowazz-attachments"),
+        max_bytes=int(os.getenv("ATTACHMENT_MAX_BYTES", str(20 * 1024 * 1024))),
+        user_quota_bytes=int(os.getenv("ATTACHMENT_USER_QUOTA_BYTES", str(100 * 1024 * 1024))),
+        max_total_bytes=int(os.getenv("ATTACHMENT_MAX_TOTAL_BYTES", str(2 * 1024 * 1024 * 1024))),
+        ttl_seconds=float(os.getenv("ATTACHMENT_TTL_SECONDS", str(30 * 86400))),
+    )
@@ -0,0 +1,178 @@
+"""
+Benchmark the asyncio streaming path (asgi.py) against gevent (server.py)
+
+Starts mock_glm.py and, one after the other, a single gunicorn gevent worker and
+a single uvicorn worker serving asgi.py, each with room for every stream. Opens
+--streams concurrent /api/message streams against each, all at once, and
+reports time to first chunk and total time (p50/p95), failures, and the worker's
+peak RSS and CPU. The mock's long TTFT and slow token rate make the streams
+idle-heavy, like real builds spent mostly waiting on the model.
+
+    python bench_asgi.py --streams 1000
+    python bench_asgi.py --streams 3000 --ttft 20 --tokens-per-sec 20 --servers asgi
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import httpx
+
+from load_test import ServerSampler, percentile
+
+SERVERS = {
+    "gevent": ["gunicorn", "--worker-class", "gevent", "--workers", "1", "--worker-connections", "{connections}",
+               "--timeout", "600", "--bind", "127.0.0.1:{port}", "server:app"],
+    "asgi": ["uvicorn", "asgi:app", "--workers", "1", "--host", "127.0.0.1", "--port", "{port}",
+             "--limit-concurrency", "{connections}", "--backlog", "{connections}", "--timeout-keep-alive", "75"],
+}
+
+
+async def stream_once(client, url, n):
+    body = {"messages": [{"role": "user", "content": f"Build me a website for my bakery (benchmark stream {n})"}]}
+    result = {"ttft": None, "total": None, "error": None}
+    started = time.monotonic()
+    try:
+        async with client.stream("POST", f"{url}/api/message", json=body,
+                                 headers={"X-Fowazz-Stream-Version": "2"}) as response:
+            if response.status_code != 200:
+                result["error"] = f"http_{response.status_code}"
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if result["ttft"] is None and event.get("chunk"):
+                    result["ttft"] = time.monotonic() - started
+                if event.get("error"):
+                    result["error"] = event["error"]
+                    return result
+                if event.get("done"):
+                    result["total"] = time.monotonic() - started
+                    return result
+        result["error"] = "incomplete"
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    return result
+
+
+async def run_streams(url, streams, timeout):
+    limits = httpx.Limits(max_connections=streams, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout, connect=60)) as client:
+        return await asyncio.gather(*[stream_once(client, url, n) for n in range(streams)])
+
+
+def wait_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            if httpx.get(f"{url}/metrics", timeout=2).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def bench(name, args, env):
+    port = args.port + (1 if name == "asgi" else 0)
+    url = f"http://127.0.0.1:{port}"
+    command = [part.format(port=port, connections=args.streams + 100) for part in SERVERS[name]]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        if not wait_ready(url, process):
+            return {"server": name, "error": "did not start"}
+        sampler = ServerSampler(process.pid)
+        sampler.sample()
+        stop = asyncio.Event()
+
+        async def sample():
+            while not stop.is_set():
+                await asyncio.sleep(0.5)
+                sampler.sample()
+
+        async def main():
+            sampling = asyncio.create_task(sample())
+            try:
+                return await run_streams(url, args.streams, args.request_timeout)
+            finally:
+                stop.set()
+                await sampling
+
+        started = time.monotonic()
+        results = asyncio.run(main())
+        elapsed = time.monotonic() - started
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    ttfts = [r["ttft"] for r in results if r["ttft"] is not None]
+    totals = [r["total"] for r in results if r["total"] is not None]
+    errors = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return dict(server=name, completed=len(totals), elapsed=round(elapsed, 1), errors=errors,
+                ttft_p50=percentile(ttfts, 50), ttft_p95=percentile(ttfts, 95),
+                total_p50=percentile(totals, 50), total_p95=percentile(totals, 95), **(sampler.summary() or {}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--streams", type=int, default=1000, help="concurrent streams per server")
+    parser.add_argument("--servers", nargs="+", choices=list(SERVERS), default=list(SERVERS))
+    parser.add_argument("--ttft", type=float, default=10.0, help="mock time to first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=40, help="mock tokens/sec per stream")
+    parser.add_argument("--content-chars", type=int, default=2000, help="mock response length")
+    parser.add_argument("--port", type=int, default=8180, help="servers use this port and the next, the mock +10")
+    parser.add_argument("--request-timeout", type=float, default=600)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    # Every stream is a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.streams * 4 + 1024)), hard))
+
+    mock_port = args.port + 10
+    mock = subprocess.Popen([sys.executable, "mock_glm.py", "--port", str(mock_port), "--ttft", str(args.ttft),
+                             "--tokens-per-sec", str(args.tokens_per_sec), "--tokens-per-chunk", "2",
+                             "--content-chars", str(args.content_chars), "--reasoning-chars", "0"],
+                            stdout=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, GLM_API_KEY="mock", GLM_BASE_URLS=f"http://127.0.0.1:{mock_port}/api/paas/v4",
+               MAX_CONCURRENT_USERS=str(args.streams + 100), ADMISSION_BACKEND="local", ADAPTIVE_CONCURRENCY="false",
+               STREAM_STORE="memory", SINGLE_FLIGHT_ENABLED="false", GLM_TTFT_SLO_SECONDS="3600",
+               METRICS_DIR=f"/tmp/fowazz-bench-metrics-{os.getpid()}")
+    env.pop("STREAM_TRACE_DIR", None)
+
+    results = []
+    try:
+        time.sleep(1)
+        for name in args.servers:
+            print(f"🏁 {name}: {args.streams} concurrent streams...")
+            results.append(bench(name, args, env))
+    finally:
+        mock.terminate()
+
+    columns = ["completed", "elapsed", "ttft_p50", "ttft_p95", "total_p50", "total_p95", "cpu_avg_percent", "rss_peak_mb"]
+    print(f"\n{'server':<8}" + "".join(f"{column:>16}" for column in columns) + "  errors")
+    for result in results:
+        cells = "".join(
+            f"{result.get(column):>16.2f}" if isinstance(result.get(column), float) else f"{str(result.get(column, '-')):>16}"
+            for column in columns
+        )
+        print(f"{result['server']:<8}{cells}  {result.get('errors') or result.get('error') or ''}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
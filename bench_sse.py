@@ -0,0 +1,82 @@
+"""
+Benchmark SSE framing policies for /api/message
+
+Replays a synthetic GLM response (thousands of 1-12 character deltas arriving at
+a steady token rate) through the same framing code generate() uses, once per
+flush policy, and reports frames per stream, SSE events/sec per client and
+framing CPU per stream. Socket writes and greenlet switches scale with frames.
+
+    python bench_sse.py                      # default policies
+    python bench_sse.py --chars 60000 --tokens-per-sec 120 --streams 50
+"""
+import argparse
+import random
+import time
+
+from sse import ChunkCoalescer, chunk_event
+
+POLICIES = [
+    ("per-delta (old)", 0, 0),
+    ("256 B / 30 ms", 256, 30),
+    ("512 B / 30 ms", 512, 30),
+    ("2 KB / 100 ms", 2048, 100),
+]
+
+
+def make_deltas(total_chars, seed=1):
+    """Deltas shaped like GLM output: mostly 1-5 chars, sometimes a longer run"""
+    rng = random.Random(seed)
+    html = "<div class=\"card\"><h2>Our Menu</h2><p>Fresh coffee roasted daily.</p></div>\n"
+    deltas, size = [], 0
+    while size < total_chars:
+        n = rng.choice([1, 2, 3, 3, 4, 4, 5, 8, 12])
+        start = size % len(html)
+        piece = (html * 2)[start:start + n]
+        deltas.append(piece)
+        size += len(piece)
+    return deltas
+
+
+def run_stream(deltas, max_bytes, max_ms, delta_interval):
+    """Frame one response; the clock advances delta_interval per delta instead of sleeping"""
+    now = [0.0]
+    coalescer = ChunkCoalescer(max_bytes, max_ms / 1000, clock=lambda: now[0])
+    wire_bytes = 0
+    for text in deltas:
+        now[0] += delta_interval
+        merged = coalescer.add(text)
+        if merged:
+            wire_bytes += len(chunk_event(merged))
+    pending = coalescer.flush()
+    if pending:
+        wire_bytes += len(chunk_event(pending))
+    return coalescer.frames, wire_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chars", type=int, default=30000, help="characters per response")
+    parser.add_argument("--tokens-per-sec", type=float, default=80, help="simulated upstream delta rate")
+    parser.add_argument("--streams", type=int, default=20, help="responses per policy")
+    args = parser.parse_args()
+
+    deltas = make_deltas(args.chars)
+    delta_interval = 1 / args.tokens_per_sec
+    print(f"{len(deltas)} deltas per response, {args.chars} chars, {args.streams} streams per policy\n")
+    stream_seconds = len(deltas) * delta_interval
+    print(f"{'policy':<18}{'frames':>8}{'wire KB':>10}{'events/sec':>12}{'CPU ms/stream':>16}{'deltas/CPU-sec':>16}")
+
+    for name, max_bytes, max_ms in POLICIES:
+        cpu_start = time.process_time()
+        for _ in range(args.streams):
+            frames, wire_bytes = run_stream(deltas, max_bytes, max_ms, delta_interval)
+        cpu = (time.process_time() - cpu_start) / args.streams
+        # events/sec: SSE events each client receives per second at the simulated token rate
+        print(
+            f"{name:<18}{frames:>8}{wire_bytes / 1024:>10.1f}{frames / stream_seconds:>12.1f}"
+            f"{cpu * 1000:>16.2f}{len(deltas) / cpu if cpu else 0:>16,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark the /api/message off-topic filter
+
+Runs the old inline check (keyword lists rebuilt per request, the whole message
+lowercased, one substring scan per keyword) and topic_filter.py (precompiled
+Aho-Corasick automaton over a capped slice of the message) on messages of
+increasing size, and reports microseconds per message for each.
+
+    python bench_topic_filter.py
+    python bench_topic_filter.py --sizes 200 5000 1000000 --repeat 50
+"""
+import argparse
+import time
+
+from topic_filter import OFF_TOPIC_KEYWORDS, WEBSITE_KEYWORDS, create_topic_filter
+
+# The keyword lists as they were inlined in message() (English only)
+OLD_OFF_TOPIC = OFF_TOPIC_KEYWORDS[:OFF_TOPIC_KEYWORDS.index("واجب منزلي")]
+OLD_WEBSITE = WEBSITE_KEYWORDS[:WEBSITE_KEYWORDS.index("موقع")]
+
+FILLER = {
+    "en": "The quarterly report covers revenue, churn and hiring across all regions. ",
+    "ar": "يغطي التقرير الفصلي الإيرادات ومعدل الإلغاء والتوظيف في جميع المناطق. ",
+}
+MESSAGES = [
+    ("en, website", "en", "Please make the hero section on my bakery website warmer. "),
+    ("en, off-topic", "en", "Can you do my homework and write my essay about the war? "),
+    ("ar, website", "ar", "[LANGUAGE: ar]\n\nأريد تغيير خلفية الصفحة الرئيسية لموقعي. "),
+    ("ar, off-topic", "ar", "[LANGUAGE: ar]\n\nساعدني في حل الواجب المنزلي. "),
+]
+
+
+def old_is_off_topic(message):
+    """The check exactly as message() used to run it"""
+    text = message.lower()
+    off_topic_keywords = list(OLD_OFF_TOPIC)
+    is_off_topic = any(keyword in text for keyword in off_topic_keywords)
+    website_keywords = list(OLD_WEBSITE)
+    has_website_context = any(keyword in text for keyword in website_keywords)
+    return is_off_topic and not has_website_context
+
+
+def make_message(request_text, language, size):
+    """The request followed by a pasted document, size characters in all"""
+    filler = FILLER[language] * (size // len(FILLER[language]) + 1)
+    return (request_text + filler)[:max(size, len(request_text))]
+
+
+def timed(check, message, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = check(message)
+    return (time.perf_counter() - start) / repeat * 1e6, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 5000, 100000, 1000000],
+                        help="message sizes in characters")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per message")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    topic_filter = create_topic_filter()
+    print(f"automaton: {len(topic_filter.classifier.automaton.transitions)} states, "
+          f"built in {(time.perf_counter() - start) * 1000:.1f} ms, scan cap {topic_filter.max_chars} chars\n")
+    print(f"{'message':<16}{'chars':>10}{'old us':>12}{'new us':>12}{'speedup':>10}  {'old':<8}{'new':<8}")
+
+    for name, language, request_text in MESSAGES:
+        for size in args.sizes:
+            message = make_message(request_text, language, size)
+            old_us, old_result = timed(old_is_off_topic, message, args.repeat)
+            new_us, new_result = timed(topic_filter.is_off_topic, message, args.repeat)
+            print(
+                f"{name:<16}{len(message):>10,}{old_us:>12,.1f}{new_us:>12,.1f}{old_us / new_us:>9.1f}x"
+                f"  {'block' if old_result else 'allow':<8}{'block' if new_result else 'allow':<8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
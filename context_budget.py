@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Token budgeting for the history we forward to GLM.
+
+Token counts are estimated with a cheap heuristic (no tokenizer download, a
+few microseconds per message): ~4 chars per token for ASCII text and ~2 per
+token for Arabic and other non-ASCII text. Attachments count as a flat cost.
+
+compact_messages() shrinks a history in three steps, stopping as soon as it
+fits the budget (step 1 always runs - old page versions are pure waste):
+
+    1. replace every [ARTIFACT:START:file] block that a later message rewrote
+    2. drop images/PDFs from all but the latest message that has them
+    3. drop the oldest turns, carrying their still-current pages forward
+"""
+import re
+
+ARTIFACT_RE = re.compile(r"\[ARTIFACT:START:(.+?)\]([\s\S]*?)\[ARTIFACT:END\]")
+ATTACHMENT_TOKENS = {"image": 1000, "document": 3000}
+MESSAGE_OVERHEAD_TOKENS = 4
+NOTE_TOKENS = 30  # the "[N earlier messages omitted]" header
+
+
+def estimate_text_tokens(text):
+    if not text:
+        return 0
+    # Non-ASCII characters take 2-4 UTF-8 bytes, so the byte surplus approximates their count
+    non_ascii = len(text.encode("utf-8", "ignore")) - len(text)
+    return (len(text) + non_ascii) // 4 + 1
+
+
+def estimate_message_tokens(message):
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return estimate_text_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for block in content or []:
+        if not isinstance(block, dict):
+            continue
+        if block.get("type") == "text":
+            tokens += estimate_text_tokens(block.get("text", ""))
+        else:
+            tokens += ATTACHMENT_TOKENS.get(block.get("type"), 500)
+    return tokens
+
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def _has_attachments(message):
+    content = message.get("content")
+    return isinstance(content, list) and any(
+        isinstance(block, dict) and block.get("type") in ATTACHMENT_TOKENS for block in content
+    )
+
+
+def _drop_superseded_artifacts(messages):
+    """Keep only the newest copy of each artifact file"""
+    seen = set()
+    compacted = []
+    for message in reversed(messages):
+        content = message.get("content")
+        if message.get("role") == "assistant" and isinstance(content, str) and "[ARTIFACT:START:" in content:
+            names_here = []
+
+            def replace(match):
+                name = match.group(1).strip()
+                names_here.append(name)
+                if name in seen:
+                    return f"[earlier version of {name} omitted - the latest version appears later in the conversation]"
+                return match.group(0)
+
+            new_content = ARTIFACT_RE.sub(replace, content)
+            seen.update(names_here)
+            if new_content != content:
+                message = dict(message, content=new_content)
+        compacted.append(message)
+    compacted.reverse()
+    return compacted
+
+
+def _drop_old_attachments(messages):
+    """Replace files in older messages with a short note; the latest files stay"""
+    latest = max((i for i, message in enumerate(messages) if _has_attachments(message)), default=None)
+    compacted = []
+    for i, message in enumerate(messages):
+        if i != latest and _has_attachments(message):
+            content = []
+            for block in message["content"]:
+                if isinstance(block, dict) and block.get("type") in ATTACHMENT_TOKENS:
+                    block = {"type": "text", "text": f"[{block['type']} attached earlier - no longer included]"}
+                content.append(block)
+            message = dict(message, content=content)
+        compacted.append(message)
+    return compacted
+
+
+def _trim_oldest(messages, budget, keep_recent):
+    """Drop the oldest turns, keeping the newest copy of every page they contained"""
+    tokens = [estimate_message_tokens(message) for message in messages]
+    total = sum(tokens)
+    carried = {}  # artifact name -> full artifact block, still the current version
+    carried_tokens = 0
+    start = 0
+    while len(messages) - start > keep_recent and total + carried_tokens + (NOTE_TOKENS if start else 0) > budget:
+        message = messages[start]
+        total -= tokens[start]
+        start += 1
+        content = message.get("content")
+        if message.get("role") == "assistant" and isinstance(content, str):
+            for match in ARTIFACT_RE.finditer(content):
+                name = match.group(1).strip()
+                carried_tokens -= estimate_text_tokens(carried.get(name, ""))
+                carried[name] = match.group(0)
+                carried_tokens += estimate_text_tokens(match.group(0))
+
+    carried_message = _carried_artifacts_message(carried, start)
+    return ([carried_message] if carried_message else []) + messages[start:], start
+
+
+def _carried_artifacts_message(carried, dropped):
+    if not dropped:
+        return None
+    text = f"[{dropped} earlier messages omitted to fit the context window]"
+    if carried:
+        text += "\n\nCurrent versions of the site files from those messages:\n\n" + "\n\n".join(carried.values())
+    return {"role": "assistant", "content": text}
+
+
+def compact_messages(messages, budget, keep_recent=6):
+    """
+    Shrink a history to fit `budget` estimated tokens.
+    Returns (messages, stats) where stats has estimated_tokens, saved_tokens and dropped_messages.
+    """
+    before = estimate_messages_tokens(messages)
+    compacted = _drop_superseded_artifacts(messages)
+    dropped = 0
+
+    if estimate_messages_tokens(compacted) > budget:
+        compacted = _drop_old_attachments(compacted)
+    if estimate_messages_tokens(compacted) > budget:
+        compacted, dropped = _trim_oldest(compacted, budget, keep_recent)
+
+    after = estimate_messages_tokens(compacted)
+    return compacted, {
+        "estimated_tokens": after,
+        "saved_tokens": max(0, before - after),
+        "dropped_messages": dropped,
+    }
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side conversation history.
+
+Clients create a conversation once, then send only the new user turn plus the
+conversation id to /api/message. The server keeps the full history, so long
+build sessions don't re-upload (and re-parse) every previous turn.
+
+Conversations are private to whoever created them: create() takes the hash of
+an owner token that is handed to the client once, and reads, deletes and new
+turns must present the token (see owned()). Knowing an id alone is not enough.
+
+Each conversation also keeps an artifact registry: the latest content of every
+page built so far, used to apply edit-mode patches (see artifacts.py).
+
+Backends:
+    sqlite - one database file shared by every gunicorn worker on a host (default)
+    redis  - one list per conversation on a Redis server, shared across nodes
+    memory - per-process dict, only useful for local dev with a single worker
+"""
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from admission import redis_client_from_env
+
+
+def new_conversation_id():
+    return os.urandom(16).hex()
+
+
+def new_owner_token():
+    return os.urandom(24).hex()
+
+
+def owner_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def owned(store, conversation_id, token):
+    """True if token is the owner token the conversation was created with"""
+    if not isinstance(token, str) or not token:
+        return False
+    owner = store.owner(conversation_id)
+    # Conversations created before owner tokens have none and can't be opened
+    return bool(owner) and hmac.compare_digest(owner, owner_hash(token))
+
+
+class MemoryConversationStore:
+    def __init__(self, ttl_seconds=7 * 24 * 3600):
+        self.ttl_seconds = ttl_seconds
+        self.conversations = {}  # id -> {"messages": [...], "updated": ts}
+        self.lock = threading.Lock()
+
+    def create(self, messages=None, owner=None):
+        conversation_id = new_conversation_id()
+        with self.lock:
+            self.conversations[conversation_id] = {
+                "messages": list(messages or []), "artifacts": {}, "owner": owner, "updated": time.time()
+            }
+        return conversation_id
+
+    def owner(self, conversation_id):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None or conversation["updated"] + self.ttl_seconds < time.time():
+                return None
+            return conversation["owner"]
+
+    def exists(self, conversation_id):
+        return self.get(conversation_id) is not None
+
+    def get(self, conversation_id):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                return None
+            if conversation["updated"] + self.ttl_seconds < time.time():
+                del self.conversations[conversation_id]
+                return None
+            return list(conversation["messages"])
+
+    def append(self, conversation_id, *messages):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                return False
+            conversation["messages"].extend(messages)
+            conversation["updated"] = time.time()
+            return True
+
+    def get_artifacts(self, conversation_id):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            return dict(conversation["artifacts"]) if conversation else {}
+
+    def put_artifacts(self, conversation_id, artifacts):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is not None:
+                conversation["artifacts"].update(artifacts)
+
+    def delete(self, conversation_id):
+        with self.lock:
+            return self.conversations.pop(conversation_id, None) is not None
+
+
+class SQLiteConversationStore:
+    """Messages are stored one row each, so appending a turn never rewrites the history"""
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    owner TEXT
+);
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    conversation_id TEXT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+);
+CREATE TABLE IF NOT EXISTS conversation_artifacts (
+    conversation_id TEXT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, name)
+);
+"""
+
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600, cleanup_interval=600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(self.SCHEMA)
+        try:
+            # Databases created before owner tokens
+            self.db.execute("ALTER TABLE conversations ADD COLUMN owner TEXT")
+        except sqlite3.OperationalError:
+            pass
+
+    def _cleanup(self, now):
+        # Expired conversations are swept lazily, at most once per interval per worker
+        if now - self.last_cleanup < self.cleanup_interval:
+            return
+        self.last_cleanup = now
+        self.db.execute("DELETE FROM conversations WHERE updated < ?", (now - self.ttl_seconds,))
+
+    def create(self, messages=None, owner=None):
+        conversation_id = new_conversation_id()
+        now = time.time()
+        with self.lock:
+            self._cleanup(now)
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute(
+                    "INSERT INTO conversations (id, created, updated, owner) VALUES (?, ?, ?, ?)",
+                    (conversation_id, now, now, owner)
+                )
+                self.db.executemany(
+                    "INSERT INTO conversation_messages (conversation_id, seq, message) VALUES (?, ?, ?)",
+                    [(conversation_id, seq, json.dumps(msg)) for seq, msg in enumerate(messages or [])]
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return conversation_id
+
+    def exists(self, conversation_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM conversations WHERE id = ? AND updated >= ?",
+                (conversation_id, time.time() - self.ttl_seconds)
+            ).fetchone()
+        return row is not None
+
+    def owner(self, conversation_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT owner FROM conversations WHERE id = ? AND updated >= ?",
+                (conversation_id, time.time() - self.ttl_seconds)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get(self, conversation_id):
+        if not self.exists(conversation_id):
+            return None
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT message FROM conversation_messages WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append(self, conversation_id, *messages):
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                updated = self.db.execute(
+                    "UPDATE conversations SET updated = ? WHERE id = ?", (now, conversation_id)
+                ).rowcount
+                if not updated:
+                    self.db.execute("ROLLBACK")
+                    return False
+                next_seq = self.db.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM conversation_messages WHERE conversation_id = ?",
+                    (conversation_id,)
+                ).fetchone()[0]
+                self.db.executemany(
+                    "INSERT INTO conversation_messages (conversation_id, seq, message) VALUES (?, ?, ?)",
+                    [(conversation_id, next_seq + i, json.dumps(msg)) for i, msg in enumerate(messages)]
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return True
+
+    def get_artifacts(self, conversation_id):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, content FROM conversation_artifacts WHERE conversation_id = ?", (conversation_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def put_artifacts(self, conversation_id, artifacts):
+        if not artifacts:
+            return
+        with self.lock:
+            try:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO conversation_artifacts (conversation_id, name, content) VALUES (?, ?, ?)",
+                    [(conversation_id, name, content) for name, content in artifacts.items()]
+                )
+            except sqlite3.IntegrityError:
+                pass  # conversation was deleted meanwhile
+
+    def delete(self, conversation_id):
+        with self.lock:
+            return self.db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,)).rowcount > 0
+
+
+class RedisConversationStore:
+    """Each conversation is a Redis list of JSON messages with a sliding TTL"""
+
+    def __init__(self, resp_client, ttl_seconds=7 * 24 * 3600, prefix="fowazz:conversation:"):
+        self.redis = resp_client
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+
+    def _key(self, conversation_id):
+        return self.prefix + conversation_id
+
+    def create(self, messages=None, owner=None):
+        conversation_id = new_conversation_id()
+        key = self._key(conversation_id)
+        # A leading marker keeps empty conversations alive as a key, and holds the owner hash
+        marker = json.dumps({"owner": owner} if owner else {})
+        self.redis.execute("RPUSH", key, marker, *[json.dumps(msg) for msg in messages or []])
+        self.redis.execute("EXPIRE", key, self.ttl_seconds)
+        return conversation_id
+
+    def exists(self, conversation_id):
+        return self.redis.execute("EXISTS", self._key(conversation_id)) == 1
+
+    def owner(self, conversation_id):
+        marker = self.redis.execute("LINDEX", self._key(conversation_id), 0)
+        return json.loads(marker).get("owner") if marker else None
+
+    def get(self, conversation_id):
+        items = self.redis.execute("LRANGE", self._key(conversation_id), 0, -1)
+        if not items:
+            return None
+        return [json.loads(item) for item in items[1:]]
+
+    def append(self, conversation_id, *messages):
+        key = self._key(conversation_id)
+        if not self.exists(conversation_id):
+            return False
+        self.redis.execute("RPUSH", key, *[json.dumps(msg) for msg in messages])
+        self.redis.execute("EXPIRE", key, self.ttl_seconds)
+        self.redis.execute("EXPIRE", key + ":artifacts", self.ttl_seconds)
+        return True
+
+    def get_artifacts(self, conversation_id):
+        items = self.redis.execute("HGETALL", self._key(conversation_id) + ":artifacts") or []
+        return {items[i].decode(): items[i + 1].decode() for i in range(0, len(items), 2)}
+
+    def put_artifacts(self, conversation_id, artifacts):
+        if not artifacts:
+            return
+        key = self._key(conversation_id) + ":artifacts"
+        fields = [part for name, content in artifacts.items() for part in (name, content)]
+        self.redis.execute("HSET", key, *fields)
+        self.redis.execute("EXPIRE", key, self.ttl_seconds)
+
+    def delete(self, conversation_id):
+        key = self._key(conversation_id)
+        return self.redis.execute("DEL", key, key + ":artifacts") >= 1
+
+
+def create_conversation_store():
+    """Build the conversation store selected by CONVERSATION_STORE (sqlite, redis or memory)"""
+    ttl_seconds = float(os.getenv("CONVERSATION_TTL_SECONDS", str(7 * 24 * 3600)))
+    backend = os.getenv("CONVERSATION_STORE", "sqlite").lower()
+
+    if backend == "redis":
+        return RedisConversationStore(redis_client_from_env(), ttl_seconds)
+
+    if backend == "sqlite":
+        path = os.getenv("CONVERSATION_DB", "/tmp/fowazz-conversations.db")
+        try:
+            return SQLiteConversationStore(path, ttl_seconds)
+        except sqlite3.Error as e:
+            print(f"⚠️ SQLite conversation store unavailable, using in-memory store: {str(e)}")
+
+    return MemoryConversationStore(ttl_seconds)
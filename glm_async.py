@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Async GLM chat completions client for the ASGI streaming path (asgi.py).
+
+The zai SDK only streams synchronously - every open stream pins a thread (or a
+gevent greenlet on a monkey-patched socket). This client speaks the same HTTP
+API over httpx.AsyncClient instead, so an event loop can hold thousands of
+streams that spend most of their time waiting on the model. It is deliberately
+small: POST {base_url}/chat/completions, parse the SSE "data:" lines, and hand
+back chunk objects shaped like the SDK's (chunk.choices[0].delta.content /
+.reasoning_content / .finish_reason), so code written against one reads the other.
+
+Errors carry status_code and response like the SDK's, so glm_pool's breakers
+and failover treat both clients the same way.
+"""
+import json
+from types import SimpleNamespace
+
+import httpx
+
+DEFAULT_BASE_URL = "https://open.bigmodel.cn/api/paas/v4"
+
+
+class GLMStatusError(Exception):
+    """Non-2xx answer from the GLM API"""
+
+    def __init__(self, response, body):
+        self.response = response
+        self.status_code = response.status_code
+        try:
+            message = json.loads(body).get("error", {}).get("message") or body
+        except (ValueError, AttributeError):
+            message = body
+        super().__init__(f"Error code: {response.status_code}, {message}")
+
+
+def _chunk(payload):
+    choices = []
+    for choice in payload.get("choices") or []:
+        delta = choice.get("delta") or {}
+        choices.append(SimpleNamespace(
+            index=choice.get("index", 0),
+            delta=SimpleNamespace(content=delta.get("content"), reasoning_content=delta.get("reasoning_content")),
+            finish_reason=choice.get("finish_reason"),
+        ))
+    return SimpleNamespace(choices=choices, usage=payload.get("usage"))
+
+
+class AsyncGLMStream:
+    """Async iterator over the chunks of one streamed completion; aclose() ends the HTTP response"""
+
+    def __init__(self, response):
+        self.response = response
+
+    async def __aiter__(self):
+        try:
+            async for line in self.response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    return
+                payload = json.loads(data)
+                if payload.get("choices"):
+                    yield _chunk(payload)
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        await self.response.aclose()
+
+
+class AsyncGLMClient:
+    def __init__(self, api_key, base_url=None, connect_timeout=10.0, read_timeout=300.0, max_connections=None):
+        self.api_key = api_key
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip("/")
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=100)
+        self.http = None  # created on first use, inside the event loop that will use it
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        """
+        POST /chat/completions. With stream=True returns an AsyncGLMStream once the
+        response headers are in; otherwise the parsed completion (choices[0].message.content).
+        """
+        if self.http is None:
+            self.http = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        request = self.http.build_request(
+            "POST", f"{self.base_url}/chat/completions",
+            headers={"Authorization": f"Bearer {self.api_key}", "Accept": "text/event-stream" if stream else "application/json"},
+            json=dict(kwargs, model=model, messages=messages, stream=stream),
+        )
+        response = await self.http.send(request, stream=True)
+        if response.status_code >= 400:
+            body = (await response.aread()).decode("utf-8", "replace")
+            await response.aclose()
+            raise GLMStatusError(response, body)
+        if stream:
+            return AsyncGLMStream(response)
+        try:
+            payload = json.loads(await response.aread())
+        finally:
+            await response.aclose()
+        return SimpleNamespace(choices=[
+            SimpleNamespace(index=choice.get("index", 0), finish_reason=choice.get("finish_reason"),
+                            message=SimpleNamespace(**(choice.get("message") or {})))
+            for choice in payload.get("choices") or []
+        ], usage=payload.get("usage"))
+
+    async def aclose(self):
+        if self.http is not None:
+            await self.http.aclose()
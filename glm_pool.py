@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of GLM upstreams (API key + endpoint pairs).
+
+With a single key, one rate limit or outage fails every user. The pool spreads
+requests over several keys and routes around the ones that are struggling:
+
+    balancing   - least outstanding requests first, then least tokens used this minute
+    budgets     - per-key concurrency cap and tokens-per-minute budget
+    breakers    - a key that keeps failing (or gets rate limited) is skipped for a
+                  cooldown; afterwards a single half-open probe decides whether it's back
+    failover    - if opening a stream fails, the next key is tried before giving up
+    fallback    - when the time to first token of a model breaches the SLO, new
+                  requests use the next model in the chain (e.g. glm-4.6 -> glm-4.5-air)
+                  until the cooldown has passed
+
+State is per worker: every gunicorn worker keeps its own breakers and budgets
+(each worker sees enough traffic to notice a bad key within a few requests).
+"""
+import collections
+import os
+import threading
+import time
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+MINUTE = 60.0
+
+
+class UpstreamUnavailable(Exception):
+    """No upstream can take the request right now (all busy, over budget or broken)"""
+
+
+def _status_code(error):
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """Errors worth trying on another key: rate limits, server errors, connection problems"""
+    status = _status_code(error)
+    if status is None:
+        return True  # connection error / timeout
+    return status in (401, 403, 408, 409, 429) or status >= 500
+
+
+class Upstream:
+    def __init__(self, name, client, max_concurrency=0, tokens_per_minute=0, async_client=None):
+        self.name = name
+        self.client = client
+        self.async_client = async_client  # glm_async.AsyncGLMClient for the ASGI path, if configured
+        self.max_concurrency = max_concurrency  # 0 = unlimited
+        self.tokens_per_minute = tokens_per_minute  # 0 = unlimited
+        self.outstanding = 0
+        self.reserved_tokens = 0
+        self.usage = collections.deque()  # (time, tokens) of finished requests, last minute
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        self.probing = False
+        self.consecutive_failures = 0
+        self.counts = collections.Counter()  # requests / failures / rate_limited / opened
+        self.ttft_ewma = None
+        self.last_error = None
+
+    def tokens_used(self, now):
+        while self.usage and self.usage[0][0] < now - MINUTE:
+            self.usage.popleft()
+        return sum(tokens for _, tokens in self.usage) + self.reserved_tokens
+
+    def available(self, now, estimated_tokens):
+        if self.state == OPEN:
+            if now < self.open_until:
+                return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and self.probing:
+            return False  # one probe at a time
+        if self.max_concurrency and self.outstanding >= self.max_concurrency:
+            return False
+        if self.tokens_per_minute and self.tokens_used(now) + estimated_tokens > self.tokens_per_minute:
+            # A request bigger than the whole budget still goes through on an idle key
+            return self.outstanding == 0 and self.tokens_used(now) == 0
+        return True
+
+
+class Lease:
+    """One request on one upstream; report how it went exactly once (release or fail)"""
+
+    def __init__(self, pool, upstream, model, estimated_tokens):
+        self.pool = pool
+        self.upstream = upstream
+        self.client = upstream.client
+        self.async_client = upstream.async_client
+        self.model = model
+        self.estimated_tokens = estimated_tokens
+        self.started = time.monotonic()
+        self.ttft = None
+        self.done = False
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self.started
+            self.pool._observe_ttft(self, self.ttft)
+
+    def release(self, output_tokens=0):
+        self.pool._finish(self, self.estimated_tokens + output_tokens, None)
+
+    def fail(self, error, output_tokens=0):
+        self.pool._finish(self, self.estimated_tokens + output_tokens, error)
+
+
+class GLMPool:
+    def __init__(self, upstreams, fallback_models=(), ttft_slo=20.0, fallback_cooldown=120.0,
+                 failure_threshold=3, breaker_cooldown=30.0, max_breaker_cooldown=300.0):
+        self.upstreams = list(upstreams)
+        self.fallback_models = list(fallback_models)
+        self.ttft_slo = ttft_slo
+        self.fallback_cooldown = fallback_cooldown
+        self.failure_threshold = failure_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.max_breaker_cooldown = max_breaker_cooldown
+        self.lock = threading.Lock()
+        self.models = {}  # model -> {"ttft_ewma", "samples", "degraded_until"}
+        self.fallbacks = collections.Counter()  # model -> requests sent elsewhere because it breached the SLO
+
+    # Model fallback
+
+    def select_model(self, preferred):
+        """preferred, or the first model after it in the fallback chain that isn't breaching its SLO"""
+        now = time.monotonic()
+        chain = [preferred] + [m for m in self.fallback_models if m != preferred]
+        with self.lock:
+            for model in chain:
+                if self.models.get(model, {}).get("degraded_until", 0) <= now:
+                    if model != preferred:
+                        self.fallbacks[preferred] += 1
+                    return model
+        return chain[-1]
+
+    def _observe_ttft(self, lease, ttft):
+        with self.lock:
+            upstream = lease.upstream
+            upstream.ttft_ewma = ttft if upstream.ttft_ewma is None else 0.8 * upstream.ttft_ewma + 0.2 * ttft
+            model = self.models.setdefault(lease.model, {"ttft_ewma": None, "samples": 0, "degraded_until": 0})
+            model["ttft_ewma"] = ttft if model["ttft_ewma"] is None else 0.8 * model["ttft_ewma"] + 0.2 * ttft
+            model["samples"] += 1
+            breached = bool(self.fallback_models) and model["samples"] >= 3 and model["ttft_ewma"] > self.ttft_slo
+            if breached:
+                model.update(ttft_ewma=None, samples=0, degraded_until=time.monotonic() + self.fallback_cooldown)
+        if breached:
+            print(f"🐢 {lease.model} time to first token above {self.ttft_slo:g}s, falling back for {self.fallback_cooldown:g}s")
+
+    # Upstreams
+
+    def acquire(self, model, estimated_tokens=0, exclude=()):
+        """Lease on the least loaded healthy upstream; raises UpstreamUnavailable if there is none"""
+        now = time.monotonic()
+        with self.lock:
+            candidates = [u for u in self.upstreams if u not in exclude and u.available(now, estimated_tokens)]
+            if not candidates:
+                raise UpstreamUnavailable("All GLM upstreams are busy or unavailable")
+            upstream = min(candidates, key=lambda u: (
+                u.outstanding / u.max_concurrency if u.max_concurrency else u.outstanding,
+                u.tokens_used(now) / u.tokens_per_minute if u.tokens_per_minute else 0,
+            ))
+            upstream.outstanding += 1
+            upstream.reserved_tokens += estimated_tokens
+            upstream.counts["requests"] += 1
+            if upstream.state == HALF_OPEN:
+                upstream.probing = True
+        return Lease(self, upstream, model, estimated_tokens)
+
+    def _finish(self, lease, tokens, error):
+        upstream = lease.upstream
+        now = time.monotonic()
+        with self.lock:
+            if lease.done:
+                return
+            lease.done = True
+            upstream.outstanding -= 1
+            upstream.reserved_tokens -= lease.estimated_tokens
+            upstream.usage.append((now, tokens))
+            upstream.probing = False
+            if error is None:
+                upstream.consecutive_failures = 0
+                if upstream.state != CLOSED:
+                    print(f"✅ GLM upstream {upstream.name} recovered")
+                upstream.state = CLOSED
+                upstream.cooldown = 0.0
+                return
+            if not is_retryable(error):
+                return  # our request was bad, the key is fine
+            upstream.counts["failures"] += 1
+            upstream.consecutive_failures += 1
+            upstream.last_error = str(error)[:200]
+            status = _status_code(error)
+            if status == 429:
+                upstream.counts["rate_limited"] += 1
+            if status in (401, 403, 429) or upstream.state == HALF_OPEN or \
+                    upstream.consecutive_failures >= self.failure_threshold:
+                upstream.cooldown = min(max(upstream.cooldown * 2, self.breaker_cooldown), self.max_breaker_cooldown)
+                cooldown = _retry_after(error) or upstream.cooldown
+                upstream.state = OPEN
+                upstream.open_until = now + cooldown
+                upstream.counts["opened"] += 1
+                print(f"⚡ GLM upstream {upstream.name} circuit open for {cooldown:g}s: {upstream.last_error}")
+
+    def create(self, model, estimated_tokens=0, **kwargs):
+        """
+        chat.completions.create on the best upstream, trying the next one when the call
+        itself fails with a retryable error. Returns (response, lease); the caller reports
+        the outcome on the lease.
+        """
+        tried = []
+        last_error = None
+        while True:
+            try:
+                lease = self.acquire(model, estimated_tokens, exclude=tried)
+            except UpstreamUnavailable:
+                if last_error is not None:
+                    raise last_error  # every key failed - report what actually went wrong
+                raise
+            try:
+                return lease.client.chat.completions.create(model=model, **kwargs), lease
+            except Exception as e:
+                lease.fail(e)
+                tried.append(lease.upstream)
+                last_error = e
+                if not is_retryable(e):
+                    raise
+                print(f"🔁 GLM upstream {lease.upstream.name} failed ({str(e)[:100]}), trying another")
+
+    async def create_async(self, model, estimated_tokens=0, **kwargs):
+        """create() for the ASGI path: the same leases, breakers and failover over each upstream's async client"""
+        tried = []
+        last_error = None
+        while True:
+            try:
+                lease = self.acquire(model, estimated_tokens, exclude=tried)
+            except UpstreamUnavailable:
+                if last_error is not None:
+                    raise last_error
+                raise
+            try:
+                return await lease.async_client.create(model=model, **kwargs), lease
+            except Exception as e:
+                lease.fail(e)
+                tried.append(lease.upstream)
+                last_error = e
+                if not is_retryable(e):
+                    raise
+                print(f"🔁 GLM upstream {lease.upstream.name} failed ({str(e)[:100]}), trying another")
+
+    def stats(self):
+        """Per-upstream health and per-model latency, for metrics"""
+        now = time.monotonic()
+        with self.lock:
+            upstreams = []
+            for u in self.upstreams:
+                state = HALF_OPEN if u.state == OPEN and now >= u.open_until else u.state
+                upstreams.append(dict(
+                    u.counts, name=u.name, state=state, outstanding=u.outstanding,
+                    max_concurrency=u.max_concurrency, tokens_last_minute=u.tokens_used(now),
+                    tokens_per_minute=u.tokens_per_minute, consecutive_failures=u.consecutive_failures,
+                    ttft_ewma=round(u.ttft_ewma, 3) if u.ttft_ewma is not None else None,
+                    open_for=round(max(u.open_until - now, 0), 1) if u.state == OPEN else 0,
+                    last_error=u.last_error,
+                ))
+            models = {
+                model: {
+                    "ttft_ewma": round(m["ttft_ewma"], 3) if m["ttft_ewma"] is not None else None,
+                    "degraded_for": round(max(m["degraded_until"] - now, 0), 1),
+                    "fallbacks": self.fallbacks[model],
+                }
+                for model, m in self.models.items()
+            }
+        return {"upstreams": upstreams, "models": models, "fallback_models": self.fallback_models}
+
+
+def _split(value):
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+def create_glm_pool(client_factory, async_client_factory=None):
+    """
+    Pool from GLM_API_KEYS (comma separated, falls back to GLM_API_KEY) and GLM_BASE_URLS
+    (one per key, or a single URL for all of them); client_factory(api_key, base_url) makes a client,
+    async_client_factory(api_key, base_url) the async client create_async() uses.
+    """
+    keys = _split(os.getenv("GLM_API_KEYS")) or _split(os.getenv("GLM_API_KEY"))
+    base_urls = _split(os.getenv("GLM_BASE_URLS"))
+    max_concurrency = int(os.getenv("GLM_KEY_MAX_CONCURRENCY", "0"))
+    tokens_per_minute = int(os.getenv("GLM_KEY_TOKENS_PER_MINUTE", "0"))
+
+    upstreams = []
+    for i, key in enumerate(keys):
+        base_url = base_urls[i] if i < len(base_urls) else (base_urls[0] if len(base_urls) == 1 else None)
+        name = f"key{i}"  # opaque: it ends up in logs and metric labels
+        async_client = async_client_factory(key, base_url) if async_client_factory else None
+        upstreams.append(Upstream(name, client_factory(key, base_url), max_concurrency, tokens_per_minute, async_client))
+
+    return GLMPool(
+        upstreams,
+        fallback_models=_split(os.getenv("GLM_FALLBACK_MODELS")),
+        ttft_slo=float(os.getenv("GLM_TTFT_SLO_SECONDS", "20")),
+        fallback_cooldown=float(os.getenv("GLM_FALLBACK_COOLDOWN_SECONDS", "120")),
+        failure_threshold=int(os.getenv("GLM_BREAKER_FAILURES", "3")),
+        breaker_cooldown=float(os.getenv("GLM_BREAKER_COOLDOWN_SECONDS", "30")),
+    )
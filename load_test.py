@@ -0,0 +1,312 @@
+"""
+Load test /api/message with hundreds of concurrent SSE clients
+
+Ramps up to --clients concurrent users over --ramp seconds. Each user sends a
+build request, reads the whole stream, and repeats until --duration is up.
+Reports p50/p95/p99 of:
+
+    admission wait   - from the server's fowazz_admission_wait_seconds histogram
+                       (/metrics, interpolated within buckets like histogram_quantile)
+    time to first    - request sent -> first chunk of the answer, client side
+    total time       - request sent -> final event, client side
+
+plus the SITE_FULL rate, errors, peak concurrent upstream streams (with
+--mock-url) and the server's CPU and RSS (with --server-pid, sampled from /proc
+for the process and all its children, i.e. every gunicorn worker).
+
+Run it against the offline upstream, never the real GLM API:
+
+    python mock_glm.py --port 8090 &
+    GLM_API_KEY=mock GLM_BASE_URLS=http://127.0.0.1:8090/api/paas/v4 gunicorn --worker-class gevent \\
+        --workers 6 --worker-connections 1000 --bind 127.0.0.1:8080 server:app &
+    python load_test.py --url http://127.0.0.1:8080 --clients 300 --ramp 30 --duration 120 \\
+        --mock-url http://127.0.0.1:8090 --server-pid $(pgrep -of "gunicorn.*server:app")
+
+--json writes the summary to a file so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+
+import httpx
+
+BUSINESSES = ["bakery", "dental clinic", "yoga studio", "law firm", "coffee shop", "bike repair shop",
+              "photography studio", "flower shop", "language school", "car wash"]
+ADMISSION_BUCKET_RE = re.compile(r'^fowazz_admission_wait_seconds_bucket\{le="([^"]+)"\} (\S+)$', re.M)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def histogram_quantile(buckets, q):
+    """Quantile from cumulative (upper bound, count) buckets, linear within a bucket"""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    previous_bound, previous_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            if count == previous_count:
+                return bound
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / (count - previous_count)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+class ServerSampler:
+    """CPU seconds and RSS of a process and its descendants, read from /proc"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.samples = []  # (time, cpu seconds, rss bytes)
+
+    def _processes(self):
+        children = {}
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    with open(f"/proc/{name}/stat") as f:
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                children.setdefault(ppid, []).append(int(name))
+        pids, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            pids.append(pid)
+            stack.extend(children.get(pid, []))
+        return pids
+
+    def sample(self):
+        cpu = rss = 0
+        for pid in self._processes():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{pid}/statm") as f:
+                    resident = int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / self.ticks  # utime + stime
+            rss += resident * self.page_size
+        self.samples.append((time.monotonic(), cpu, rss))
+
+    def summary(self):
+        if len(self.samples) < 2:
+            return None
+        (start, cpu_start, _), (end, cpu_end, _) = self.samples[0], self.samples[-1]
+        rates = [
+            (cpu_b - cpu_a) / (t_b - t_a) * 100
+            for (t_a, cpu_a, _), (t_b, cpu_b, _) in zip(self.samples, self.samples[1:]) if t_b > t_a
+        ]
+        return {
+            "cpu_avg_percent": round((cpu_end - cpu_start) / (end - start) * 100, 1),
+            "cpu_peak_percent": round(max(rates), 1) if rates else None,
+            "rss_peak_mb": round(max(rss for _, _, rss in self.samples) / 2 ** 20, 1),
+        }
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.results = []  # one dict per finished request
+        self.active = 0
+        self.peak_active = 0
+
+    def body(self, user, n):
+        business = random.choice(BUSINESSES)
+        # Distinct prompts so single flight and the response cache don't merge the load away
+        text = f"[LANGUAGE: en]\n\nBuild me a website for my {business} (load test user {user}, request {n})"
+        body = {"messages": [{"role": "user", "content": text}]}
+        if self.args.parallel_build:
+            body["parallelBuild"] = True
+        return body
+
+    async def request(self, client, user, n):
+        result = {"status": None, "queued": False, "ttft": None, "total": None, "bytes": 0}
+        started = time.monotonic()
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            async with client.stream("POST", f"{self.args.url}/api/message", json=self.body(user, n),
+                                     headers={"X-Fowazz-Stream-Version": "2"}) as response:
+                if response.status_code == 503:
+                    result["status"] = "site_full"
+                    return result
+                if response.status_code != 200:
+                    result["status"] = f"http_{response.status_code}"
+                    return result
+                async for line in response.aiter_lines():
+                    result["bytes"] += len(line) + 1
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    if event.get("queued"):
+                        result["queued"] = True
+                    if result["ttft"] is None and (event.get("chunk") or event.get("artifact_delta")):
+                        result["ttft"] = time.monotonic() - started
+                    if event.get("error"):
+                        result["status"] = "site_full" if event["error"] == "SITE_FULL" else "error"
+                        result["error"] = event["error"]
+                        return result
+                    if event.get("done"):
+                        result["status"] = "completed"
+                        result["total"] = time.monotonic() - started
+                        return result
+                result["status"] = "incomplete"  # stream ended without a final event
+        except httpx.HTTPError as e:
+            result["status"] = "error"
+            result["error"] = type(e).__name__
+        finally:
+            self.active -= 1
+            self.results.append(result)
+        return result
+
+    async def user(self, client, user, deadline):
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            result = await self.request(client, user, n)
+            if result["status"] != "completed" and result["total"] is None and result["ttft"] is None:
+                await asyncio.sleep(1.0)  # rejected or unreachable - don't hammer the server in a tight loop
+            elif self.args.think_time:
+                await asyncio.sleep(random.uniform(0, 2 * self.args.think_time))
+
+    async def fetch(self, client, url):
+        try:
+            response = await client.get(url, headers={"Authorization": f"Bearer {self.args.metrics_token}"}
+                                        if self.args.metrics_token else None)
+            return response.text if response.status_code == 200 else None
+        except httpx.HTTPError:
+            return None
+
+    def admission_buckets(self, text):
+        buckets = {}
+        for bound, count in ADMISSION_BUCKET_RE.findall(text or ""):
+            buckets[float(bound)] = buckets.get(float(bound), 0) + float(count)
+        return buckets
+
+    async def run(self):
+        args = self.args
+        sampler = ServerSampler(args.server_pid) if args.server_pid else None
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.clients)
+        timeout = httpx.Timeout(args.request_timeout, connect=10.0)
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+            before = self.admission_buckets(await self.fetch(client, f"{args.url}/metrics"))
+            if args.mock_url:
+                await self.fetch(client, f"{args.mock_url}/stats?reset=1")
+
+            started = time.monotonic()
+            deadline = started + args.duration
+            tasks = []
+            for user in range(args.clients):
+                # Spread the users' start times evenly over the ramp
+                start_at = started + args.ramp * user / args.clients
+                await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+                tasks.append(asyncio.create_task(self.user(client, user, deadline)))
+
+            async def report():
+                while any(not task.done() for task in tasks):
+                    if sampler:
+                        sampler.sample()
+                    done = Counter(result["status"] for result in self.results)
+                    print(f"  {time.monotonic() - started:6.0f}s  {self.active:4d} streams open, "
+                          f"{len(self.results)} finished ({dict(done)})")
+                    await asyncio.sleep(args.report_interval)
+
+            reporter = asyncio.create_task(report())
+            await asyncio.gather(*tasks)
+            if sampler:
+                sampler.sample()
+            reporter.cancel()
+            elapsed = time.monotonic() - started
+
+            after = self.admission_buckets(await self.fetch(client, f"{args.url}/metrics"))
+            mock_stats = json.loads(await self.fetch(client, f"{args.mock_url}/stats") or "null") if args.mock_url else None
+
+        admission = sorted((bound, after[bound] - before.get(bound, 0)) for bound in after)
+        return self.summary(elapsed, admission, sampler.summary() if sampler else None, mock_stats)
+
+    def summary(self, elapsed, admission, server, mock_stats):
+        results = self.results
+        statuses = Counter(result["status"] for result in results)
+        completed = [result for result in results if result["status"] == "completed"]
+
+        def stats(values):
+            return {f"p{p}": round(percentile(values, p), 3) if values else None for p in (50, 95, 99)}
+
+        return {
+            "clients": self.args.clients,
+            "duration_seconds": round(elapsed, 1),
+            "requests": len(results),
+            "statuses": dict(statuses),
+            "site_full_rate": round(statuses["site_full"] / len(results), 4) if results else None,
+            "queued_rate": round(sum(result["queued"] for result in results) / len(results), 4) if results else None,
+            "completed_per_second": round(len(completed) / elapsed, 2) if elapsed else None,
+            "peak_open_streams": self.peak_active,
+            "admission_wait": {f"p{p}": round(value, 3) if value is not None else None
+                               for p, value in ((p, histogram_quantile(admission, p / 100)) for p in (50, 95, 99))},
+            "time_to_first_chunk": stats([result["ttft"] for result in results if result["ttft"] is not None]),
+            "total_time": stats([result["total"] for result in completed]),
+            "server": server,
+            "upstream": mock_stats,
+        }
+
+
+def print_summary(summary):
+    print(f"\n{summary['requests']} requests from {summary['clients']} clients in {summary['duration_seconds']}s "
+          f"({summary['completed_per_second']} completed/s, peak {summary['peak_open_streams']} open streams)")
+    print(f"statuses: {summary['statuses']}")
+    print(f"SITE_FULL rate: {summary['site_full_rate']:.2%}   queued: {summary['queued_rate']:.2%}\n")
+    print(f"{'':<22}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, key in (("admission wait (s)", "admission_wait"), ("first chunk (s)", "time_to_first_chunk"),
+                      ("total time (s)", "total_time")):
+        values = summary[key]
+        print(f"{name:<22}" + "".join(f"{'-' if values[p] is None else values[p]:>10}" for p in ("p50", "p95", "p99")))
+    if summary["server"]:
+        server = summary["server"]
+        print(f"\nserver CPU avg {server['cpu_avg_percent']}% (peak {server['cpu_peak_percent']}%), "
+              f"RSS peak {server['rss_peak_mb']} MB")
+    if summary["upstream"]:
+        print(f"upstream: {summary['upstream']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="Flask API base URL")
+    parser.add_argument("--clients", type=int, default=100, help="concurrent users at full load")
+    parser.add_argument("--ramp", type=float, default=20, help="seconds to reach --clients")
+    parser.add_argument("--duration", type=float, default=60, help="seconds users keep sending requests")
+    parser.add_argument("--think-time", type=float, default=0, help="average pause between a user's requests")
+    parser.add_argument("--request-timeout", type=float, default=600, help="seconds without data before giving up")
+    parser.add_argument("--parallel-build", action="store_true", help='send "parallelBuild": true')
+    parser.add_argument("--metrics-token", default=os.getenv("METRICS_TOKEN"), help="bearer token for /metrics")
+    parser.add_argument("--mock-url", help="mock_glm.py base URL, for upstream stream counts")
+    parser.add_argument("--server-pid", type=int, help="server (gunicorn master) pid, for CPU/RSS")
+    parser.add_argument("--report-interval", type=float, default=5)
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    print(f"🚦 {args.clients} clients against {args.url}, ramp {args.ramp:g}s, duration {args.duration:g}s")
+    summary = asyncio.run(LoadTest(args).run())
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus metrics shared by every gunicorn worker.
+
+Each worker keeps its own values in memory and writes them to
+METRICS_DIR/<pid>.json every couple of seconds (and right before serving a
+scrape). /metrics merges the files of all workers on the host:
+
+    counters, histograms - summed over every file, including workers that have
+                           exited, so totals never go backwards
+    gauges               - summed (or max'd) over workers that are still running
+
+A scrape folds the counters and histograms of exited workers into
+METRICS_DIR/dead.json and deletes their files (like prometheus_client's
+mark_process_dead), so the directory doesn't grow with every worker restart.
+
+Values that already live elsewhere (generation_stats, cache stats, pool health)
+are mirrored in by collectors that run before every write, instead of being
+counted twice.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows local dev - a single process, nothing to coordinate
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values tuple -> value
+
+    def _key(self, labels):
+        self.registry._ensure_flusher()
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        with self.registry.lock:
+            key = self._key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+            self.registry.dirty = True
+
+    def set_total(self, value, **labels):
+        """Mirror a total this worker already keeps elsewhere"""
+        with self.registry.lock:
+            self.values[self._key(labels)] = value
+            self.registry.dirty = True
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, registry, name, help_text, labelnames=(), aggregate="sum"):
+        super().__init__(registry, name, help_text, labelnames)
+        self.aggregate = aggregate  # how values from several workers combine: sum or max
+
+    def set(self, value, **labels):
+        with self.registry.lock:
+            self.values[self._key(labels)] = value
+            self.registry.dirty = True
+
+    def clear(self):
+        with self.registry.lock:
+            self.values = {}
+            self.registry.dirty = True
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        with self.registry.lock:
+            key = self._key(labels)
+            state = self.values.get(key)
+            if state is None:
+                # non-cumulative bucket counts (+Inf last), then sum and count
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-2] += value
+            state[-1] += 1
+            self.registry.dirty = True
+
+
+class Metrics:
+    def __init__(self, directory, flush_interval=2.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}  # name -> metric, in registration order
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.dirty = False
+        self.flusher_pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(self, name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), aggregate="sum"):
+        return self._register(Gauge(self, name, help_text, labelnames, aggregate))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, help_text, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        """collector() runs before every write and mirrors values kept elsewhere into metrics"""
+        self.collectors.append(collector)
+        self._ensure_flusher()
+
+    # Per-worker files
+
+    def _ensure_flusher(self):
+        # Started lazily (and again after a fork) so each worker flushes its own values
+        if self.flusher_pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self.flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Couldn't write metrics: {str(e)}")
+
+    def flush(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {str(e)}")
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            snapshot = {
+                name: [[list(key), value] for key, value in metric.values.items()]
+                for name, metric in self.metrics.items()
+            }
+        self._write(f"{os.getpid()}.json", {"pid": os.getpid(), "metrics": snapshot})
+
+    def _write(self, name, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(data).encode())
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _merge(self, metric, merged, values):
+        """Add one worker's values of a metric into merged (label values tuple -> value)"""
+        for key, value in values:
+            key = tuple(key)
+            if metric.kind == "histogram":
+                if len(value) != len(metric.buckets) + 3:
+                    continue  # written with other buckets by an older deploy
+                current = merged.setdefault(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(current, value)]
+            elif metric.kind == "gauge" and metric.aggregate == "max":
+                merged[key] = max(merged.get(key, value), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    def _bury_dead(self, dead):
+        """Fold the counters and histograms of exited workers into dead.json and delete their files"""
+        lock_fd = os.open(os.path.join(self.directory, "dead.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, "dead.json")
+            try:
+                with open(archive_path, "rb") as f:
+                    archive = json.load(f).get("metrics", {})
+            except (OSError, ValueError):
+                archive = {}
+            buried = []
+            for name in dead:
+                path = os.path.join(self.directory, name)
+                try:
+                    # Re-read under the lock: another worker may have buried it already
+                    with open(path, "rb") as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if _pid_alive(data.get("pid")):
+                    continue
+                for metric_name, values in data.get("metrics", {}).items():
+                    metric = self.metrics.get(metric_name)
+                    if metric is None or metric.kind == "gauge":
+                        continue
+                    merged = {tuple(key): value for key, value in archive.get(metric_name, [])}
+                    self._merge(metric, merged, values)
+                    archive[metric_name] = [[list(key), value] for key, value in merged.items()]
+                buried.append(path)
+            if not buried:
+                return
+            self._write("dead.json", {"pid": None, "metrics": archive})
+            for path in buried:
+                os.unlink(path)
+        finally:
+            os.close(lock_fd)
+
+    # Exposition
+
+    def _read_workers(self, bury=True):
+        workers = []
+        dead = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "rb") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _pid_alive(data.get("pid"))
+            if bury and not alive and name != "dead.json":
+                dead.append(name)
+            workers.append((alive, data.get("metrics", {})))
+        if dead:
+            try:
+                self._bury_dead(dead)
+            except OSError as e:
+                print(f"⚠️ Couldn't merge metrics of exited workers: {str(e)}")
+            else:
+                return self._read_workers(bury=False)
+        return workers
+
+    def render(self):
+        """Prometheus text exposition of every worker's metrics merged"""
+        self._ensure_flusher()
+        self.dirty = True
+        self.flush()
+        workers = self._read_workers()
+
+        lines = []
+        for name, metric in self.metrics.items():
+            merged = {}
+            for alive, values in workers:
+                if metric.kind == "gauge" and not alive:
+                    continue
+                self._merge(metric, merged, values.get(name, []))
+
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(merged.items()):
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{_format_labels(metric.labelnames, key)} {_format_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric.buckets) + [float("inf")], value):
+                    cumulative += count
+                    le = (("le", _format_number(float(bound))),)
+                    lines.append(f"{name}_bucket{_format_labels(metric.labelnames, key, le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(metric.labelnames, key)} {_format_number(float(value[-2]))}")
+                lines.append(f"{name}_count{_format_labels(metric.labelnames, key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid):
+    if not isinstance(pid, int):
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def create_metrics():
+    """Metrics registry writing to METRICS_DIR (one directory per host, shared by its workers)"""
+    return Metrics(
+        os.getenv("METRICS_DIR", "/tmp/fowazz-metrics"),
+        flush_interval=float(os.getenv("METRICS_FLUSH_SECONDS", "2")),
+    )
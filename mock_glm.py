@@ -0,0 +1,245 @@
+"""
+Offline stand-in for the GLM (ZhipuAI) chat completions API, for load tests
+
+Serves POST .../chat/completions the way open.bigmodel.cn/api/paas/v4 does:
+streamed responses as SSE chunks (reasoning_content while "thinking", then
+content, then finish_reason and "data: [DONE]"), non-streamed responses as one
+JSON body. Nothing is generated - the reply is a canned site of the requested
+size, paced to the configured timing, so capacity changes can be measured
+without an API key or API bill.
+
+    python mock_glm.py --port 8090 --ttft 1.5 --tokens-per-sec 60 --reasoning-chars 3000
+    GLM_API_KEY=mock GLM_BASE_URLS=http://127.0.0.1:8090/api/paas/v4 python server.py
+
+Error injection: --error-rate answers that share of requests with --error-status
+(429 by default) before streaming, --disconnect-rate drops that share of streams
+halfway through, --length-rate ends that share with finish_reason "length".
+
+GET /stats reports requests served, streams open now and at peak, and injected
+errors; GET /stats?reset=1 also resets the counters (load_test.py does this).
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CHARS_PER_TOKEN = 4
+PAGE_FILE_RE = re.compile(r"^Build ONLY ([\w\-.]+\.html):", re.M)
+
+SECTION = """    <section class="py-16 px-6">
+      <h2 class="text-3xl font-bold mb-4">Fresh from the oven</h2>
+      <p class="text-lg text-gray-700">Sourdough, croissants and seasonal tarts, baked every morning since 1998.</p>
+    </section>
+"""
+REASONING = "The user wants a bakery website. I should plan the sections, pick warm colours and keep the copy short. "
+
+
+def make_content(chars, file="index.html"):
+    """A response shaped like a real build: title, intro, one artifact, closing - about `chars` long"""
+    head = f"[TITLE: Mock Bakery]\n\nHere's your bakery website!\n\n[ARTIFACT:START:{file}]\n<!DOCTYPE html>\n<html>\n  <body>\n"
+    tail = "  </body>\n</html>\n[ARTIFACT:END]\n\nWant me to add a menu page?"
+    body = SECTION * max(1, (chars - len(head) - len(tail)) // len(SECTION) + 1)
+    return head + body[:max(0, chars - len(head) - len(tail))] + tail
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = Counter()  # requests / streams / completed / length / errors / disconnects / cancelled
+        self.open_streams = 0
+        self.peak_streams = 0
+
+    def stream_opened(self):
+        with self.lock:
+            self.open_streams += 1
+            self.peak_streams = max(self.peak_streams, self.open_streams)
+
+    def stream_closed(self):
+        with self.lock:
+            self.open_streams -= 1
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            data = dict(self.counts, open_streams=self.open_streams, peak_streams=self.peak_streams)
+            if reset:
+                open_streams = self.open_streams
+                self.reset()
+                self.open_streams = self.peak_streams = open_streams
+        return data
+
+
+class MockGLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # hundreds of streams - keep the console readable
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/stats":
+            return self._send_json(404, {"error": {"message": "not found"}})
+        reset = parse_qs(url.query).get("reset") == ["1"]
+        self._send_json(200, self.server.stats.snapshot(reset))
+
+    def do_POST(self):
+        config = self.server.config
+        stats = self.server.stats
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if not urlparse(self.path).path.endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": "not found"}})
+        stats.count("requests")
+
+        if random.random() < config.error_rate:
+            stats.count("errors")
+            return self._send_json(config.error_status, {
+                "error": {"code": "1302" if config.error_status == 429 else "500", "message": "Injected by mock_glm"}
+            })
+
+        messages = body.get("messages") or []
+        last = str(messages[-1].get("content", "")) if messages else ""
+        if not body.get("stream"):
+            return self._send_json(200, self._completion(body, self._plan(last)))
+
+        continuation = last.startswith("[CONTINUE]")
+        page = PAGE_FILE_RE.search(last)  # one page of a parallel build
+        content = make_content(config.content_chars // 4 if continuation else config.content_chars,
+                               page.group(1) if page else "index.html")
+        thinking = (body.get("thinking") or {}).get("type") != "disabled"
+        reasoning = (REASONING * (config.reasoning_chars // len(REASONING) + 1))[:config.reasoning_chars] if thinking else ""
+        finish_reason = "stop"
+        if not continuation and random.random() < config.length_rate:
+            content = content[:len(content) * 2 // 3]
+            finish_reason = "length"
+        disconnect_at = len(content) // 2 if random.random() < config.disconnect_rate else None
+
+        stats.stream_opened()
+        try:
+            self._stream(body, reasoning, content, finish_reason, disconnect_at)
+        except (BrokenPipeError, ConnectionResetError):
+            stats.count("cancelled")  # the server closed the upstream (client went away)
+        finally:
+            stats.stream_closed()
+
+    def _stream(self, body, reasoning, content, finish_reason, disconnect_at):
+        config = self.server.config
+        stats = self.server.stats
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        base = {"id": uuid.uuid4().hex, "created": int(time.time()), "model": body.get("model", "glm-4.6")}
+        ttft = config.ttft * random.uniform(1 - config.jitter, 1 + config.jitter)
+        time.sleep(max(0.0, ttft))
+
+        piece = CHARS_PER_TOKEN * config.tokens_per_chunk
+        interval = config.tokens_per_chunk / config.tokens_per_sec
+        next_at = time.monotonic()
+        for field, text in (("reasoning_content", reasoning), ("content", content)):
+            for start in range(0, len(text), piece):
+                if field == "content" and disconnect_at is not None and start >= disconnect_at:
+                    stats.count("disconnects")
+                    self.close_connection = True
+                    return  # no terminating chunk - the client sees a broken stream
+                self._write_event(dict(base, choices=[{
+                    "index": 0, "delta": {"role": "assistant", field: text[start:start + piece]}, "finish_reason": None
+                }]))
+                next_at += interval
+                time.sleep(max(0.0, next_at - time.monotonic()))
+
+        output_tokens = (len(reasoning) + len(content)) // CHARS_PER_TOKEN
+        self._write_event(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": finish_reason}], usage={
+            "prompt_tokens": 0, "completion_tokens": output_tokens, "total_tokens": output_tokens
+        }))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+        stats.count("length" if finish_reason == "length" else "completed")
+
+    def _plan(self, last_message):
+        """Reply to a non-streamed call: a build plan when asked for one, else a short answer"""
+        config = self.server.config
+        if not last_message.startswith("[BUILD PLAN]"):
+            return "OK"
+        if config.plan_pages < 2:
+            return json.dumps({"ready": False})
+        pages = [{"file": "index.html", "brief": "Home page"}] + [
+            {"file": f"page{i}.html", "brief": f"Page {i}"} for i in range(2, config.plan_pages + 1)
+        ]
+        return json.dumps({"ready": True, "title": "Mock Bakery", "intro": "Building your site!", "pages": pages,
+                           "nav": "<nav></nav>", "design": "Primary #b45309, Inter, 8px radius", "closing": "All done!"})
+
+    def _completion(self, body, text):
+        return {
+            "id": uuid.uuid4().hex, "created": int(time.time()), "model": body.get("model", "glm-4.6"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(text) // CHARS_PER_TOKEN,
+                      "total_tokens": len(text) // CHARS_PER_TOKEN},
+        }
+
+    def _write_event(self, payload):
+        self._write_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockGLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, config):
+        super().__init__(address, MockGLMHandler)
+        self.config = config
+        self.stats = MockStats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--ttft", type=float, default=1.0, help="seconds to the first token")
+    parser.add_argument("--jitter", type=float, default=0.3, help="TTFT varies by +- this fraction")
+    parser.add_argument("--tokens-per-sec", type=float, default=60, help="per stream")
+    parser.add_argument("--tokens-per-chunk", type=int, default=1, help="tokens per SSE chunk")
+    parser.add_argument("--reasoning-chars", type=int, default=2000, help="reasoning before the content (thinking on)")
+    parser.add_argument("--content-chars", type=int, default=8000, help="length of each response")
+    parser.add_argument("--length-rate", type=float, default=0.0, help="share of responses cut off with finish_reason length")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="share of streams dropped halfway")
+    parser.add_argument("--plan-pages", type=int, default=4, help="pages in build plans (parallel builds); <2 = not ready")
+    config = parser.parse_args()
+
+    server = MockGLMServer((config.host, config.port), config)
+    print(f"🧪 Mock GLM on http://{config.host}:{config.port}/api/paas/v4 "
+          f"(TTFT {config.ttft:g}s, {config.tokens_per_sec:g} tok/s, {config.content_chars} chars)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Replay recorded upstream stream traces through /api/message
+
+Loads traces written with STREAM_TRACE_DIR (see stream_traces.py), swaps the
+GLM pool for a ReplayClient and sends one /api/message request per trace
+through the Flask app in-process - admission, generate(), continuation
+stitching, parallel page merging, coalescing, artifact parsing and SSE framing
+all run exactly as in production, fed with production chunk sizes and gaps.
+
+    python replay_traces.py traces/traces-2026-10-17.jsonl
+    python replay_traces.py traces/*.jsonl --speed 20 --concurrency 16 --json after.json
+
+--speed divides every recorded gap (20 = twenty times faster). Reports p50/p95
+of time to first chunk and total time, the drift from the recorded timing
+(total time minus recorded duration / speed), events, bytes and outcomes, so a
+change to framing, parsing or admission can be compared run against run.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.pop("STREAM_TRACE_DIR", None)  # don't record the replay itself
+os.environ.setdefault("GLM_API_KEY", "replay")
+
+import glm_pool
+import server
+from stream_traces import ReplayClient, load_traces
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def recorded_duration(trace):
+    """Seconds from the first upstream call to the last chunk, as recorded"""
+    return max(
+        (trace_round["opened_ms"] + (trace_round["chunks"][-1][0] if trace_round["chunks"] else 0)) / 1000
+        for trace_round in trace["rounds"]
+    )
+
+
+def replay(client, index, trace, speed):
+    body = {
+        "messages": [{"role": "user", "content": f"[LANGUAGE: en]\n\nBuild me a website (replay trace {index})"}],
+        "thinkingProgress": True,
+        "artifactEvents": True,
+    }
+    if trace["mode"] == "parallel":
+        body["parallelBuild"] = True
+    result = {"outcome": None, "ttft": None, "total": None, "events": 0, "bytes": 0,
+              "expected": recorded_duration(trace) / speed}
+    started = time.monotonic()
+    response = client.post("/api/message", json=body, headers={server.STREAM_VERSION_HEADER: "2"}, buffered=False)
+    if response.status_code != 200:
+        result["outcome"] = f"http_{response.status_code}"
+        return result
+    buffer = b""
+    try:
+        for data in response.iter_encoded():
+            result["bytes"] += len(data)
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[6:])
+                result["events"] += 1
+                if result["ttft"] is None and (event.get("chunk") or event.get("artifact_delta")):
+                    result["ttft"] = time.monotonic() - started
+                if event.get("error"):
+                    result["outcome"] = f"error:{event['error'][:40]}"
+                elif event.get("done"):
+                    result["outcome"] = result["outcome"] or "completed"
+                    result["total"] = time.monotonic() - started
+                    return result
+    finally:
+        response.close()
+    result["outcome"] = result["outcome"] or "incomplete"
+    return result
+
+
+def row(name, values):
+    cells = [f"{value:10.3f}" if value is not None else f"{'-':>10}" for value in
+             (percentile(values, 50), percentile(values, 95), percentile(values, 99))]
+    return f"{name:<24}" + "".join(cells)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("traces", nargs="+", help="trace JSONL files")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 1 = as recorded")
+    parser.add_argument("--concurrency", type=int, default=1, help="traces replayed at the same time")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N traces")
+    parser.add_argument("--mode", choices=["serial", "parallel"], help="replay only serial or parallel builds")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's own log lines")
+    parser.add_argument("--json", help="write the summary to this file")
+    args = parser.parse_args()
+
+    traces = [trace for trace in load_traces(args.traces) if not args.mode or trace["mode"] == args.mode]
+    if args.limit:
+        traces = traces[:args.limit]
+    if not traces:
+        sys.exit("no traces to replay")
+
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    server.glm_pool = glm_pool.GLMPool([glm_pool.Upstream("replay", ReplayClient(traces, args.speed))])
+    client = server.app.test_client()
+
+    print(f"🎞️ Replaying {len(traces)} traces at {args.speed:g}x, {args.concurrency} at a time", file=out)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda item: replay(client, item[0], item[1], args.speed), enumerate(traces)))
+    elapsed = time.monotonic() - started
+
+    completed = [result for result in results if result["total"] is not None]
+    summary = {
+        "traces": len(traces),
+        "speed": args.speed,
+        "concurrency": args.concurrency,
+        "elapsed": round(elapsed, 3),
+        "outcomes": dict(Counter(result["outcome"] for result in results)),
+        "events": sum(result["events"] for result in results),
+        "bytes": sum(result["bytes"] for result in results),
+    }
+    metrics = {
+        "first chunk (s)": [result["ttft"] for result in results if result["ttft"] is not None],
+        "total time (s)": [result["total"] for result in completed],
+        "drift (s)": [result["total"] - result["expected"] for result in completed],
+    }
+    for name, values in metrics.items():
+        summary[name] = {f"p{p}": percentile(values, p) for p in (50, 95, 99)}
+
+    print(f"\n{len(traces)} traces in {elapsed:.1f}s: {summary['outcomes']}", file=out)
+    print(f"{summary['events']} events, {summary['bytes']:,} bytes "
+          f"({summary['bytes'] / max(1, summary['events']):.0f} bytes/event)\n", file=out)
+    print(f"{'':<24}{'p50':>10}{'p95':>10}{'p99':>10}", file=out)
+    for name, values in metrics.items():
+        print(row(name, values), file=out)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"\nSummary written to {args.json}", file=out)
+
+
+if __name__ == "__main__":
+    main()
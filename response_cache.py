@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in cache of complete responses for repeatable prompts.
+
+Many first turns are near-identical ("surprise me" with the same plugin
+configuration), yet each one costs a full GLM generation. Requests that send
+"cache": true are looked up by a hash of
+
+    system prompt version (its sha256) + normalized messages + model params
+
+Messages are normalized before hashing: whitespace is collapsed and inline
+files are replaced by their digest, so trivially different payloads share a
+cache entry.
+
+Two tiers, both LRU with a TTL:
+    memory - per worker, the hottest entries
+    disk   - shared by every worker on a host, promoted into memory on a hit
+
+Settings (enabled, max temperature) live in a small JSON file next to the disk
+tier, so an admin toggle applies to every worker within a second.
+"""
+import base64
+import binascii
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+SETTINGS_FILE = "settings.json"
+
+
+def _normalize_text(text):
+    return " ".join(str(text).split())
+
+
+def _normalize_block(block):
+    if not isinstance(block, dict):
+        return block
+    if block.get("type") == "text":
+        return {"type": "text", "text": _normalize_text(block.get("text", ""))}
+    source = block.get("source")
+    if isinstance(source, dict):
+        if source.get("type") == "attachment":
+            digest = source.get("digest")
+        else:
+            try:
+                digest = hashlib.sha256(base64.b64decode(source.get("data", ""), validate=True)).hexdigest()
+            except (binascii.Error, ValueError):
+                digest = hashlib.sha256(str(source.get("data", "")).encode()).hexdigest()
+        return {"type": block.get("type"), "digest": digest}
+    return block
+
+
+def cache_key(system_prompt, messages, params):
+    """Normalized hash of (system prompt version, messages, model params)"""
+    normalized = []
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = [_normalize_block(block) for block in content]
+        else:
+            content = _normalize_text(content)
+        normalized.append({"role": message.get("role"), "content": content})
+    payload = {
+        "system": hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(),
+        "messages": normalized,
+        "params": params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def sweep_directory(directory, suffix, ttl_seconds, max_bytes, skip=()):
+    """Unlink files older than ttl_seconds (by mtime), then the oldest ones until the rest fit in max_bytes"""
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith(suffix) and name not in skip:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    oldest_allowed = time.time() - ttl_seconds
+    for mtime, size, path in files:
+        if total <= max_bytes and mtime >= oldest_allowed:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+
+class ResponseCache:
+    SWEEP_EVERY = 32  # puts between disk size checks
+
+    def __init__(self, directory, max_entries=256, ttl_seconds=3600, disk_max_bytes=200 * 1024 * 1024,
+                 enabled=True, max_temperature=1.0):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_max_bytes = disk_max_bytes
+        self.memory = collections.OrderedDict()  # key -> (expires, value), oldest first
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()  # hits / disk_hits / misses / stores, per worker
+        self.puts = 0
+        self.settings = {"enabled": enabled, "max_temperature": max_temperature}
+        self.settings_mtime = None
+        self.settings_checked = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _write_atomic(self, path, data):
+        write_atomic(path, data)
+
+    # Settings
+
+    def _reload_settings(self):
+        now = time.monotonic()
+        if now - self.settings_checked < 1.0:
+            return
+        self.settings_checked = now
+        path = os.path.join(self.directory, SETTINGS_FILE)
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime != self.settings_mtime:
+                with open(path, "rb") as f:
+                    self.settings.update(json.load(f))
+                self.settings_mtime = mtime
+        except (OSError, ValueError):
+            pass
+
+    def get_settings(self):
+        self._reload_settings()
+        return dict(self.settings)
+
+    def update_settings(self, **changes):
+        """Change settings for every worker (enabled, max_temperature)"""
+        self._reload_settings()
+        self.settings.update({k: v for k, v in changes.items() if v is not None})
+        self._write_atomic(os.path.join(self.directory, SETTINGS_FILE), json.dumps(self.settings).encode())
+        self.settings_checked = 0
+        return dict(self.settings)
+
+    def accepts(self, temperature):
+        """Whether responses generated at this temperature may be cached/served from cache"""
+        self._reload_settings()
+        return bool(self.settings["enabled"]) and temperature <= float(self.settings["max_temperature"])
+
+    # Entries
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    self.counts["hits"] += 1
+                    return entry[1]
+                del self.memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = None
+        if stored is None or stored.get("expires", 0) <= now:
+            with self.lock:
+                self.counts["misses"] += 1
+            return None
+
+        try:
+            os.utime(path)  # mtime = last use, for the disk LRU sweep
+        except OSError:
+            pass
+        with self.lock:
+            self._remember(key, stored["expires"], stored["value"])
+            self.counts["disk_hits"] += 1
+        return stored["value"]
+
+    def _remember(self, key, expires, value):
+        self.memory[key] = (expires, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl_seconds
+        with self.lock:
+            self._remember(key, expires, value)
+            self.counts["stores"] += 1
+            self.puts += 1
+            sweep = self.puts % self.SWEEP_EVERY == 0
+        try:
+            self._write_atomic(self._path(key), json.dumps({"expires": expires, "value": value}).encode("utf-8"))
+            if sweep:
+                self._sweep_disk()
+        except OSError as e:
+            print(f"⚠️ Response cache disk write failed: {str(e)}")
+
+    def _sweep_disk(self):
+        """Drop expired files, then the least recently used ones until the disk tier fits its budget"""
+        sweep_directory(self.directory, ".json", self.ttl_seconds, self.disk_max_bytes, skip=(SETTINGS_FILE,))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".json") and name != SETTINGS_FILE:
+                    try:
+                        os.unlink(os.path.join(root, name))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, memory_entries=len(self.memory))
+
+
+class ResponseBodyStore:
+    """
+    Full text of finished responses, by sha256, for v2 clients that only got the
+    digest in the final event (GET /api/responses/<sha256>). Kept apart from user
+    attachments, and bounded: bodies expire after ttl_seconds and the least
+    recently used go first once the directory is over max_bytes.
+    """
+    SWEEP_EVERY = 32  # puts between disk size checks
+
+    def __init__(self, directory, ttl_seconds=86400, max_bytes=500 * 1024 * 1024):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.puts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".txt")
+
+    def put(self, text):
+        """Store a response body and return its sha256"""
+        body = text.encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            os.utime(path)  # same body again - keep it another TTL
+        else:
+            write_atomic(path, body)
+        with self.lock:
+            self.puts += 1
+            sweep = self.puts % self.SWEEP_EVERY == 0
+        if sweep:
+            sweep_directory(self.directory, ".txt", self.ttl_seconds, self.max_bytes)
+        return digest
+
+    def get(self, digest):
+        """The body stored under digest, or None if unknown or expired"""
+        path = self._path(digest)
+        try:
+            if os.path.getmtime(path) < time.time() - self.ttl_seconds:
+                return None
+            with open(path, "rb") as f:
+                return f.read().decode("utf-8")
+        except OSError:
+            return None
+
+
+def create_response_body_store():
+    """Response body store configured from RESPONSE_BODY_* environment variables"""
+    return ResponseBodyStore(
+        os.getenv("RESPONSE_BODY_DIR", "/tmp/fowazz-response-bodies"),
+        ttl_seconds=float(os.getenv("RESPONSE_BODY_TTL_SECONDS", "86400")),
+        max_bytes=int(os.getenv("RESPONSE_BODY_DISK_BYTES", str(500 * 1024 * 1024))),
+    )
+
+
+def create_response_cache():
+    """Response cache configured from RESPONSE_CACHE_* environment variables"""
+    return ResponseCache(
+        os.getenv("RESPONSE_CACHE_DIR", "/tmp/fowazz-response-cache"),
+        max_entries=int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "256")),
+        ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+        disk_max_bytes=int(os.getenv("RESPONSE_CACHE_DISK_BYTES", str(200 * 1024 * 1024))),
+        enabled=os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true",
+        max_temperature=float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "1.0")),
+    )
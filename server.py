@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 import sys
 import io
+import os
 
 # Gevent monkey patching for production (Railway with Gunicorn)
-try:
-    from gevent import monkey, sleep as gevent_sleep
-    monkey.patch_all()
-    GEVENT_AVAILABLE = True
-except ImportError:
-    GEVENT_AVAILABLE = False
+# (asgi.py turns it off with GEVENT_MONKEY_PATCH=false - asyncio needs the real sockets)
+GEVENT_AVAILABLE = False
+if os.getenv("GEVENT_MONKEY_PATCH", "true").lower() != "false":
+    try:
+        from gevent import monkey, sleep as gevent_sleep
+        monkey.patch_all()
+        GEVENT_AVAILABLE = True
+    except ImportError:
+        pass
+if not GEVENT_AVAILABLE:
     def gevent_sleep(t): pass  # No-op for local dev
 
 # Fix Windows console encoding for emojis
@@ -18,40 +23,157 @@ if sys.platform == 'win32':
 
 from flask import Flask, request, jsonify, Response
 from zai import ZhipuAiClient
-import os
 import json
+import math
+import base64
+import binascii
+import hashlib
+import hmac
 from flask_cors import CORS
 from dotenv import load_dotenv
 import stripe
 import requests
 import threading
+import time
+from collections import Counter
+
+from admission import create_adaptive_limiter, create_admission_backend, AdmissionQueue
+from conversations import create_conversation_store, new_owner_token, owned, owner_hash
+from context_budget import compact_messages, estimate_messages_tokens, estimate_text_tokens
+from artifacts import ArtifactEventParser, ContinuationStitcher, PatchStreamRewriter, extract_artifacts, latest_artifacts
+from site_builder import PLAN_PROMPT, build_pages, page_instruction, parse_plan
+from sse import ChunkFramer, coalescer_from_request, sse_event
+from response_cache import cache_key, create_response_body_store, create_response_cache
+from glm_pool import UpstreamUnavailable, create_glm_pool
+from glm_async import AsyncGLMClient
+from metrics import create_metrics
+from topic_filter import create_topic_filter
+from stream_traces import create_stream_recorder
+from subscription_cache import create_subscription_cache, update_from_event, user_id_from_jwt
+from streams import (
+    STREAM_ID_RE, Cancellation, close_upstream, create_stream_store, follow, parse_last_event_id, produce
+)
+from account_deletion import JOB_ID_RE, create_account_deleter, public_job
+from attachments import (
+    ALLOWED_MEDIA_TYPES, DIGEST_RE, MEDIA_EXTENSIONS, AttachmentError, AttachmentQuotaError, create_attachment_store,
+    expand_attachments, has_inline_attachments, intern_attachments, missing_attachments, sniff_media_type
+)
 
 load_dotenv()
 
-# Thread-safe connection counter for concurrent user limit
-class ConnectionCounter:
-    def __init__(self, max_connections=16):
-        self.count = 0
-        self.max = max_connections
-        self.lock = threading.Lock()
-
-    def try_acquire(self):
-        with self.lock:
-            if self.count >= self.max:
-                return False
-            self.count += 1
-            return True
-
-    def release(self):
-        with self.lock:
-            self.count = max(0, self.count - 1)
-
-    def get_count(self):
-        with self.lock:
-            return self.count
-
-# Max 16 concurrent AI chat connections
-active_connections = ConnectionCounter(max_connections=16)
+# Max concurrent AI chat connections - one global limit shared by every worker
+# (file lock on a single host, Redis across nodes; see admission.py)
+admission_backend = create_admission_backend()
+LEASE_RENEW_INTERVAL = admission_backend.lease_seconds / 3
+
+# When every slot is taken, requests wait in a bounded priority queue (per worker)
+# instead of getting an instant SITE_FULL. Paid plans are served first.
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "120"))
+active_connections = AdmissionQueue(admission_backend, max_waiting=ADMISSION_QUEUE_SIZE)
+# With ADAPTIVE_CONCURRENCY=true the limit follows GLM's speed (TTFT, tokens/sec) within
+# ADAPTIVE_MIN_USERS..ADAPTIVE_MAX_USERS instead of staying at MAX_CONCURRENT_USERS
+concurrency_limiter = create_adaptive_limiter(active_connections)
+PLAN_PRIORITY = {"max": 0, "pro": 1}  # everyone else (lite / no plan) gets 2
+
+# Server-side chat history so clients only send the new turn plus a conversation id
+conversation_store = create_conversation_store()
+
+# Images/PDFs stored once by sha256 digest; messages reference them instead of inlining base64
+attachment_store = create_attachment_store()
+
+# Input token budget for each GLM call (system prompt + history); older history is compacted to fit
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "64000"))
+CONTEXT_KEEP_RECENT = int(os.getenv("CONTEXT_KEEP_RECENT", "6"))
+
+# Truncated responses are continued automatically (same admission slot) up to this many times
+MAX_CONTINUATIONS = int(os.getenv("MAX_CONTINUATIONS", "3"))
+continuation_counts = Counter()  # continuations needed -> number of responses
+
+# Opt-in ("parallelBuild": true) multi-page builds: one short planning call, then every
+# page streams concurrently, each extra stream holding its own admission slot
+PARALLEL_BUILD_MAX_PAGES = int(os.getenv("PARALLEL_BUILD_MAX_PAGES", "7"))
+PLAN_MAX_TOKENS = int(os.getenv("PLAN_MAX_TOKENS", "2048"))
+
+# Upstream deltas are merged into fewer SSE frames (see sse.py); clients can override
+# with "flushBytes"/"flushMs" in the request body
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "512"))
+SSE_FLUSH_MS = float(os.getenv("SSE_FLUSH_MS", "30"))
+
+# Opt-in ("thinkingProgress": true) progress events while the model is still reasoning,
+# at most one per THINKING_PROGRESS_INTERVAL_SECONDS; the reasoning text itself is never sent
+THINKING_PROGRESS_INTERVAL = float(os.getenv("THINKING_PROGRESS_INTERVAL_SECONDS", "1"))
+
+# Clients sending "X-Fowazz-Stream-Version: 2" get a final event with the response's
+# sha256/length instead of the whole text again; the body is kept for a while in its
+# own bounded store (RESPONSE_BODY_*) and can be fetched from /api/responses/<sha256>
+STREAM_VERSION_HEADER = "X-Fowazz-Stream-Version"
+response_body_store = create_response_body_store()
+
+# Responses are generated in the background into a resumable event log, so a dropped
+# client can reconnect with Last-Event-ID instead of starting a new generation.
+# Generation stops once no client has followed it for STREAM_DETACHED_TTL_SECONDS.
+stream_store = create_stream_store()
+STREAM_DETACHED_TTL = float(os.getenv("STREAM_DETACHED_TTL_SECONDS", "60"))
+STREAM_ID_HEADER = "X-Fowazz-Stream-Id"
+
+# Clients that will reconnect send "X-Fowazz-Resumable: 1" and get the detached TTL;
+# for everyone else generation is cancelled (upstream closed, slot freed) on disconnect
+RESUMABLE_HEADER = "X-Fowazz-Resumable"
+generation_stats = Counter()  # completed/aborted generations and their (estimated) tokens, per worker
+
+# Identical requests from the same user/conversation while the first is still generating
+# (double submits, retries, a second tab) follow the running stream instead of starting another
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+SINGLE_FLIGHT_TTL = float(os.getenv("SINGLE_FLIGHT_TTL_SECONDS", "900"))
+disconnect_handlers = {}  # stream id -> cancel-on-disconnect callback, for generations running in this worker
+idle_handlers = {}  # stream id -> flushes text the coalescer has held too long, for generations running in this worker
+
+# Off-topic requests (homework, essays, medical advice...) are turned away before any upstream
+# call; English + Arabic keywords compiled once, see topic_filter.py for TOPIC_CLASSIFIER
+topic_filter = create_topic_filter()
+
+# Opt-in: sanitized per-chunk timing traces of upstream streams, for replay_traces.py
+stream_recorder = create_stream_recorder()
+
+# Opt-in ("cache": true) cache of complete responses for repeatable prompts like "surprise me".
+# Admins can switch it off, or stop caching above a temperature, via /api/admin/response-cache
+response_cache = create_response_cache()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Per-stream timing plus the per-worker counters above, as Prometheus metrics on /metrics
+# (merged across gunicorn workers through METRICS_DIR; METRICS_TOKEN is required unless METRICS_PUBLIC=true)
+metrics = create_metrics()
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "false").lower() == "true"  # serve /metrics without a token
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RATE_BUCKETS = (5, 10, 20, 30, 40, 60, 80, 100, 150, 200, 300)
+admission_wait_seconds = metrics.histogram("fowazz_admission_wait_seconds", "Time from request to admission slot")
+upstream_connect_seconds = metrics.histogram("fowazz_upstream_connect_seconds", "Time to open the GLM stream")
+first_reasoning_seconds = metrics.histogram("fowazz_first_reasoning_token_seconds", "GLM request to first reasoning token")
+first_content_seconds = metrics.histogram("fowazz_first_content_token_seconds", "GLM request to first content token")
+content_tokens_per_second = metrics.histogram("fowazz_content_tokens_per_second", "Content tokens/sec after the first one", buckets=RATE_BUCKETS)
+stream_duration_seconds = metrics.histogram("fowazz_stream_duration_seconds", "Request to last event", ["outcome"])
+stream_bytes = metrics.histogram("fowazz_stream_bytes", "SSE bytes produced per response", buckets=SIZE_BUCKETS)
+stream_finish_total = metrics.counter("fowazz_stream_finish_total", "Responses by outcome and GLM finish_reason", ["outcome", "finish_reason"])
+generations_total = metrics.counter("fowazz_generations_total", "Completed and aborted generations", ["outcome"])
+generated_tokens_total = metrics.counter("fowazz_generated_tokens_total", "Estimated output tokens", ["outcome"])
+saved_tokens_total = metrics.counter("fowazz_saved_tokens_total", "Estimated tokens not generated thanks to cancellation")
+continuations_total = metrics.counter("fowazz_responses_by_continuations_total", "Responses by automatic continuations needed", ["continuations"])
+response_cache_total = metrics.counter("fowazz_response_cache_total", "Response cache lookups and stores", ["result"])
+response_cache_entries = metrics.gauge("fowazz_response_cache_memory_entries", "Entries in the in-memory cache tiers")
+upstream_requests_total = metrics.counter("fowazz_glm_upstream_requests_total", "GLM requests per key", ["upstream"])
+upstream_failures_total = metrics.counter("fowazz_glm_upstream_failures_total", "Failed GLM requests per key", ["upstream"])
+upstream_rate_limited_total = metrics.counter("fowazz_glm_upstream_rate_limited_total", "429 responses per key", ["upstream"])
+upstream_circuit_opens_total = metrics.counter("fowazz_glm_upstream_circuit_opens_total", "Times a key's circuit opened", ["upstream"])
+upstream_outstanding = metrics.gauge("fowazz_glm_upstream_outstanding", "GLM requests in flight per key", ["upstream"])
+upstream_circuit_open = metrics.gauge("fowazz_glm_upstream_circuit_open", "Workers that currently skip this key", ["upstream"])
+model_fallbacks_total = metrics.counter("fowazz_glm_model_fallbacks_total", "Requests moved off a model breaching its TTFT SLO", ["model"])
+admission_limit = metrics.gauge("fowazz_admission_limit", "Current admission limit", aggregate="max")
+admission_active = metrics.gauge("fowazz_admission_active", "Admission slots in use", aggregate="max")
+admission_queued = metrics.gauge("fowazz_admission_queued", "Requests waiting for a slot")
+admission_limit_changes_total = metrics.counter("fowazz_admission_limit_changes_total", "Adaptive limit changes by cause", ["cause"])
+admission_limit_cause = metrics.gauge("fowazz_admission_limit_cause", "Cause of the last adaptive limit change seen by each worker", ["cause"])
 
 app = Flask(__name__)
 
@@ -61,16 +183,36 @@ allowed_origins = os.getenv("FRONTEND_URL", "http://localhost:3000").split(",")
 CORS(app, origins=allowed_origins, supports_credentials=True)
 
 # GLM-4.6 API Configuration (Official ZAI SDK with advanced features)
+# GLM_API_KEYS (comma separated) spreads load over several keys with per-key budgets and
+# circuit breakers; the SDK retries once per key, the pool fails over to the next key
 GLM_API_KEY = os.getenv("GLM_API_KEY")
-client = ZhipuAiClient(api_key=GLM_API_KEY) if GLM_API_KEY else None
+glm_pool = create_glm_pool(
+    lambda api_key, base_url: ZhipuAiClient(api_key=api_key, base_url=base_url, max_retries=1),
+    async_client_factory=lambda api_key, base_url: AsyncGLMClient(api_key, base_url)  # only used by asgi.py
+)
+GLM_MODEL = "glm-4.6"
+GLM_TEMPERATURE = 0.95
+GLM_MAX_TOKENS = 8192  # GLM-4.6 supports up to 8192 output tokens
 
 # Stripe configuration
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 stripe.api_key = STRIPE_SECRET_KEY
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+
+# Subscription status, plan_name and website_limit kept locally from Stripe webhooks
+# (subscription_cache.py), so plan checks don't need Supabase
+subscription_cache = create_subscription_cache()
 
 # Supabase configuration for admin operations
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+# With the project's JWT secret, access tokens are checked locally instead of via /auth/v1/user
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+
+# Account deletions run as resumable background jobs (account_deletion.py)
+account_deleter = create_account_deleter(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+if account_deleter.configured:
+    account_deleter.start()
 
 SYSTEM_PROMPT = """You are Fowazz — an elite web designer and developer. You build websites that look like a team of professional designers spent months on them. Not generic AI templates. Not basic layouts. Real, premium work. Built by FawzSites.com.
 
@@ -704,156 +846,1144 @@ The [INCOMPLETE] marker tells the frontend to show artifacts as code instead of
 You're an elite designer who builds REAL business websites. Not tech startup landing pages. Not SaaS marketing sites. REAL businesses with REAL customers. Clean. Professional. Timeless.
 """
 
-@app.route("/api/message", methods=["POST"])
-def message():
-    # Check if site is at capacity BEFORE doing anything
-    if not active_connections.try_acquire():
-        print(f"🚫 Site at capacity! {active_connections.get_count()}/{active_connections.max} connections")
-        return jsonify({
-            "error": "SITE_FULL",
-            "message": "Fowazz is at capacity right now. Too many people are building websites simultaneously. Please try again in a few minutes!",
-            "current_users": active_connections.get_count(),
-            "max_users": active_connections.max
-        }), 503  # Service Unavailable
+# Short-lived cache of plan lookups so queued users don't hit Supabase on every request
+plan_cache = {}
+plan_cache_lock = threading.Lock()
+PLAN_CACHE_SECONDS = 300
+
+def get_user_plan(auth_header):
+    """Look up the active plan name for the user behind a Supabase JWT (None if unknown)"""
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+
+    # Webhook-fed subscription cache first - no network when the token can be checked locally
+    user_id = user_id_from_jwt(auth_header, SUPABASE_JWT_SECRET)
+    now = time.monotonic()
+    with plan_cache_lock:
+        cached = plan_cache.get(auth_header)
+    if cached and cached[2] > now:
+        user_id = user_id or cached[0]
+    if user_id:
+        entitlement = subscription_cache.entitlement(user_id)
+        if entitlement is not None:
+            return entitlement["plan_name"]
+    if cached and cached[2] > now:
+        return cached[1]
+
+    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
+        return None
+
+    plan = None
+    try:
+        # Resolve the token to a user, then read their active subscription
+        user_response = requests.get(
+            f"{SUPABASE_URL}/auth/v1/user",
+            headers={'apikey': SUPABASE_SERVICE_ROLE_KEY, 'Authorization': auth_header},
+            timeout=3
+        )
+        if user_response.status_code == 200:
+            user_id = user_response.json().get("id")
+            entitlement = subscription_cache.entitlement(user_id)
+            if entitlement is not None:
+                plan = entitlement["plan_name"]
+            else:
+                subscription_response = requests.get(
+                    f"{SUPABASE_URL}/rest/v1/subscriptions",
+                    params={'select': 'plan_name', 'user_id': f'eq.{user_id}', 'status': 'eq.active'},
+                    headers={
+                        'apikey': SUPABASE_SERVICE_ROLE_KEY,
+                        'Authorization': f'Bearer {SUPABASE_SERVICE_ROLE_KEY}'
+                    },
+                    timeout=3
+                )
+                if subscription_response.status_code == 200 and subscription_response.json():
+                    plan = (subscription_response.json()[0].get("plan_name") or "").lower().strip() or None
+    except Exception as e:
+        print(f"⚠️ Plan lookup failed: {str(e)}")
+        return None
+
+    with plan_cache_lock:
+        # The token's user is kept too, so later checks can go to the subscription cache
+        plan_cache[auth_header] = (user_id, plan, now + PLAN_CACHE_SECONDS)
+        if len(plan_cache) > 10000:
+            plan_cache.clear()
+    return plan
+
+# Token -> Supabase user id, for endpoints that need to know who is calling
+token_users = {}
+token_users_lock = threading.Lock()
+
+def get_user_id(auth_header):
+    """Supabase user id behind a Bearer token, or None - checked locally first when SUPABASE_JWT_SECRET is set"""
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    user_id = user_id_from_jwt(auth_header, SUPABASE_JWT_SECRET)
+    if user_id or not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
+        return user_id
+
+    now = time.monotonic()
+    with token_users_lock:
+        cached = token_users.get(auth_header)
+        if cached and cached[1] > now:
+            return cached[0]
+    try:
+        response = requests.get(
+            f"{SUPABASE_URL}/auth/v1/user",
+            headers={'apikey': SUPABASE_SERVICE_ROLE_KEY, 'Authorization': auth_header},
+            timeout=3
+        )
+    except Exception as e:
+        print(f"⚠️ User lookup failed: {str(e)}")
+        return None
+    user_id = response.json().get("id") if response.status_code == 200 else None
+    with token_users_lock:
+        token_users[auth_header] = (user_id, now + PLAN_CACHE_SECONDS)
+        if len(token_users) > 10000:
+            token_users.clear()
+    return user_id
+
+def get_request_priority():
+    """Queue priority for the current request - paid plans go first"""
+    return PLAN_PRIORITY.get(get_user_plan(request.headers.get('Authorization')), 2)
+
+# Added to the system prompt once the conversation already has pages, so small
+# tweaks come back as patches (applied server-side) instead of whole pages
+EDIT_MODE_PROMPT = """
+
+## EDITING EXISTING PAGES - USE PATCHES:
+
+The site already exists - the latest version of every page is in the conversation above.
+
+For small or medium changes (colors, text, a section, a button, fixing something), DON'T rewrite the whole page. Output a patch instead:
+
+[ARTIFACT:PATCH:index.html]
+<<<<<<< SEARCH
+        <h1>Welcome to Our Business</h1>
+=======
+        <h1>Welcome to Joe's Coffee</h1>
+>>>>>>> REPLACE
+[ARTIFACT:END]
 
-    connection_acquired = True
-    print(f"✅ Connection acquired ({active_connections.get_count()}/{active_connections.max} active)")
+**PATCH RULES:**
+1. SEARCH must be copied EXACTLY from the current version of the page, including indentation - whole lines only
+2. Include 2-3 surrounding lines so the SEARCH text only matches one place
+3. Put several SEARCH/REPLACE blocks in one patch when changing several spots in the same page
+4. One [ARTIFACT:PATCH:...] per page you change - pages you don't touch stay as they are
+5. For a full redesign or a NEW page, output the complete [ARTIFACT:START:...] artifact like usual
+"""
 
-    try:
-        if client is None:
-            active_connections.release()
-            return jsonify({
-                "error": "Server missing GLM_API_KEY. Set it in .env and restart the server."
-            }), 500
+# Sent after a response hits max_tokens, so the model picks up where it stopped
+CONTINUE_PROMPT = """[CONTINUE] Your last response was cut off by the length limit. Continue EXACTLY from the last character you wrote.
+- No intro, no [TITLE], don't repeat anything you already wrote
+- If you were in the middle of an artifact, keep writing its code directly (do NOT write [ARTIFACT:START:...] again) and close it with [ARTIFACT:END]
+- Then finish the rest of the response as planned"""
+
+SYSTEM_PROMPT_TOKENS = estimate_text_tokens(SYSTEM_PROMPT)
+EDIT_MODE_PROMPT_TOKENS = estimate_text_tokens(EDIT_MODE_PROMPT)
+
+class GLMRounds:
+    """
+    What stream_glm does besides reading GLM, shared with asgi.stream_glm_async: the
+    messages of each continuation round, stitching a continuation onto what came
+    before, stats, and turning each chunk into content text and thinking events.
+    No I/O - the caller opens the rounds and reads the chunks.
+    """
+
+    def __init__(self, zai_messages, stats, thinking=True, thinking_interval=None):
+        self.zai_messages = zai_messages
+        self.stats = stats
+        self.thinking = thinking
+        self.thinking_interval = thinking_interval
+        self.raw_content = ""  # exactly what the model wrote, across continuation rounds
+        self.last_thinking = None  # when the last thinking event went out, None once the content started
+        self.stitcher = None
+        self.round_start = 0
+        self.round_reasoning = 0
+        stats.update(finish_reason=None, continuations=0, reasoning_chars=0, started_at=time.monotonic())
+
+    def start_round(self):
+        """(messages, thinking) for the next request to GLM"""
+        round_messages = self.zai_messages
+        self.stitcher = None
+        if self.stats["continuations"]:
+            round_messages = self.zai_messages + [
+                {"role": "assistant", "content": self.raw_content},
+                {"role": "user", "content": CONTINUE_PROMPT}
+            ]
+            self.stitcher = ContinuationStitcher(self.raw_content)
+        self.stats["finish_reason"] = None
+        self.round_start = len(self.raw_content)
+        self.round_reasoning = self.stats["reasoning_chars"]
+        # Continuations skip thinking - the plan was already made
+        return round_messages, self.thinking and not self.stats["continuations"]
+
+    def chunk(self, chunk):
+        """Content text pieces and ("thinking", {...}) events for one streamed chunk"""
+        stats = self.stats
+        stats.setdefault("first_token_at", time.monotonic())
+        delta = chunk.choices[0].delta
+        out = []
+
+        # Capture hidden reasoning (chain-of-thought)
+        # We don't send this to the user, but it helps the model think better
+        reasoning = getattr(delta, 'reasoning_content', None)
+        if reasoning:
+            stats.setdefault("first_reasoning_at", time.monotonic())
+            stats["reasoning_chars"] += len(reasoning)
+            if self.thinking_interval is not None and "first_content_at" not in stats:
+                now = time.monotonic()
+                if self.last_thinking is None or now - self.last_thinking >= self.thinking_interval:
+                    self.last_thinking = now
+                    out.append(("thinking", thinking_progress(stats, now)))
+
+        if delta.content:
+            stats.setdefault("first_content_at", time.monotonic())
+            if self.last_thinking is not None:
+                self.last_thinking = None
+                out.append(("thinking", dict(thinking_progress(stats, time.monotonic()), done=True)))
+            text = self.stitcher.feed(delta.content) if self.stitcher else delta.content
+            self.raw_content += text
+            out.append(text)
+
+        if chunk.choices[0].finish_reason:
+            stats["finish_reason"] = chunk.choices[0].finish_reason
+        return out
+
+    def round_output_tokens(self):
+        """Estimated tokens GLM produced in the current round, for the key's budget"""
+        return estimate_text_tokens(self.raw_content[self.round_start:]) + \
+            (self.stats["reasoning_chars"] - self.round_reasoning) // 4
+
+    def end_round(self):
+        """Text the stitcher still held back at the end of a round"""
+        text = self.stitcher.finish() if self.stitcher else ""
+        self.raw_content += text
+        return [text] if text else []
+
+    def next_round(self):
+        """Whether the response was cut off and gets another continuation round"""
+        stats = self.stats
+        if stats["finish_reason"] != "length" or stats["continuations"] >= MAX_CONTINUATIONS:
+            return False
+        stats["continuations"] += 1
+        print(f"⏩ Response hit the token limit, continuing automatically ({stats['continuations']}/{MAX_CONTINUATIONS})")
+        return True
+
+def stream_glm(model, zai_messages, stats, keep_alive=None, thinking=True, cancel=None, thinking_interval=None,
+               trace=None):
+    """
+    Stream content text from GLM, continuing automatically when a round hits max_tokens.
+    Yields text pieces; fills stats with finish_reason, continuations and reasoning_chars.
+    With thinking_interval, also yields ("thinking", {...}) at most that often while the
+    model reasons, and once more with done=True when the content starts.
+    If cancel (a streams.Cancellation) fires, the upstream HTTP stream is closed at once.
+    With trace (a stream_traces.StreamTrace), every round's chunk timing is recorded.
+    """
+    rounds = GLMRounds(zai_messages, stats, thinking, thinking_interval)
+
+    while not (cancel and cancel.cancelled):
+        # Stream response from GLM-4.6 with thinking mode enabled
+        round_messages, round_thinking = rounds.start_round()
+        trace_round = trace.round(stats["continuations"], round_thinking) if trace else None
+        try:
+            stream, upstream = glm_pool.create(
+                model,
+                estimate_messages_tokens(round_messages),
+                messages=round_messages,
+                max_tokens=GLM_MAX_TOKENS,
+                temperature=GLM_TEMPERATURE,
+                stream=True,
+                thinking={"type": "enabled" if round_thinking else "disabled"}
+            )
+        except Exception as e:
+            if trace_round:
+                trace_round.failed(e)
+            raise
+        stats.setdefault("connected_at", time.monotonic())
+        if trace_round:
+            trace_round.connected()
+        if cancel:
+            cancel.register(stream)
+
+        error = None
+        try:
+            for chunk in stream:
+                if cancel and cancel.cancelled:
+                    return
+                upstream.first_token()
+                if trace_round:
+                    delta = chunk.choices[0].delta
+                    trace_round.chunk(getattr(delta, "reasoning_content", None), delta.content, chunk.choices[0].finish_reason)
+                if keep_alive:
+                    keep_alive()
+                yield from rounds.chunk(chunk)
+        except Exception as e:
+            # A read failing because we closed the stream on cancel isn't the key's fault
+            if not (cancel and cancel.cancelled):
+                error = e
+                if trace_round:
+                    trace_round.failed(e)
+            raise
+        finally:
+            # Also runs when our consumer stops early - don't leave GLM generating for nobody
+            if cancel:
+                cancel.unregister(stream)
+            close_upstream(stream)
+            if error is not None:
+                upstream.fail(error, rounds.round_output_tokens())
+            else:
+                upstream.release(rounds.round_output_tokens())
 
-        data = request.get_json()
-        messages = data.get("messages", [])
+        yield from rounds.end_round()
+        if not rounds.next_round():
+            return
 
-        if not messages:
-            active_connections.release()
-            return jsonify({"error": "No messages provided"}), 400
+def thinking_progress(stats, now):
+    """What a thinking event tells the client: how much reasoning so far, and for how long"""
+    return {"chars": stats["reasoning_chars"], "seconds": round(now - stats["first_reasoning_at"], 1)}
+
+def plan_site(model, zai_messages):
+    """Ask GLM for a build plan (pages, shared nav, design tokens); None if it isn't ready to build"""
+    try:
+        plan_messages = zai_messages + [{"role": "user", "content": PLAN_PROMPT}]
+        response, upstream = glm_pool.create(
+            model,
+            estimate_messages_tokens(plan_messages),
+            messages=plan_messages,
+            max_tokens=PLAN_MAX_TOKENS,
+            temperature=0.6,
+            stream=False,
+            thinking={"type": "disabled"}
+        )
+        text = None
+        try:
+            text = response.choices[0].message.content
+        finally:
+            upstream.release(estimate_text_tokens(text or ""))
+        return parse_plan(text, PARALLEL_BUILD_MAX_PAGES)
+    except Exception as e:
+        print(f"⚠️ Build planning failed, building serially: {str(e)}")
+        return None
+
+def stream_site_parallel(model, zai_messages, plan, stats, concurrency, keep_alive=None, cancel=None, trace=None):
+    """
+    Build every page of plan concurrently and stream the merged response in plan order.
+    Yields ("chunk", text) and ("progress", {...}) events; fills stats like stream_glm.
+    """
+    stats.update(finish_reason=None, continuations=0, reasoning_chars=0, started_at=time.monotonic())
+    page_stats = []
+
+    def stream_page(page):
+        page_stat = {}
+        page_stats.append(page_stat)
+        page_messages = zai_messages + [{"role": "user", "content": page_instruction(plan, page)}]
+        page_trace = trace.page(plan["pages"].index(page)) if trace else None
+        return stream_glm(model, page_messages, page_stat, cancel=cancel, trace=page_trace)
+
+    title = str(plan.get("title") or "").strip()
+    if title:
+        yield ("chunk", f"[TITLE:{title}]\n\n")
+    if plan.get("intro"):
+        yield ("chunk", str(plan["intro"]).strip() + "\n\n")
+
+    yield from build_pages(plan, stream_page, concurrency, keep_alive)
+
+    if plan.get("closing"):
+        yield ("chunk", "\n\n" + str(plan["closing"]).strip())
+
+    # Timing of the whole build is that of its quickest page
+    for key in ("connected_at", "first_reasoning_at", "first_content_at", "first_token_at"):
+        times = [page_stat[key] for page_stat in page_stats if key in page_stat]
+        if times:
+            stats[key] = min(times)
+    for page_stat in page_stats:
+        stats["continuations"] += page_stat.get("continuations", 0)
+        stats["reasoning_chars"] += page_stat.get("reasoning_chars", 0)
+        if page_stat.get("finish_reason") == "length":
+            stats["finish_reason"] = "length"
+
+def record_generation(output_tokens, aborted):
+    """Count a finished or aborted generation; tokens saved are estimated from the average completed response"""
+    if not aborted:
+        generation_stats["completed"] += 1
+        generation_stats["completed_tokens"] += output_tokens
+        return
+    generation_stats["aborted"] += 1
+    generation_stats["aborted_tokens"] += output_tokens
+    if generation_stats["completed"]:
+        average = generation_stats["completed_tokens"] // generation_stats["completed"]
+        generation_stats["saved_tokens"] += max(0, average - output_tokens)
+    print(f"🛑 Generation aborted after ~{output_tokens} tokens ({generation_stats['aborted']} aborted, ~{generation_stats['saved_tokens']} tokens saved so far)")
+
+def observe_stream_speed(stats, content):
+    """Report a finished stream's time to first token and tokens/sec to the adaptive limiter"""
+    now = time.monotonic()
+    ttft = stats["first_token_at"] - stats["started_at"]
+    generating = now - stats["first_token_at"]
+    if generating < 1.0:
+        return  # too short to say anything about throughput
+    tokens = estimate_text_tokens(content) + stats["reasoning_chars"] // 4
+    concurrency_limiter.observe(ttft, tokens / generating)
+
+def stream_timing(stats, content):
+    """Upstream timing of a finished stream from the timestamps stream_glm left in its stats"""
+    now = time.monotonic()
+    started = stats.get("started_at")
+    timing = {}
+    if started is None:
+        return timing
+    for name, key in (("upstream_connect", "connected_at"), ("first_reasoning", "first_reasoning_at"),
+                      ("first_content", "first_content_at")):
+        if key in stats:
+            timing[name] = round(stats[key] - started, 3)
+    if "first_content_at" in stats and now - stats["first_content_at"] > 0.5:
+        timing["content_tokens_per_sec"] = round(estimate_text_tokens(content) / (now - stats["first_content_at"]), 1)
+    return timing
+
+def record_stream_timing(timing):
+    """Export one response's timing to /metrics and log it as a single structured line"""
+    for name, histogram in (("admission_wait", admission_wait_seconds), ("upstream_connect", upstream_connect_seconds),
+                            ("first_reasoning", first_reasoning_seconds), ("first_content", first_content_seconds),
+                            ("content_tokens_per_sec", content_tokens_per_second)):
+        if timing.get(name) is not None:
+            histogram.observe(timing[name])
+    stream_duration_seconds.observe(timing["duration"], outcome=timing["outcome"])
+    stream_bytes.observe(timing["bytes"])
+    stream_finish_total.inc(outcome=timing["outcome"], finish_reason=timing.get("finish_reason") or "none")
+    print(f"⏱️ Stream timing {json.dumps(timing)}")
+
+def instrumented(events, timing, received_at):
+    """Count the bytes a response produces, then record its timing once it is over"""
+    try:
+        for event in events:
+            timing["bytes"] += len(event.encode("utf-8"))
+            yield event
+    finally:
+        events.close()
+        timing["outcome"] = timing["outcome"] or "interrupted"
+        timing["duration"] = round(time.monotonic() - received_at, 3)
+        record_stream_timing(timing)
+
+def collect_metrics():
+    """Mirror the counters kept elsewhere in this worker into the metrics registry"""
+    for outcome in ("completed", "aborted"):
+        generations_total.set_total(generation_stats[outcome], outcome=outcome)
+        generated_tokens_total.set_total(generation_stats[f"{outcome}_tokens"], outcome=outcome)
+    saved_tokens_total.set_total(generation_stats["saved_tokens"])
+    for continuations, count in list(continuation_counts.items()):
+        continuations_total.set_total(count, continuations=continuations)
+
+    cache_stats = response_cache.stats()
+    response_cache_entries.set(cache_stats.pop("memory_entries", 0))
+    for result, count in cache_stats.items():
+        response_cache_total.set_total(count, result=result)
+
+    pool_stats = glm_pool.stats()
+    for upstream in pool_stats["upstreams"]:
+        name = upstream["name"]
+        upstream_requests_total.set_total(upstream.get("requests", 0), upstream=name)
+        upstream_failures_total.set_total(upstream.get("failures", 0), upstream=name)
+        upstream_rate_limited_total.set_total(upstream.get("rate_limited", 0), upstream=name)
+        upstream_circuit_opens_total.set_total(upstream.get("opened", 0), upstream=name)
+        upstream_outstanding.set(upstream["outstanding"], upstream=name)
+        upstream_circuit_open.set(0 if upstream["state"] == "closed" else 1, upstream=name)
+    for model, model_stats in pool_stats["models"].items():
+        model_fallbacks_total.set_total(model_stats["fallbacks"], model=model)
+
+    admission_limit.set(active_connections.max)
+    admission_active.set(active_connections.get_count())
+    admission_queued.set(active_connections.get_waiting())
+    if concurrency_limiter:
+        limiter_stats = concurrency_limiter.stats()
+        for cause, count in limiter_stats["changes_by_cause"].items():
+            admission_limit_changes_total.set_total(count, cause=cause)
+        admission_limit_cause.clear()
+        admission_limit_cause.set(1, cause=limiter_stats["cause"])
+
+metrics.add_collector(collect_metrics)
+
+SITE_FULL_MESSAGE = "Fowazz is at capacity right now. Too many people are building websites simultaneously. Please try again in a few minutes!"
+TRUNCATION_WARNING = "\n\n⚠️ **Response was cut off** - The page might be incomplete. Just ask me to **\"complete the page\"** or **\"finish the last file\"** and I'll continue from where I stopped!"
+
+def site_full_payload(**fields):
+    """The SITE_FULL error: a 503 body, or with done=True the last event of a request whose queue wait expired"""
+    return {"error": "SITE_FULL", "message": SITE_FULL_MESSAGE, **fields}
+
+def response_events(req, patcher, kind, text):
+    """SSE events for one piece of a generation (text, or a progress/thinking event) and the response text it adds"""
+    if kind in ("progress", "thinking"):
+        return req.framer.flush() + [sse_event({kind: text, 'done': False})], ""
+    if patcher:
+        text = patcher.feed(text)
+    if not text:
+        return [], ""
+    # Deltas are merged and sent as one chunk event once enough bytes/time piled up
+    return req.framer.add(text), text
+
+def closing_events(req, patcher, stream_stats):
+    """SSE events once GLM is done (last patches, truncation warning, final flush) and the response text they add"""
+    continuations = stream_stats["continuations"]
+    continuation_counts[continuations] += 1
+    if continuations:
+        print(f"⏩ Response needed {continuations} continuation(s)")
+
+    events, text = [], ""
+    if patcher:
+        text = patcher.finish()
+        events += req.framer.add(text)
+        if patcher.applied or patcher.failed:
+            print(f"🩹 Applied {len(patcher.applied)} patch(es), {len(patcher.failed)} failed")
+
+    # Log total reasoning tokens used (for debugging)
+    if stream_stats["reasoning_chars"]:
+        print(f"🧠 Used {stream_stats['reasoning_chars']} chars of reasoning")
+
+    # Check if response was still truncated after every continuation
+    if stream_stats["finish_reason"] == "length":
+        # The page that was cut off ends here, not after the warning
+        events += req.framer.flush(finish=True)
+        text += TRUNCATION_WARNING
+        events += req.framer.add(TRUNCATION_WARNING)
+    return events + req.framer.flush(finish=True), text
+
+def remember_exchange(req, full_content, finish_reason, context_stats):
+    """Store a finished exchange in the conversation and the response cache"""
+    if req.conversation_id:
+        conversation_store.append(req.conversation_id, req.new_message, {"role": "assistant", "content": full_content})
+        conversation_store.put_artifacts(req.conversation_id, extract_artifacts(full_content))
+    if req.cache_key and finish_reason != "length":
+        response_cache.put(req.cache_key, {'content': full_content, 'context': context_stats})
+
+def final_event(full_content, stream_version, **fields):
+    """Last SSE event - v1 clients get the full content again, v2 clients a digest they can fetch later"""
+    final = dict(done=True, **fields)
+    if stream_version >= 2:
+        try:
+            final['responseId'] = response_body_store.put(full_content)
+            final.update(sha256=final['responseId'], length=len(full_content), bytes=len(full_content.encode("utf-8")))
+            return sse_event(final)
+        except OSError as e:
+            print(f"⚠️ Couldn't store response body, sending it inline: {str(e)}")
+    final['content'] = full_content
+    return sse_event(final)
+
+def stream_response(stream_id, after=0, headers=None, on_disconnect=None):
+    """SSE response following a stream from seq `after`"""
+    return Response(
+        follow(stream_store, stream_id, after, on_disconnect=on_disconnect, on_idle=idle_handlers.get(stream_id)),
+        mimetype='text/event-stream',
+        headers={STREAM_ID_HEADER: stream_id, **(headers or {})}
+    )
+
+def cached_response_events(cached, req, stream_version):
+    """SSE events of a cached response through the normal framing, ending with the final event"""
+    content = cached['content']
+    for start in range(0, len(content), 256):
+        yield from req.framer.add(content[start:start + 256])
+    yield from req.framer.flush(finish=True)
+    if req.conversation_id:
+        conversation_store.append(req.conversation_id, req.new_message, {"role": "assistant", "content": content})
+        conversation_store.put_artifacts(req.conversation_id, extract_artifacts(content))
+    yield final_event(content, stream_version, context=cached.get('context'), continuations=0, cached=True)
+
+def replay_cached_response(cached, req, stream_version):
+    """Stream a cached response as fast as the client reads it"""
+    stream_id = stream_store.create()
+    threading.Thread(
+        target=produce, args=(stream_store, stream_id, cached_response_events(cached, req, stream_version),
+                              STREAM_DETACHED_TTL, Cancellation()), daemon=True
+    ).start()
+    return stream_response(stream_id, headers={STREAM_VERSION_HEADER: str(stream_version)})
+
+def single_flight_key(system_prompt, messages, conversation_id, model, stream_version, parallel_build, thinking_events,
+                      artifact_events):
+    """Identifies "the same request from the same user": its normalized content plus who sent it"""
+    authorization = request.headers.get('Authorization')
+    if conversation_id:
+        scope = "conversation:" + conversation_id
+    elif authorization:
+        scope = "user:" + hashlib.sha256(authorization.encode()).hexdigest()
+    else:
+        scope = "ip:" + (request.headers.get('X-Forwarded-For', request.remote_addr) or "")
+    return cache_key(system_prompt, messages, {
+        "scope": scope, "model": model, "stream_version": stream_version, "parallel": parallel_build,
+        "thinking_events": thinking_events, "artifact_events": artifact_events
+    })
+
+def end_unstarted_stream(stream_id, error):
+    """A single-flight stream whose generation never started - tell anyone who joined it"""
+    stream_store.append(stream_id, sse_event({'error': error, 'done': True}))
+    stream_store.finish(stream_id)
+
+class BadMessageRequest(Exception):
+    """A /api/message body that can't be answered; payload is the JSON error response"""
+
+    def __init__(self, payload, status=400):
+        super().__init__(payload["error"])
+        self.payload = payload
+        self.status = status
+
+class MessageRequest:
+    """A validated /api/message body and what it asks for - shared by the Flask and ASGI handlers"""
+
+    def __init__(self, data, auth_header=None):
+        self.conversation_id = data.get("conversationId")
+        self.new_message = None
+
+        if self.conversation_id:
+            # Stored conversation: the client only sends the latest user turn
+            self.new_message = data.get("message")
+            if isinstance(self.new_message, str):
+                self.new_message = {"role": "user", "content": self.new_message}
+            if not self.new_message:
+                raise BadMessageRequest({"error": "No message provided"})
+            # Same answer for a wrong token as for an unknown id
+            history = conversation_store.get(self.conversation_id) \
+                if owned(conversation_store, self.conversation_id, data.get("conversationToken")) else None
+            if history is None:
+                raise BadMessageRequest({"error": "CONVERSATION_NOT_FOUND"}, 404)
+            # Keep inline files out of the stored history - they're saved once by digest, like an upload
+            if has_inline_attachments(self.new_message):
+                owner = get_user_id(auth_header)
+                if not owner:
+                    raise BadMessageRequest({"error": "Unauthorized"}, 401)
+                try:
+                    self.new_message = intern_attachments(attachment_store, self.new_message, owner)
+                except AttachmentQuotaError as e:
+                    raise BadMessageRequest({"error": str(e)}, 413)
+            self.messages = history + [self.new_message]
+        else:
+            self.messages = data.get("messages", [])
+
+        if not self.messages:
+            raise BadMessageRequest({"error": "No messages provided"})
+
+        # Only the turn being sent has to be complete; files evicted from earlier turns
+        # are replaced by a note when the upstream call is built (expand_attachments)
+        missing = missing_attachments(attachment_store, self.messages[-1:])
+        if missing:
+            raise BadMessageRequest({"error": "ATTACHMENT_NOT_FOUND", "missing": missing})
+
+        # Pages built so far - once there are some, small edits come back as patches
+        if self.conversation_id:
+            self.artifacts = conversation_store.get_artifacts(self.conversation_id)
+        else:
+            self.artifacts = latest_artifacts(self.messages)
+        self.edit_mode = bool(self.artifacts) and data.get("editMode", True) is not False
+        # Parallel page generation only helps the first full build
+        self.parallel_build = data.get("parallelBuild") is True and not self.artifacts
 
         # Validate that conversation is about website building
         # Get the last user message
         last_user_message = None
-        for msg in reversed(messages):
+        for msg in reversed(self.messages):
             if msg.get("role") == "user":
                 # Handle both string and array content formats
                 content = msg.get("content", "")
                 if isinstance(content, list):
                     # Extract text from array format
                     text_parts = [item.get("text", "") for item in content if item.get("type") == "text"]
-                    last_user_message = " ".join(text_parts).lower()
+                    last_user_message = " ".join(text_parts)
                 else:
-                    last_user_message = content.lower()
+                    last_user_message = content
                 break
 
-        # Block off-topic requests (but allow first message greetings)
-        if last_user_message and len(messages) > 2:
-            # Off-topic keywords that have nothing to do with websites
-            off_topic_keywords = [
-                "homework", "essay", "write my", "do my", "solve this", "math problem",
-                "physics", "chemistry", "biology", "history assignment", "book report",
-                "translate", "summarize this article", "explain quantum", "what is the meaning",
-                "write a poem", "write a story", "write code for", "python script",
-                "help me with my", "my teacher", "my professor", "school project",
-                "dating advice", "relationship", "how to ask out", "legal advice",
-                "medical advice", "diagnose", "symptoms", "should i see a doctor"
-            ]
-
-            # Check if clearly off-topic
-            is_off_topic = any(keyword in last_user_message for keyword in off_topic_keywords)
+        # Block clearly off-topic requests with no website context (but allow first message greetings)
+        if last_user_message and len(self.messages) > 2 and topic_filter.is_off_topic(last_user_message):
+            print(f"🚫 Blocked off-topic request: {last_user_message[:100]}")
+            raise BadMessageRequest({
+                "error": "Fowazz is a website builder, not a general AI assistant. Please ask about building or editing websites!"
+            })
+
+        self.system_prompt = SYSTEM_PROMPT + EDIT_MODE_PROMPT if self.edit_mode else SYSTEM_PROMPT
+        # Clients may ask to give up sooner than the server-wide queue timeout
+        max_wait = data.get("maxWaitSeconds", ADMISSION_QUEUE_TIMEOUT)
+        try:
+            if isinstance(max_wait, bool):
+                raise ValueError
+            max_wait = float(max_wait)
+        except (TypeError, ValueError):
+            raise BadMessageRequest({"error": "maxWaitSeconds must be a number"})
+        if math.isnan(max_wait):
+            raise BadMessageRequest({"error": "maxWaitSeconds must be a number"})
+        self.max_wait = min(max(max_wait, 0.0), ADMISSION_QUEUE_TIMEOUT)
+        # Parallel builds report per-page progress instead
+        self.thinking_events = data.get("thinkingProgress") is True and not self.parallel_build
+        # Opt-in typed title/artifact events instead of artifact text in plain chunks
+        self.artifact_parser = ArtifactEventParser() if data.get("artifactEvents") is True else None
+        self.framer = ChunkFramer(coalescer_from_request(data, SSE_FLUSH_BYTES, SSE_FLUSH_MS), self.artifact_parser)
+
+        # Using GLM-4.6 flagship model with thinking mode - or the next model in
+        # GLM_FALLBACK_MODELS while its time to first token is over the SLO
+        self.selected_model = glm_pool.select_model(GLM_MODEL)
+
+        # Opt-in response cache, keyed on everything that shapes the answer
+        self.cache_key = None
+        if data.get("cache") is True and not self.edit_mode and not self.parallel_build and response_cache.accepts(GLM_TEMPERATURE):
+            self.cache_key = cache_key(self.system_prompt, self.messages, {
+                "model": self.selected_model, "temperature": GLM_TEMPERATURE, "max_tokens": GLM_MAX_TOKENS, "thinking": True
+            })
 
-            # Check if about websites (allow if yes)
-            website_keywords = [
-                "website", "web", "page", "site", "html", "css", "design", "build",
-                "create", "landing", "homepage", "portfolio", "business site", "blog",
-                "navigation", "header", "footer", "style", "layout", "responsive",
-                "button", "form", "contact page", "about page", "menu", "link",
-                "color", "font", "image", "section", "background", "card", "deploy"
-            ]
-            has_website_context = any(keyword in last_user_message for keyword in website_keywords)
+@app.route("/api/message", methods=["POST"])
+def message():
+    received_at = time.monotonic()
+    lease = None
+    stream_id = None
+    started = False
 
-            # Block if clearly off-topic and no website context
-            if is_off_topic and not has_website_context:
-                print(f"🚫 Blocked off-topic request: {last_user_message[:100]}")
-                active_connections.release()
-                return jsonify({
-                    "error": "Fowazz is a website builder, not a general AI assistant. Please ask about building or editing websites!"
-                }), 400
+    try:
+        if not glm_pool.upstreams:
+            return jsonify({
+                "error": "Server missing GLM_API_KEY. Set it in .env and restart the server."
+            }), 500
 
-        # Using GLM-4.6 flagship model with thinking mode
-        selected_model = "glm-4.6"
-        print(f"📊 Using model: {selected_model} (with thinking mode)")
+        # A client reconnecting after a dropped connection re-attaches to its generation
+        # (replaying what it missed) instead of starting a second one
+        resume = parse_last_event_id(request.headers.get('Last-Event-ID'))
+        if resume and stream_store.exists(resume[0]):
+            print(f"🔁 Client resumed stream {resume[0][:8]} after event {resume[1]}")
+            return stream_response(resume[0], resume[1], on_disconnect=disconnect_handlers.get(resume[0]))
+
+        req = MessageRequest(request.get_json(), request.headers.get('Authorization'))
+        stream_version = 2 if request.headers.get(STREAM_VERSION_HEADER) == "2" else 1
+        resumable = request.headers.get(RESUMABLE_HEADER) == "1"
+
+        # Opt-in response cache - a hit is replayed without taking an admission slot
+        cached = response_cache.get(req.cache_key) if req.cache_key else None
+        if cached is not None:
+            print(f"⚡ Response cache hit {req.cache_key[:12]}")
+            return replay_cached_response(cached, req, stream_version)
+
+        # Single flight: an identical request that's still generating is joined, not repeated
+        if SINGLE_FLIGHT_ENABLED:
+            stream_id, created = stream_store.create_or_join(single_flight_key(
+                req.system_prompt, req.messages, req.conversation_id, req.selected_model, stream_version, req.parallel_build,
+                req.thinking_events, req.artifact_parser is not None
+            ), SINGLE_FLIGHT_TTL)
+            if not created:
+                print(f"🔗 Identical request in flight, joining stream {stream_id[:8]}")
+                return stream_response(
+                    stream_id, headers={STREAM_VERSION_HEADER: str(stream_version)},
+                    on_disconnect=None if resumable else disconnect_handlers.get(stream_id)
+                )
 
-        # Prepare messages (ZAI SDK format - add system message to messages array)
-        zai_messages = [{"role": "system", "content": SYSTEM_PROMPT}] + messages
+        # Check capacity only once the request is known to be valid
+        lease = active_connections.try_acquire()
+        ticket = None
+        if lease:
+            print(f"✅ Connection acquired ({active_connections.get_count()}/{active_connections.max} active)")
+        else:
+            # No free slot - wait in line instead of bouncing the user straight away
+            ticket = active_connections.enqueue(get_request_priority())
+            if ticket is None:
+                if stream_id:
+                    end_unstarted_stream(stream_id, 'SITE_FULL')
+                print(f"🚫 Site at capacity! {active_connections.get_count()}/{active_connections.max} connections, {active_connections.get_waiting()} waiting")
+                return jsonify(site_full_payload(
+                    current_users=active_connections.get_count(), max_users=active_connections.max
+                )), 503  # Service Unavailable
+            print(f"⏳ Site at capacity, request queued (priority {ticket.priority}, {active_connections.get_waiting()} waiting)")
+
+        cancel = Cancellation()
+        if ticket is not None:
+            cancel.on_cancel(ticket.cancel)
+
+        def on_disconnect():
+            # A client that won't resume can't use the rest - stop paying for it right away
+            if not resumable and cancel.cancel("client disconnected"):
+                print("🔌 Client disconnected, cancelling generation")
+
+        def flush_stale():
+            # GLM went quiet mid-response: don't sit on deltas until the next one arrives
+            if cancel.cancelled:
+                return
+            with req.framer.lock:
+                for event in req.framer.flush_stale():
+                    stream_store.append(stream_id, event)
+
+        print(f"📊 Using model: {req.selected_model} (with thinking mode)")
+        timing = {"outcome": None, "model": req.selected_model, "admission_wait": None, "finish_reason": None, "bytes": 0}
 
         # Use streaming to send response in chunks
         def generate():
+            nonlocal lease
+            if ticket is not None:
+                for position in active_connections.wait(ticket, req.max_wait):
+                    yield sse_event({'queued': True, 'position': position, 'done': False})
+                lease = ticket.lease
+                if not lease and cancel.cancelled:
+                    print("🔌 Client left the queue")
+                    timing["outcome"] = "left_queue"
+                    return
+                if not lease:
+                    print(f"🚫 Queue wait expired after {req.max_wait:g}s")
+                    timing["outcome"] = "queue_timeout"
+                    yield sse_event(site_full_payload(done=True))
+                    return
+                print(f"✅ Connection acquired from queue ({active_connections.get_count()}/{active_connections.max} active)")
+
+            timing["admission_wait"] = round(time.monotonic() - received_at, 3)
+            extra_leases = []  # extra admission slots held by a parallel build
+            events = None
+            trace = None
+            full_content = ""
+            stream_stats = {}
             try:
-                full_content = ""
-                reasoning_content = ""
-                finish_reason = None
-
-                # Stream response from GLM-4.6 with thinking mode enabled
-                stream = client.chat.completions.create(
-                    model=selected_model,
-                    messages=zai_messages,
-                    max_tokens=8192,  # GLM-4.6 supports up to 8192 output tokens
-                    temperature=0.95,
-                    stream=True,
-                    thinking={"type": "enabled"}  # Enable deep reasoning mode
-                )
-
-                for chunk in stream:
-                    delta = chunk.choices[0].delta
-
-                    # Capture hidden reasoning (chain-of-thought)
-                    # We don't send this to the user, but it helps the model think better
-                    if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
-                        reasoning_content += delta.reasoning_content
-                        # Log reasoning internally for debugging (optional)
-                        # print(f"[THINKING] {delta.reasoning_content}", end="", flush=True)
-
-                    # Send actual content to user
-                    if delta.content:
-                        text = delta.content
-                        full_content += text
-                        # Send each chunk as JSON
-                        yield f"data: {json.dumps({'chunk': text, 'done': False})}\n\n"
+                # Fit the history into the token budget (old page versions, old files, oldest turns)
+                history_budget = CONTEXT_TOKEN_BUDGET - SYSTEM_PROMPT_TOKENS - (EDIT_MODE_PROMPT_TOKENS if req.edit_mode else 0)
+                compacted, context_stats = compact_messages(req.messages, history_budget, CONTEXT_KEEP_RECENT)
+                if context_stats["saved_tokens"]:
+                    print(f"✂️ Context compacted to ~{context_stats['estimated_tokens']} tokens (saved ~{context_stats['saved_tokens']}, dropped {context_stats['dropped_messages']} messages)")
+
+                # Prepare messages (ZAI SDK format - add system message to messages array)
+                # Attachment references are only expanded to base64 here, right before the call
+                zai_messages = [{"role": "system", "content": req.system_prompt}] + expand_attachments(attachment_store, compacted)
+                # Patches from the model are applied to the stored pages and streamed out as full pages
+                patcher = PatchStreamRewriter(req.artifacts) if req.edit_mode else None
+
+                def keep_alive():
+                    # Keep our admission leases alive while the stream is still producing
+                    nonlocal last_renewal
+                    if time.monotonic() - last_renewal > LEASE_RENEW_INTERVAL:
+                        for held in [lease] + extra_leases:
+                            active_connections.renew(held)
+                        last_renewal = time.monotonic()
+
+                last_renewal = time.monotonic()
+                plan = plan_site(req.selected_model, zai_messages) if req.parallel_build else None
+                if stream_recorder:
+                    trace = stream_recorder.start("parallel" if plan else "serial")
+                    if trace and plan:
+                        trace.pages = len(plan["pages"])
+                if plan:
+                    # One extra admission slot per concurrent page stream, only while nobody is queued
+                    for _ in range(len(plan["pages"]) - 1):
+                        extra = active_connections.try_acquire()
+                        if not extra:
+                            break
+                        extra_leases.append(extra)
+                    concurrency = 1 + len(extra_leases)
+                    print(f"🏗️ Building {len(plan['pages'])} pages in parallel ({concurrency} streams)")
+                    events = stream_site_parallel(req.selected_model, zai_messages, plan, stream_stats, concurrency, keep_alive, cancel,
+                                                  trace)
+                else:
+                    events = (
+                        event if isinstance(event, tuple) else ("chunk", event)
+                        for event in stream_glm(req.selected_model, zai_messages, stream_stats, keep_alive, cancel=cancel,
+                                                thinking_interval=THINKING_PROGRESS_INTERVAL if req.thinking_events else None,
+                                                trace=trace)
+                    )
+
+                for kind, text in events:
+                    out, text = response_events(req, patcher, kind, text)
+                    full_content += text
+                    if out:
+                        yield from out
                         # IMPORTANT: Yield to other greenlets so multiple users can stream simultaneously
                         gevent_sleep(0)
 
-                    # Check finish reason
-                    if chunk.choices[0].finish_reason:
-                        finish_reason = chunk.choices[0].finish_reason
+                if cancel.cancelled:
+                    # Nobody is waiting for the rest - don't store a half answer as the reply
+                    yield sse_event({'error': 'CANCELLED', 'done': True})
+                    return
+
+                # How fast GLM answered under the current load drives the adaptive limit
+                if concurrency_limiter and not plan and "first_token_at" in stream_stats:
+                    observe_stream_speed(stream_stats, full_content)
 
-                # Log total reasoning tokens used (for debugging)
-                if reasoning_content:
-                    print(f"🧠 Used {len(reasoning_content)} chars of reasoning")
+                out, text = closing_events(req, patcher, stream_stats)
+                full_content += text
+                yield from out
 
-                # Check if response was truncated
-                if finish_reason == "length":
-                    truncation_warning = "\n\n⚠️ **Response was cut off** - The page might be incomplete. Just ask me to **\"complete the page\"** or **\"finish the last file\"** and I'll continue from where I stopped!"
-                    full_content += truncation_warning
-                    yield f"data: {json.dumps({'chunk': truncation_warning, 'done': False})}\n\n"
+                # Remember this exchange for the next turn
+                remember_exchange(req, full_content, stream_stats["finish_reason"], context_stats)
 
-                # Send final message with full content
-                yield f"data: {json.dumps({'content': full_content, 'done': True})}\n\n"
+                # Send final message with the full content (or its digest)
+                extra = {}
+                if plan:
+                    extra['parallel'] = {'pages': [page['file'] for page in plan['pages']], 'streams': 1 + len(extra_leases)}
+                yield final_event(full_content, stream_version, context=context_stats, continuations=stream_stats["continuations"], **extra)
+                timing["outcome"] = "completed"
             except Exception as e:
-                yield f"data: {json.dumps({'error': str(e), 'done': True})}\n\n"
+                timing["outcome"] = "error"
+                yield from req.framer.flush(finish=True)
+                # Closing the upstream on cancel makes the read fail - that's not an error
+                if cancel.cancelled:
+                    error = 'CANCELLED'
+                elif isinstance(e, UpstreamUnavailable):
+                    error = 'UPSTREAM_UNAVAILABLE'
+                else:
+                    error = str(e)
+                yield sse_event({'error': error, 'done': True})
             finally:
+                disconnect_handlers.pop(stream_id, None)
+                idle_handlers.pop(stream_id, None)
+                if not cancel.cancelled:
+                    cancel.finish()
+                output_tokens = estimate_text_tokens(full_content) + stream_stats.get("reasoning_chars", 0) // 4
+                record_generation(output_tokens, aborted=cancel.cancelled)
+                if cancel.cancelled:
+                    timing["outcome"] = "cancelled" if cancel.reason != "abandoned" else "abandoned"
+                timing.update(stream_timing(stream_stats, full_content), finish_reason=stream_stats.get("finish_reason"))
+                if trace:
+                    stream_recorder.write(trace, timing)
                 # ALWAYS release connection when streaming is done
-                active_connections.release()
+                if events is not None:
+                    events.close()  # stops parallel page workers if the client went away
+                for held in extra_leases:
+                    active_connections.release(held)
+                active_connections.release(lease)
                 print(f"🔓 Connection released ({active_connections.get_count()}/{active_connections.max} active)")
 
-        return Response(generate(), mimetype='text/event-stream')
+        # Generate in the background - the client only follows the event log
+        if stream_id is None:
+            stream_id = stream_store.create()
+        disconnect_handlers[stream_id] = on_disconnect
+        idle_handlers[stream_id] = flush_stale
+        threading.Thread(
+            target=produce, args=(stream_store, stream_id, instrumented(generate(), timing, received_at), STREAM_DETACHED_TTL, cancel),
+            daemon=True
+        ).start()
+        started = True
+        return stream_response(stream_id, headers={STREAM_VERSION_HEADER: str(stream_version)}, on_disconnect=on_disconnect)
+
+    except BadMessageRequest as e:
+        return jsonify(e.payload), e.status
+    except AttachmentError as e:
+        if lease:
+            active_connections.release(lease)
+        if stream_id and not started:
+            end_unstarted_stream(stream_id, str(e))
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        if lease:
+            active_connections.release(lease)
+        if stream_id and not started:
+            end_unstarted_stream(stream_id, f"Server error: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+CONVERSATION_TOKEN_HEADER = "X-Conversation-Token"
 
+@app.route("/api/conversations", methods=["POST"])
+def create_conversation():
+    """Start a server-side conversation, optionally seeded with existing history"""
+    try:
+        data = request.get_json(silent=True) or {}
+        messages = data.get("messages", [])
+        if not isinstance(messages, list):
+            return jsonify({"error": "messages must be a list"}), 400
+
+        if any(has_inline_attachments(msg) for msg in messages):
+            # Inline files are stored like uploads, against the signed-in user's quota
+            owner = get_user_id(request.headers.get('Authorization'))
+            if not owner:
+                return jsonify({"error": "Unauthorized"}), 401
+            messages = [intern_attachments(attachment_store, msg, owner) for msg in messages]
+        # Only the hash is stored; the token itself is handed out once, here
+        token = new_owner_token()
+        conversation_id = conversation_store.create(messages, owner=owner_hash(token))
+        conversation_store.put_artifacts(conversation_id, latest_artifacts(messages))
+        print(f"💬 Conversation created: {conversation_id} ({len(messages)} messages)")
+        return jsonify({"conversationId": conversation_id, "conversationToken": token}), 201
+    except AttachmentQuotaError as e:
+        return jsonify({"error": str(e)}), 413
+    except AttachmentError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        active_connections.release()
+        print(f"❌ Server error: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+@app.route("/api/conversations/<conversation_id>", methods=["GET"])
+def get_conversation(conversation_id):
+    """Return the stored history of a conversation"""
+    token = request.headers.get(CONVERSATION_TOKEN_HEADER)
+    messages = conversation_store.get(conversation_id) if owned(conversation_store, conversation_id, token) else None
+    if messages is None:
+        return jsonify({"error": "CONVERSATION_NOT_FOUND"}), 404
+    return jsonify({"conversationId": conversation_id, "messages": messages}), 200
+
+@app.route("/api/conversations/<conversation_id>", methods=["DELETE"])
+def delete_conversation(conversation_id):
+    """Forget a stored conversation"""
+    token = request.headers.get(CONVERSATION_TOKEN_HEADER)
+    if not owned(conversation_store, conversation_id, token) or not conversation_store.delete(conversation_id):
+        return jsonify({"error": "CONVERSATION_NOT_FOUND"}), 404
+    return jsonify({"success": True}), 200
+
+@app.route("/api/attachments", methods=["POST"])
+def upload_attachment():
+    """Store an image/PDF once and return its digest for use in later messages"""
+    try:
+        # Uploads count against the signed-in user's quota
+        user_id = get_user_id(request.headers.get('Authorization'))
+        if not user_id:
+            return jsonify({"error": "Unauthorized"}), 401
+        # base64 JSON is a third bigger than the file, plus some room for the form/JSON wrapper
+        if request.content_length and request.content_length > attachment_store.max_bytes * 4 // 3 + 64 * 1024:
+            return jsonify({"error": f"Attachment too large (max {attachment_store.max_bytes} bytes)"}), 413
+
+        if "file" in request.files:
+            upload = request.files["file"]
+            file_data = upload.read()
+            media_type = upload.mimetype or "application/octet-stream"
+        else:
+            data = request.get_json(silent=True) or {}
+            media_type = data.get("mediaType") or "application/octet-stream"
+            try:
+                file_data = base64.b64decode(data.get("data", ""), validate=True)
+            except (binascii.Error, ValueError):
+                return jsonify({"error": "data must be base64"}), 400
+
+        if not file_data:
+            return jsonify({"error": "No file provided"}), 400
+
+        digest = attachment_store.put(file_data, media_type, owner=user_id)
+        media_type = sniff_media_type(file_data)
+        print(f"📎 Attachment stored: {digest[:12]}… ({len(file_data)} bytes, {media_type})")
+        return jsonify({"digest": digest, "mediaType": media_type, "size": len(file_data)}), 201
+
+    except AttachmentQuotaError as e:
+        return jsonify({"error": str(e)}), 413
+    except AttachmentError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"❌ Server error: {str(e)}")
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
+@app.route("/api/attachments/<digest>", methods=["GET"])
+def get_attachment(digest):
+    """Fetch a stored attachment (HEAD works too, to check before uploading)"""
+    try:
+        stored = attachment_store.get(digest)
+    except AttachmentError as e:
+        return jsonify({"error": str(e)}), 400
+    if stored is None:
+        return jsonify({"error": "ATTACHMENT_NOT_FOUND"}), 404
+    file_data, media_type = stored
+    if media_type not in ALLOWED_MEDIA_TYPES:
+        media_type = "application/octet-stream"
+    # Always a download, never rendered on the API origin
+    return Response(file_data, mimetype=media_type, headers={
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "X-Content-Type-Options": "nosniff",
+        "Content-Disposition": f'attachment; filename="{digest}.{MEDIA_EXTENSIONS.get(media_type, "bin")}"',
+        "Content-Security-Policy": "default-src 'none'; sandbox",
+    })
+
+@app.route("/api/streams/<stream_id>", methods=["GET"])
+def resume_stream(stream_id):
+    """Re-attach to a response stream, replaying everything after Last-Event-ID (or ?after=N)"""
+    if not STREAM_ID_RE.match(stream_id) or not stream_store.exists(stream_id):
+        return jsonify({"error": "STREAM_NOT_FOUND"}), 404
+    resume = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    if resume and resume[0] == stream_id:
+        after = resume[1]
+    else:
+        after = request.args.get("after", 0, type=int)
+    return stream_response(stream_id, after)
+
+@app.route("/api/responses/<digest>", methods=["GET"])
+def get_response_body(digest):
+    """Full text of a streamed response, by the sha256 from its final v2 event"""
+    if not DIGEST_RE.match(digest):
+        return jsonify({"error": f"Invalid response digest: {digest!r}"}), 400
+    content = response_body_store.get(digest)
+    if content is None:
+        return jsonify({"error": "RESPONSE_NOT_FOUND"}), 404
+    return jsonify({"content": content, "sha256": digest, "length": len(content)})
+
+def is_admin_request():
+    """Admin endpoints need the ADMIN_TOKEN (disabled when it isn't set)"""
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus scrape endpoint, merged across every worker on this host"""
+    if not METRICS_PUBLIC:
+        token = request.headers.get('Authorization', '')
+        if not METRICS_TOKEN or not hmac.compare_digest(token.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            return jsonify({"error": "Forbidden"}), 403
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/api/admin/upstreams", methods=["GET"])
+def admin_upstreams():
+    """Health of each GLM key (breaker state, load, token budget, errors) and per-model latency"""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(glm_pool.stats())
+
+@app.route("/api/admin/concurrency", methods=["GET"])
+def admin_concurrency():
+    """Current admission limit, and why it last changed when the adaptive limiter is on"""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    if concurrency_limiter is None:
+        return jsonify({"adaptive": False, "limit": active_connections.max, "active": active_connections.get_count()})
+    return jsonify({"adaptive": True, "active": active_connections.get_count(), **concurrency_limiter.stats()})
+
+@app.route("/api/admin/response-cache", methods=["GET", "POST"])
+def admin_response_cache():
+    """Show or change response cache settings: {"enabled": bool, "maxTemperature": float, "clear": bool}"""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        try:
+            max_temperature = float(data["maxTemperature"]) if "maxTemperature" in data else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "maxTemperature must be a number"}), 400
+        for field in ("enabled", "clear"):
+            if field in data and not isinstance(data[field], bool):
+                return jsonify({"error": f"{field} must be true or false"}), 400
+        enabled = data.get("enabled")
+        settings = response_cache.update_settings(enabled=enabled, max_temperature=max_temperature)
+        if data.get("clear"):
+            response_cache.clear()
+        print(f"🗄️ Response cache settings changed: {settings}")
+
+    settings = response_cache.get_settings()
+    return jsonify({
+        "enabled": settings["enabled"],
+        "maxTemperature": settings["max_temperature"],
+        "temperature": GLM_TEMPERATURE,
+        "active": response_cache.accepts(GLM_TEMPERATURE),
+        "stats": response_cache.stats(),
+    })
+
+@app.route("/webhook", methods=["POST"])
+def stripe_webhook():
+    """Stripe events -> local subscription cache (status, plan_name, website_limit)"""
+    if not STRIPE_WEBHOOK_SECRET:
+        print("❌ STRIPE_WEBHOOK_SECRET not configured!")
+        return jsonify({"error": "Webhook not configured on server"}), 500
+
+    # Verify against the raw body before trusting any of it
+    payload = request.get_data(as_text=True)
+    try:
+        stripe.WebhookSignature.verify_header(
+            payload, request.headers.get("Stripe-Signature", ""), STRIPE_WEBHOOK_SECRET, stripe.Webhook.DEFAULT_TOLERANCE
+        )
+        event = json.loads(payload)
+    except (stripe.error.SignatureVerificationError, ValueError) as e:
+        print(f"❌ Invalid Stripe webhook: {str(e)}")
+        return jsonify({"error": "Invalid signature"}), 400
+
+    try:
+        update = update_from_event(event, subscription_cache.plan_prices)
+        result = subscription_cache.apply(event["id"], update)
+    except Exception as e:
+        # Not recorded, so Stripe's retry gets another go
+        print(f"❌ Stripe webhook {event.get('id')} failed: {str(e)}")
+        return jsonify({"error": "Processing error"}), 500
+
+    if result == "duplicate":
+        print(f"🔁 Stripe webhook {event['id']} already processed")
+    elif update is not None:
+        print(f"💳 Stripe webhook {event['type']} for subscription {update.subscription_id}")
+    return jsonify({"received": True}), 200
+
 @app.route("/api/create-checkout-session", methods=["POST"])
 def create_checkout_session():
     """Create a Stripe checkout session for subscription payments"""
@@ -891,6 +2021,8 @@ def create_checkout_session():
             cancel_url=cancel_url,
             customer_email=customer_email,
             client_reference_id=client_reference_id,
+            # Lets /webhook tie every later subscription event to the user
+            subscription_data={'metadata': {'user_id': client_reference_id}} if client_reference_id else None,
         )
 
         print(f"✅ Stripe session created: {session.id}")
@@ -956,14 +2088,14 @@ def cancel_subscription():
 
 @app.route("/api/delete-account", methods=["POST"])
 def delete_account():
-    """Delete a user account and all associated data"""
+    """Start deleting a user account and all associated data; returns a job id to poll"""
     try:
         # Check if Supabase is configured
-        if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
+        if not account_deleter.configured:
             print("❌ Supabase not configured!")
             return jsonify({"error": "Server configuration error"}), 500
 
-        data = request.json
+        data = request.get_json(silent=True) or {}
         user_id = data.get("userId")
 
         print(f"🗑️ Deleting account for user: {user_id}")
@@ -978,54 +2110,35 @@ def delete_account():
             print("❌ Missing or invalid authorization header!")
             return jsonify({"error": "Unauthorized"}), 401
 
-        # Delete all user data from database tables
-        headers = {
-            'apikey': SUPABASE_SERVICE_ROLE_KEY,
-            'Authorization': f'Bearer {SUPABASE_SERVICE_ROLE_KEY}',
-            'Content-Type': 'application/json'
-        }
-
-        # Tables to delete from (in order to respect foreign key constraints)
-        tables_to_delete = [
-            'payments',
-            'subscriptions',
-            'projects',
-            'user_profiles'
-        ]
-
-        for table in tables_to_delete:
-            delete_url = f"{SUPABASE_URL}/rest/v1/{table}?id=eq.{user_id}"
-            response = requests.delete(delete_url, headers=headers)
-            if response.status_code not in [200, 204]:
-                print(f"⚠️ Warning: Failed to delete from {table}: {response.text}")
-            else:
-                print(f"✅ Deleted data from {table}")
-
-        # Delete the auth user using Supabase Admin API
-        delete_user_url = f"{SUPABASE_URL}/auth/v1/admin/users/{user_id}"
-        response = requests.delete(delete_user_url, headers=headers)
-
-        if response.status_code not in [200, 204]:
-            print(f"❌ Failed to delete auth user: {response.text}")
-            return jsonify({"error": "Failed to delete user account"}), 500
-
-        print(f"✅ Account deleted successfully: {user_id}")
+        if account_deleter.verify_user(auth_header) != user_id:
+            print("❌ Token does not belong to this user!")
+            return jsonify({"error": "Unauthorized"}), 403
 
+        job_id = account_deleter.submit(user_id)
         return jsonify({
-            "success": True,
-            "message": "Account deleted successfully"
-        }), 200
+            "jobId": job_id,
+            "status": "pending",
+            "statusUrl": f"/api/delete-account/{job_id}"
+        }), 202
 
     except Exception as e:
         print(f"❌ Server error: {str(e)}")
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
+@app.route("/api/delete-account/<job_id>", methods=["GET"])
+def delete_account_status(job_id):
+    """Progress of an account deletion job"""
+    job = account_deleter.status(job_id) if JOB_ID_RE.match(job_id) else None
+    if not job:
+        return jsonify({"error": "Unknown deletion job"}), 404
+    return jsonify(public_job(job)), 200
+
 if __name__ == "__main__":
-    if not GLM_API_KEY:
+    if not glm_pool.upstreams:
         print("⚠️  WARNING: GLM_API_KEY not found in .env file!")
         print("Please create a .env file with: GLM_API_KEY=your_key_here")
     else:
-        print("✅ GLM-4.6 API key loaded successfully")
+        print(f"✅ GLM-4.6 API key loaded successfully ({len(glm_pool.upstreams)} key(s) in the pool)")
 
     if not STRIPE_SECRET_KEY:
         print("⚠️  WARNING: STRIPE_SECRET_KEY not found in environment!")
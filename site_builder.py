@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel multi-page site generation.
+
+Instead of one serial stream for 3-7 pages, a short planning call returns the
+page list, shared navigation and design tokens, then every page is generated
+by its own upstream stream at the same time. Page output is merged back in
+plan order into a single response, so wall-clock time is roughly the slowest
+page instead of the sum of all pages.
+
+The caller decides how many streams may run at once (server.py reserves one
+admission slot per extra stream); with fewer slots the pages queue up.
+"""
+import json
+import queue
+import re
+import threading
+import time
+
+PLAN_PROMPT = """[BUILD PLAN] Before building, plan the site. Reply with ONLY a JSON object, no other text:
+
+{
+  "ready": true,
+  "title": "2-4 word project title",
+  "intro": "your short casual intro line, in the user's language",
+  "closing": "your short closing line asking if they want changes, in the user's language",
+  "design": "the design system every page must share: colors (hex), fonts, spacing, border-radius, button and card styles",
+  "nav": "the exact <nav>...</nav> HTML shared by every page, linking all pages",
+  "pages": [
+    {"file": "index.html", "brief": "what this page contains, section by section"}
+  ]
+}
+
+Use 3-7 pages for a business site. If you are NOT ready to build yet (you still need to ask questions, or the user only wants a small edit or a chat reply), reply with exactly {"ready": false}."""
+
+PAGE_PROMPT = """[BUILD PAGE] You're building ONE page of a multi-page site - the other pages are being built at the same time by teammates, so follow the shared plan exactly.
+
+Site: {title}
+All pages: {files}
+
+Design system (use exactly, every page must match):
+{design}
+
+Shared navigation (use this exact HTML):
+{nav}
+
+Build ONLY {file}: {brief}
+
+Output ONLY this one artifact - no intro, no closing text, no [TITLE]:
+[ARTIFACT:START:{file}]
+...complete page...
+[ARTIFACT:END]"""
+
+FILE_RE = re.compile(r"^[\w\-.]+\.html$")
+
+
+def parse_plan(text, max_pages=7):
+    """Parse the planning reply; returns None when the model isn't ready to build"""
+    if not text:
+        return None
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end == -1:
+        return None
+    try:
+        plan = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(plan, dict) or not plan.get("ready"):
+        return None
+
+    pages = []
+    for page in plan.get("pages") or []:
+        if isinstance(page, dict) and FILE_RE.match(str(page.get("file", ""))):
+            if page["file"] not in [p["file"] for p in pages]:
+                pages.append({"file": page["file"], "brief": str(page.get("brief", ""))})
+    if len(pages) < 2:
+        return None  # a single page gains nothing from fanning out
+    plan["pages"] = pages[:max_pages]
+    return plan
+
+
+def page_instruction(plan, page):
+    return PAGE_PROMPT.format(
+        title=plan.get("title", ""),
+        files=", ".join(p["file"] for p in plan["pages"]),
+        design=plan.get("design", ""),
+        nav=plan.get("nav", ""),
+        file=page["file"],
+        brief=page["brief"],
+    )
+
+
+class ArtifactOnlyFilter:
+    """Passes through a page stream from [ARTIFACT:START:...] up to [ARTIFACT:END], dropping chatter around it"""
+
+    START = "[ARTIFACT:START:"
+    END = "[ARTIFACT:END]"
+
+    def __init__(self):
+        self.buffer = ""
+        self.state = "before"  # before -> inside -> after
+
+    def feed(self, text):
+        if self.state == "after":
+            return ""
+        self.buffer += text
+        if self.state == "before":
+            index = self.buffer.find(self.START)
+            if index == -1:
+                # Only the tail could still be the start of the marker
+                self.buffer = self.buffer[-len(self.START):]
+                return ""
+            self.buffer = self.buffer[index:]
+            self.state = "inside"
+        index = self.buffer.find(self.END)
+        if index != -1:
+            output = self.buffer[:index + len(self.END)]
+            self.buffer = ""
+            self.state = "after"
+            return output
+        # Hold back a possible partial end marker
+        keep = len(self.END) - 1
+        output, self.buffer = self.buffer[:-keep], self.buffer[-keep:]
+        return output
+
+    def finish(self):
+        """Close a page that was cut off so the merged response stays well-formed"""
+        if self.state != "inside":
+            return ""
+        self.state = "after"
+        output, self.buffer = self.buffer + "\n" + self.END, ""
+        return output
+
+
+def build_pages(plan, stream_page, concurrency, keep_alive=None, progress_interval=1.0):
+    """
+    Generate every page of plan with up to `concurrency` streams at once and yield,
+    in plan order:
+
+        ("chunk", text)                        - page output, already in final order
+        ("progress", {"page", "status", ...})  - status is generating / done / failed
+
+    stream_page(page) must return an iterator of text for that page. The page that
+    is next in order streams live; later pages are buffered until it finishes.
+    """
+    pages = plan["pages"]
+    concurrency = max(1, min(concurrency, len(pages)))
+
+    events = queue.Queue()
+    work = queue.Queue()
+    for index in range(len(pages)):
+        work.put(index)
+    cancelled = threading.Event()
+
+    def worker():
+        while not cancelled.is_set():
+            try:
+                index = work.get_nowait()
+            except queue.Empty:
+                return
+            page_filter = ArtifactOnlyFilter()
+            events.put(("started", index, None))
+            stream = None
+            try:
+                stream = stream_page(pages[index])
+                for text in stream:
+                    if cancelled.is_set():
+                        return
+                    text = page_filter.feed(text)
+                    if text:
+                        events.put(("delta", index, text))
+                text = page_filter.finish()
+                if text:
+                    events.put(("delta", index, text))
+                events.put(("end", index, None))
+            except Exception as e:
+                events.put(("error", index, str(e)))
+            finally:
+                if hasattr(stream, "close"):
+                    stream.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    buffered = {index: [] for index in range(len(pages))}
+    chars = {index: 0 for index in range(len(pages))}
+    finished = set()
+    current = 0
+    last_progress = {}
+
+    try:
+        while current < len(pages):
+            try:
+                kind, index, payload = events.get(timeout=1.0)
+            except queue.Empty:
+                kind = None
+            if keep_alive:
+                keep_alive()
+            if kind is None:
+                continue
+
+            page = pages[index]["file"]
+            if kind == "started":
+                yield ("progress", {"page": page, "status": "generating", "index": index, "total": len(pages)})
+            elif kind == "delta":
+                chars[index] += len(payload)
+                if index == current:
+                    yield ("chunk", payload)
+                else:
+                    buffered[index].append(payload)
+                now = time.monotonic()
+                if now - last_progress.get(index, 0) >= progress_interval:
+                    last_progress[index] = now
+                    yield ("progress", {"page": page, "status": "generating", "chars": chars[index], "index": index, "total": len(pages)})
+            else:
+                finished.add(index)
+                if kind == "error":
+                    print(f"❌ Page {page} failed: {payload}")
+                status = "failed" if kind == "error" else "done"
+                yield ("progress", {"page": page, "status": status, "chars": chars[index], "index": index, "total": len(pages)})
+
+            # Flush every page that is now complete, in order
+            while current in finished:
+                current += 1
+                if current < len(pages):
+                    yield ("chunk", "\n\n")
+                    for text in buffered[current]:
+                        yield ("chunk", text)
+                    buffered[current] = []
+    finally:
+        # Client went away or we're done - workers stop at their next chunk
+        cancelled.set()
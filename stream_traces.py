@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Record-and-replay of real upstream stream timings.
+
+With STREAM_TRACE_DIR set, /api/message records what GLM actually sent for a
+sampled share (STREAM_TRACE_SAMPLE_RATE) of responses - when each upstream
+round connected, and the arrival time and size of every chunk of reasoning and
+content - and appends one JSON line per response to
+STREAM_TRACE_DIR/traces-YYYY-MM-DD.jsonl:
+
+    {"version": 1, "recorded_at": ..., "mode": "serial" | "parallel", "pages": 4,
+     "outcome": "completed", "finish_reason": "stop", "admission_wait": 0.002,
+     "rounds": [{"page": null, "continuation": 0, "thinking": true, "opened_ms": 12,
+                 "connect_ms": 640, "chunks": [[ms, reasoning_chars, content_chars], ...],
+                 "finish_reason": "stop", "error": null, "content": "..."}]}
+
+Traces are sanitized: no prompts, no reasoning text, and in the content every
+letter and digit is replaced by a filler character of the same UTF-8 length.
+Whitespace, punctuation and the [TITLE:] / [ARTIFACT:...] / SEARCH-REPLACE
+markers are kept, so framing, artifact parsing and chunk coalescing see the
+same shapes (and byte counts) as they did in production.
+
+ReplayClient plays traces back as a zai-sdk client (see replay_traces.py),
+so a replay runs the same generate() code path at 1x or accelerated speed.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+TRACE_VERSION = 1
+MARKER_RE = re.compile(
+    r"(\[(?:TITLE:|ARTIFACT:START:|ARTIFACT:PATCH:|ARTIFACT:END\])|<<<<<<< SEARCH|=======|>>>>>>> REPLACE)"
+)
+WORD_RE = re.compile(r"[^\W_]+")
+FILLER = {1: "x", 2: "é", 3: "ก", 4: "𝑥"}  # by UTF-8 length, so byte counts survive sanitizing
+REPLAY_TAG_RE = re.compile(r"\(replay trace (\d+)\)")
+REPLAY_PAGE_RE = re.compile(r"^Build ONLY page(\d+)\.html:", re.M)
+
+
+def _fill(match):
+    word = match.group()
+    if word.isascii():
+        return "x" * len(word)
+    return "".join(FILLER[len(char.encode("utf-8"))] for char in word)
+
+
+def sanitize(text):
+    """text with letters and digits blanked out; whitespace, punctuation and markers kept"""
+    parts = MARKER_RE.split(text)
+    # split() with a group puts the markers at the odd indexes
+    return "".join(part if index % 2 else WORD_RE.sub(_fill, part) for index, part in enumerate(parts))
+
+
+class TraceRound:
+    """One upstream call: when it connected and when each chunk arrived (ms since the call)"""
+
+    def __init__(self, trace, page, continuation, thinking):
+        self.opened = time.monotonic()
+        self.opened_ms = round((self.opened - trace.started) * 1000)
+        self.page = page
+        self.continuation = continuation
+        self.thinking = thinking
+        self.connect_ms = None
+        self.chunks = []
+        self.content = []
+        self.finish_reason = None
+        self.error = None
+
+    def connected(self):
+        self.connect_ms = round((time.monotonic() - self.opened) * 1000)
+
+    def chunk(self, reasoning, content, finish_reason=None):
+        self.chunks.append([round((time.monotonic() - self.opened) * 1000), len(reasoning or ""), len(content or "")])
+        if content:
+            self.content.append(content)
+        if finish_reason:
+            self.finish_reason = finish_reason
+
+    def failed(self, error):
+        self.error = type(error).__name__
+
+    def to_dict(self):
+        return {
+            "page": self.page, "continuation": self.continuation, "thinking": self.thinking,
+            "opened_ms": self.opened_ms, "connect_ms": self.connect_ms, "chunks": self.chunks,
+            "finish_reason": self.finish_reason, "error": self.error, "content": sanitize("".join(self.content)),
+        }
+
+
+class StreamTrace:
+    """The upstream rounds of one response; page(index) is the view a parallel page stream records into"""
+
+    def __init__(self, mode, rounds=None, started=None, page_index=None):
+        self.mode = mode
+        self.rounds = [] if rounds is None else rounds
+        self.started = time.monotonic() if started is None else started
+        self.page_index = page_index
+        self.pages = None
+
+    def page(self, index):
+        return StreamTrace(self.mode, self.rounds, self.started, index)
+
+    def round(self, continuation, thinking):
+        trace_round = TraceRound(self, self.page_index, continuation, thinking)
+        self.rounds.append(trace_round)  # list.append is atomic - page streams record concurrently
+        return trace_round
+
+
+class StreamRecorder:
+    def __init__(self, directory, sample_rate=1.0):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, mode):
+        """A new trace, or None when this response isn't sampled"""
+        if random.random() >= self.sample_rate:
+            return None
+        return StreamTrace(mode)
+
+    def write(self, trace, timing):
+        """Append the finished trace as one JSON line"""
+        now = datetime.now(timezone.utc)
+        line = json.dumps({
+            "version": TRACE_VERSION,
+            "recorded_at": now.isoformat(timespec="seconds"),
+            "mode": trace.mode,
+            "pages": trace.pages,
+            "outcome": timing.get("outcome"),
+            "finish_reason": timing.get("finish_reason"),
+            "admission_wait": timing.get("admission_wait"),
+            "rounds": [trace_round.to_dict() for trace_round in trace.rounds],
+        }, ensure_ascii=False)
+        path = os.path.join(self.directory, f"traces-{now:%Y-%m-%d}.jsonl")
+        try:
+            with self.lock, open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.written += 1
+        except OSError as e:
+            print(f"⚠️ Could not write stream trace: {e}")
+
+
+def create_stream_recorder():
+    """Stream recorder configured from STREAM_TRACE_DIR / STREAM_TRACE_SAMPLE_RATE; None when off"""
+    directory = os.getenv("STREAM_TRACE_DIR")
+    if not directory:
+        return None
+    sample_rate = float(os.getenv("STREAM_TRACE_SAMPLE_RATE", "1"))
+    print(f"🎞️ Recording {sample_rate:.0%} of upstream stream timings to {directory}")
+    return StreamRecorder(directory, sample_rate)
+
+
+def load_traces(paths):
+    """Every trace in the given JSONL files, in order"""
+    traces = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    trace = json.loads(line)
+                    if trace.get("version") == TRACE_VERSION and trace.get("rounds"):
+                        traces.append(trace)
+    return traces
+
+
+def _sleep_until(deadline):
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class ReplayStream:
+    """A recorded round as a zai-sdk stream: the same chunk sizes at the same offsets, divided by speed"""
+
+    def __init__(self, trace_round, speed, opened):
+        self.round = trace_round
+        self.speed = speed
+        self.opened = opened
+        self.closed = False
+
+    def __iter__(self):
+        content = self.round["content"]
+        position = 0
+        chunks = self.round["chunks"]
+        for index, (ms, reasoning_chars, content_chars) in enumerate(chunks):
+            _sleep_until(self.opened + ms / 1000 / self.speed)
+            if self.closed:
+                raise ConnectionError("replay stream closed")
+            text = content[position:position + content_chars]
+            position += content_chars
+            last = index == len(chunks) - 1
+            delta = SimpleNamespace(role="assistant", content=text or None,
+                                    reasoning_content="x" * reasoning_chars if reasoning_chars else None)
+            yield SimpleNamespace(choices=[SimpleNamespace(
+                index=0, delta=delta, finish_reason=self.round["finish_reason"] if last else None
+            )])
+        if self.round.get("error"):
+            raise ConnectionError(f"replayed upstream error ({self.round['error']})")
+
+    def close(self):
+        self.closed = True
+
+
+class ReplayClient:
+    """
+    Stands in for ZhipuAiClient. Requests are matched to traces by a "(replay trace N)"
+    tag in the user message, to rounds by page ("Build ONLY pageN.html") and continuation.
+    """
+
+    def __init__(self, traces, speed=1.0):
+        self.traces = traces
+        self.speed = speed
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False, **kwargs):
+        opened = time.monotonic()
+        text = "\n".join(str(message.get("content", "")) for message in messages if message.get("role") == "user")
+        tag = REPLAY_TAG_RE.search(text)
+        if not tag:
+            raise ValueError("replay request without a (replay trace N) tag")
+        trace = self.traces[int(tag.group(1))]
+        last = str(messages[-1].get("content", ""))
+
+        if not stream:
+            return self._completion(self._plan(trace) if last.startswith("[BUILD PLAN]") else "OK")
+
+        page = REPLAY_PAGE_RE.search(last)
+        page = int(page.group(1)) - 1 if page else None
+        continuation = sum(1 for message in messages if str(message.get("content", "")).startswith("[CONTINUE]"))
+        for trace_round in trace["rounds"]:
+            if trace_round["page"] == page and trace_round["continuation"] == continuation:
+                break
+        else:
+            raise ValueError(f"trace has no round for page {page}, continuation {continuation}")
+        if trace_round.get("error") and trace_round["connect_ms"] is None:
+            raise ConnectionError(f"replayed upstream error ({trace_round['error']})")  # the call itself failed
+        _sleep_until(opened + (trace_round["connect_ms"] or 0) / 1000 / self.speed)
+        return ReplayStream(trace_round, self.speed, opened)
+
+    def _plan(self, trace):
+        if trace["mode"] != "parallel" or not trace.get("pages"):
+            return json.dumps({"ready": False})
+        pages = [{"file": f"page{i}.html", "brief": f"Page {i}"} for i in range(1, trace["pages"] + 1)]
+        return json.dumps({"ready": True, "title": "Replay", "intro": "Replaying.", "closing": "Done.",
+                           "design": "", "nav": "<nav></nav>", "pages": pages})
+
+    def _completion(self, text):
+        return SimpleNamespace(choices=[SimpleNamespace(
+            index=0, message=SimpleNamespace(role="assistant", content=text), finish_reason="stop"
+        )])
@@ -0,0 +1,655 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable response streams.
+
+Every /api/message response is produced in the background into a bounded
+per-response event log instead of straight into the HTTP response. Clients
+follow the log: each SSE event gets an id of the form "<stream id>:<seq>", so
+a client that drops off (mobile network switch, tab suspended) can reconnect
+with Last-Event-ID, get the events it missed replayed and then follow the live
+tail - instead of re-sending the request and starting a second generation.
+
+Generation keeps running while nobody is attached, until no client has been
+seen for the detached TTL; finished logs are kept for the retention period.
+
+Backends:
+    memory - a ring buffer per stream in each worker (default). Appending costs
+             no I/O, but a reconnect or duplicate request that lands on another
+             worker can't find the stream and starts over.
+    sqlite - one database file shared by every gunicorn worker on a host; every
+             event is a write, so only worth it when resuming across workers matters
+    redis  - one list per stream on a Redis server, shared across nodes
+
+Followers in the producing process are woken immediately; followers in other
+processes poll.
+
+Identical requests that arrive while a response is still being generated
+(double submits, retries after a timeout, a second tab) join the running
+stream through create_or_join() instead of starting another generation. The
+store counts followers, so a client disconnecting only cancels generation
+once nobody else is following it.
+"""
+import collections
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from admission import redis_client_from_env
+from sse import sse_event
+
+LAST_EVENT_ID_RE = re.compile(r"^([0-9a-f]{32}):(\d+)$")
+STREAM_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_stream_id():
+    return os.urandom(16).hex()
+
+
+def parse_last_event_id(value):
+    """(stream id, seq) from a Last-Event-ID header, or None"""
+    match = LAST_EVENT_ID_RE.match((value or "").strip())
+    return (match.group(1), int(match.group(2))) if match else None
+
+
+class _LocalNotify:
+    """Wakes followers in this process as soon as the local producer appends"""
+
+    def _init_notify(self):
+        self.notify_lock = threading.Lock()
+        self.conditions = {}  # stream id -> Condition, only for streams produced here
+        self.local_seq = {}   # stream id -> latest seq appended here
+        self.local_done = set()
+
+    def _notify(self, stream_id, seq=None, done=False):
+        with self.notify_lock:
+            if seq is not None:
+                self.local_seq[stream_id] = seq
+            if done:
+                self.local_done.add(stream_id)
+            condition = self.conditions.get(stream_id)
+        if condition:
+            with condition:
+                condition.notify_all()
+
+    def _forget_local(self, stream_id):
+        with self.notify_lock:
+            self.conditions.pop(stream_id, None)
+            self.local_seq.pop(stream_id, None)
+            self.local_done.discard(stream_id)
+
+    def wait(self, stream_id, after, timeout):
+        """Block until an event after `after` may exist, or timeout"""
+        with self.notify_lock:
+            if stream_id not in self.local_seq:
+                condition = None  # produced by another process (or already finished) - plain polling
+            else:
+                condition = self.conditions.setdefault(stream_id, threading.Condition())
+        if condition is None:
+            time.sleep(timeout)
+            return
+        with condition:
+            if self.local_seq.get(stream_id, 0) > after or stream_id in self.local_done:
+                return
+            condition.wait(timeout)
+
+
+class MemoryStreamStore(_LocalNotify):
+    def __init__(self, max_events=2048, retention_seconds=300):
+        self.max_events = max_events
+        self.retention_seconds = retention_seconds
+        self.streams = {}  # id -> {"events": deque, "next_seq", "done", "last_seen", "updated", "followers"}
+        self.flights = {}  # request key -> (stream id, expires), for streams still being generated
+        self.lock = threading.Lock()
+        self._init_notify()
+
+    def _cleanup(self, now):
+        for stream_id in [sid for sid, s in self.streams.items() if max(s["updated"], s["last_seen"]) + self.retention_seconds < now]:
+            del self.streams[stream_id]
+            self._forget_local(stream_id)
+        for key in [k for k, (_, expires) in self.flights.items() if expires < now]:
+            del self.flights[key]
+
+    def _create_locked(self, now):
+        stream_id = new_stream_id()
+        self.streams[stream_id] = {
+            "events": collections.deque(maxlen=self.max_events),
+            "next_seq": 1, "done": False, "last_seen": now, "updated": now, "followers": 0,
+        }
+        return stream_id
+
+    def create(self):
+        now = time.time()
+        with self.lock:
+            self._cleanup(now)
+            stream_id = self._create_locked(now)
+        self._notify(stream_id, seq=0)
+        return stream_id
+
+    def create_or_join(self, key, ttl):
+        """(stream id, created): the unfinished stream registered under key, or a new one registered for ttl seconds"""
+        now = time.time()
+        with self.lock:
+            self._cleanup(now)
+            flight = self.flights.get(key)
+            if flight is not None:
+                stream = self.streams.get(flight[0])
+                if stream is not None and not stream["done"] and flight[1] > now:
+                    return flight[0], False
+            stream_id = self._create_locked(now)
+            self.flights[key] = (stream_id, now + ttl)
+        self._notify(stream_id, seq=0)
+        return stream_id, True
+
+    def exists(self, stream_id):
+        with self.lock:
+            return stream_id in self.streams
+
+    def append(self, stream_id, event):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                return None
+            seq = stream["next_seq"]
+            stream["next_seq"] += 1
+            stream["events"].append((seq, event))
+            stream["updated"] = time.time()
+        self._notify(stream_id, seq=seq)
+        return seq
+
+    def finish(self, stream_id):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream["done"] = True
+                stream["updated"] = time.time()
+            for key in [k for k, (sid, _) in self.flights.items() if sid == stream_id]:
+                del self.flights[key]
+        self._notify(stream_id, done=True)
+        self._forget_local(stream_id)
+
+    def read(self, stream_id, after, limit=512):
+        """(events after seq `after`, done) - or None if the stream is unknown or expired"""
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                return None
+            events = [item for item in stream["events"] if item[0] > after][:limit]
+            return events, stream["done"]
+
+    def touch(self, stream_id):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream["last_seen"] = time.time()
+
+    def last_seen(self, stream_id):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            return stream["last_seen"] if stream else 0
+
+    def attach(self, stream_id, delta=1):
+        """Count a follower in (or out, with delta=-1); returns the number of followers left"""
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                return 0
+            stream["followers"] = max(stream["followers"] + delta, 0)
+            return stream["followers"]
+
+
+class SQLiteStreamStore(_LocalNotify):
+    """Events are rows keyed by (stream, seq); old rows are trimmed as the producer appends"""
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS streams (
+    id TEXT PRIMARY KEY,
+    updated REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    followers INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stream_flights (
+    key TEXT PRIMARY KEY,
+    stream_id TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stream_events (
+    stream_id TEXT NOT NULL REFERENCES streams(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (stream_id, seq)
+);
+"""
+    TRIM_EVERY = 64
+
+    def __init__(self, path, max_events=2048, retention_seconds=300, cleanup_interval=60):
+        self.path = path
+        self.max_events = max_events
+        self.retention_seconds = retention_seconds
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = 0
+        self.next_seq = {}  # stream id -> next seq, for streams produced by this process
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(self.SCHEMA)
+        try:
+            # Databases created before follower counting
+            self.db.execute("ALTER TABLE streams ADD COLUMN followers INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        self._init_notify()
+
+    def _cleanup(self, now):
+        # Expired streams are swept lazily, at most once per interval per worker
+        if now - self.last_cleanup < self.cleanup_interval:
+            return
+        self.last_cleanup = now
+        cutoff = now - self.retention_seconds
+        self.db.execute("DELETE FROM streams WHERE updated < ? AND last_seen < ?", (cutoff, cutoff))
+        self.db.execute("DELETE FROM stream_flights WHERE expires < ?", (now,))
+
+    def _create_locked(self, now):
+        stream_id = new_stream_id()
+        self.db.execute("INSERT INTO streams (id, updated, last_seen) VALUES (?, ?, ?)", (stream_id, now, now))
+        self.next_seq[stream_id] = 1
+        return stream_id
+
+    def create(self):
+        now = time.time()
+        with self.lock:
+            self._cleanup(now)
+            stream_id = self._create_locked(now)
+        self._notify(stream_id, seq=0)
+        return stream_id
+
+    def create_or_join(self, key, ttl):
+        """(stream id, created): the unfinished stream registered under key, or a new one registered for ttl seconds"""
+        now = time.time()
+        with self.lock:
+            self._cleanup(now)
+            # IMMEDIATE takes the write lock up front, so two workers can't both miss and create
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT f.stream_id FROM stream_flights f JOIN streams s ON s.id = f.stream_id "
+                    "WHERE f.key = ? AND f.expires > ? AND s.done = 0",
+                    (key, now)
+                ).fetchone()
+                if row is None:
+                    stream_id = self._create_locked(now)
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO stream_flights (key, stream_id, expires) VALUES (?, ?, ?)",
+                        (key, stream_id, now + ttl)
+                    )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if row is not None:
+            return row[0], False
+        self._notify(stream_id, seq=0)
+        return stream_id, True
+
+    def exists(self, stream_id):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM streams WHERE id = ?", (stream_id,)).fetchone() is not None
+
+    def append(self, stream_id, event):
+        # Only the process that created a stream produces into it, so seq is tracked locally
+        with self.lock:
+            seq = self.next_seq.get(stream_id)
+            if seq is None:
+                return None
+            self.next_seq[stream_id] = seq + 1
+            try:
+                self.db.execute(
+                    "INSERT INTO stream_events (stream_id, seq, event) VALUES (?, ?, ?)", (stream_id, seq, event)
+                )
+            except sqlite3.IntegrityError:
+                return None  # stream expired meanwhile
+            if seq % self.TRIM_EVERY == 0 and seq > self.max_events:
+                self.db.execute(
+                    "DELETE FROM stream_events WHERE stream_id = ? AND seq <= ?", (stream_id, seq - self.max_events)
+                )
+                self.db.execute("UPDATE streams SET updated = ? WHERE id = ?", (time.time(), stream_id))
+        self._notify(stream_id, seq=seq)
+        return seq
+
+    def finish(self, stream_id):
+        with self.lock:
+            self.next_seq.pop(stream_id, None)
+            self.db.execute("UPDATE streams SET done = 1, updated = ? WHERE id = ?", (time.time(), stream_id))
+            self.db.execute("DELETE FROM stream_flights WHERE stream_id = ?", (stream_id,))
+        self._notify(stream_id, done=True)
+        self._forget_local(stream_id)
+
+    def read(self, stream_id, after, limit=512):
+        """(events after seq `after`, done) - or None if the stream is unknown or expired"""
+        with self.lock:
+            # Read done before the events: once done is set every event is already written
+            row = self.db.execute("SELECT done FROM streams WHERE id = ?", (stream_id,)).fetchone()
+            if row is None:
+                return None
+            events = self.db.execute(
+                "SELECT seq, event FROM stream_events WHERE stream_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (stream_id, after, limit)
+            ).fetchall()
+        return events, bool(row[0])
+
+    def touch(self, stream_id):
+        with self.lock:
+            self.db.execute("UPDATE streams SET last_seen = ? WHERE id = ?", (time.time(), stream_id))
+
+    def last_seen(self, stream_id):
+        with self.lock:
+            row = self.db.execute("SELECT last_seen FROM streams WHERE id = ?", (stream_id,)).fetchone()
+        return row[0] if row else 0
+
+    def attach(self, stream_id, delta=1):
+        """Count a follower in (or out, with delta=-1); returns the number of followers left"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE streams SET followers = MAX(followers + ?, 0) WHERE id = ?", (delta, stream_id)
+            )
+            row = self.db.execute("SELECT followers FROM streams WHERE id = ?", (stream_id,)).fetchone()
+        return row[0] if row else 0
+
+
+class RedisStreamStore(_LocalNotify):
+    """Each stream is a capped Redis list plus a small hash holding its latest seq, done flag and last_seen"""
+
+    APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local seq = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return seq
+"""
+    READ_SCRIPT = """
+local meta = redis.call('HMGET', KEYS[1], 'seq', 'done')
+if not meta[1] then return false end
+local seq = tonumber(meta[1])
+local first = seq - redis.call('LLEN', KEYS[2]) + 1
+local start = math.max(tonumber(ARGV[1]) + 1 - first, 0)
+return {first + start, meta[2] or '0', redis.call('LRANGE', KEYS[2], start, start + tonumber(ARGV[2]) - 1)}
+"""
+    JOIN_SCRIPT = """
+local existing = redis.call('GET', KEYS[1])
+if existing and redis.call('HGET', ARGV[3] .. existing, 'done') == '0' then
+    return {existing, 0}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('HSET', KEYS[2], 'seq', 0, 'done', 0, 'last_seen', ARGV[4], 'followers', 0, 'flight', KEYS[1])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return {ARGV[1], 1}
+"""
+    TOUCH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[1], 'last_seen', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+    FINISH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[1], 'done', 1)
+local flight = redis.call('HGET', KEYS[1], 'flight')
+if flight and redis.call('GET', flight) == ARGV[1] then redis.call('DEL', flight) end
+return 1
+"""
+    ATTACH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local followers = redis.call('HINCRBY', KEYS[1], 'followers', ARGV[1])
+if followers < 0 then
+    redis.call('HSET', KEYS[1], 'followers', 0)
+    return 0
+end
+return followers
+"""
+
+    def __init__(self, resp_client, max_events=2048, retention_seconds=300, prefix="fowazz:stream:"):
+        self.redis = resp_client
+        self.max_events = max_events
+        self.retention_seconds = int(retention_seconds)
+        self.prefix = prefix
+        self._init_notify()
+
+    def _keys(self, stream_id):
+        return self.prefix + stream_id, self.prefix + stream_id + ":events"
+
+    def create(self):
+        stream_id = new_stream_id()
+        meta, _ = self._keys(stream_id)
+        self.redis.execute("HSET", meta, "seq", 0, "done", 0, "last_seen", time.time())
+        self.redis.execute("EXPIRE", meta, self.retention_seconds)
+        self._notify(stream_id, seq=0)
+        return stream_id
+
+    def create_or_join(self, key, ttl):
+        """(stream id, created): the unfinished stream registered under key, or a new one registered for ttl seconds"""
+        stream_id = new_stream_id()
+        meta, _ = self._keys(stream_id)
+        existing, created = self.redis.eval(
+            self.JOIN_SCRIPT, [self.prefix + "flight:" + key, meta],
+            [stream_id, int(ttl), self.prefix, time.time(), self.retention_seconds]
+        )
+        if not created:
+            return existing.decode(), False
+        self._notify(stream_id, seq=0)
+        return stream_id, True
+
+    def exists(self, stream_id):
+        return self.redis.execute("EXISTS", self._keys(stream_id)[0]) == 1
+
+    def append(self, stream_id, event):
+        meta, events = self._keys(stream_id)
+        seq = self.redis.eval(self.APPEND_SCRIPT, [meta, events], [event, self.max_events, self.retention_seconds])
+        if not seq:
+            return None
+        self._notify(stream_id, seq=seq)
+        return seq
+
+    def finish(self, stream_id):
+        meta, _ = self._keys(stream_id)
+        self.redis.eval(self.FINISH_SCRIPT, [meta], [stream_id])
+        self._notify(stream_id, done=True)
+        self._forget_local(stream_id)
+
+    def read(self, stream_id, after, limit=512):
+        """(events after seq `after`, done) - or None if the stream is unknown or expired"""
+        meta, events = self._keys(stream_id)
+        result = self.redis.eval(self.READ_SCRIPT, [meta, events], [after, limit])
+        if not result:
+            return None
+        first, done, items = result
+        return [(first + i, item.decode()) for i, item in enumerate(items)], done in (b"1", "1", 1)
+
+    def touch(self, stream_id):
+        meta, events = self._keys(stream_id)
+        self.redis.eval(self.TOUCH_SCRIPT, [meta, events], [time.time(), self.retention_seconds])
+
+    def last_seen(self, stream_id):
+        value = self.redis.execute("HGET", self._keys(stream_id)[0], "last_seen")
+        return float(value) if value else 0
+
+    def attach(self, stream_id, delta=1):
+        """Count a follower in (or out, with delta=-1); returns the number of followers left"""
+        return self.redis.eval(self.ATTACH_SCRIPT, [self._keys(stream_id)[0]], [delta])
+
+
+def close_upstream(upstream):
+    """Close an upstream GLM stream's HTTP response so the connection (and generation) ends right away"""
+    target = getattr(upstream, "response", upstream)
+    close = getattr(target, "close", None)
+    if close:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+class Cancellation:
+    """
+    Cancels a running generation from another greenlet: flags it, closes every
+    upstream stream registered with it and runs the on_cancel callbacks.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.finished = False
+        self.reason = None
+        self.lock = threading.Lock()
+        self.upstreams = []
+        self.callbacks = []
+
+    def register(self, upstream):
+        with self.lock:
+            if not self.cancelled:
+                self.upstreams.append(upstream)
+                return
+        close_upstream(upstream)
+
+    def unregister(self, upstream):
+        with self.lock:
+            if upstream in self.upstreams:
+                self.upstreams.remove(upstream)
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def finish(self):
+        """The generation ended on its own - later cancel() calls do nothing"""
+        with self.lock:
+            self.finished = True
+            self.upstreams, self.callbacks = [], []
+
+    def cancel(self, reason):
+        """Returns False if it was already cancelled or finished"""
+        with self.lock:
+            if self.cancelled or self.finished:
+                return False
+            self.cancelled = True
+            self.reason = reason
+            upstreams, self.upstreams = self.upstreams, []
+            callbacks, self.callbacks = self.callbacks, []
+        for upstream in upstreams:
+            close_upstream(upstream)
+        for callback in callbacks:
+            callback()
+        return True
+
+
+def follow(store, stream_id, after=0, poll_interval=0.5, heartbeat_interval=2.0, ping_interval=15.0,
+           on_disconnect=None, on_idle=None, disconnect_check_interval=2.0):
+    """
+    SSE generator for a client following a stream from seq `after`: replays what is
+    still buffered, then the live tail. Keeps the stream's last_seen fresh.
+    on_disconnect runs if the last follower goes away before the stream is finished.
+    A gone client is noticed when a write to it fails and the server closes this
+    generator, so with on_disconnect an idle stream is pinged every
+    disconnect_check_interval seconds instead of every ping_interval.
+    on_idle runs on every poll that found nothing new (it may append to the stream).
+    """
+    store.attach(stream_id)
+    if on_disconnect:
+        ping_interval = min(ping_interval, disconnect_check_interval)
+    finished = False
+    try:
+        yield from _follow(store, stream_id, after, poll_interval, heartbeat_interval, ping_interval, on_idle)
+        finished = True
+    finally:
+        # GeneratorExit lands here when the server gives up on a failed write
+        remaining = store.attach(stream_id, -1)
+        if not finished and remaining == 0 and on_disconnect:
+            on_disconnect()
+
+
+def _follow(store, stream_id, after, poll_interval, heartbeat_interval, ping_interval, on_idle):
+    last_touch = 0
+    last_sent = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now - last_touch >= heartbeat_interval:
+            store.touch(stream_id)
+            last_touch = now
+
+        result = store.read(stream_id, after)
+        if result is None:
+            yield sse_event({'error': 'STREAM_NOT_FOUND', 'done': True})
+            return
+        events, done = result
+
+        if events and events[0][0] > after + 1:
+            # The ring buffer already dropped part of what this client missed
+            yield sse_event({'gap': True, 'missed': events[0][0] - after - 1, 'done': False})
+        for seq, event in events:
+            yield f"id: {stream_id}:{seq}\n{event}"
+            after = seq
+        if events:
+            last_sent = now
+            continue
+        if done:
+            return
+        if now - last_sent >= ping_interval:
+            yield ": ping\n\n"  # keeps idle proxies from closing the connection
+            last_sent = now
+        if on_idle:
+            on_idle()
+        store.wait(stream_id, after, poll_interval)
+
+
+def produce(store, stream_id, events, detached_ttl, cancel, check_interval=1.0):
+    """
+    Drain an SSE event generator into a stream. Stops early (closing the generator)
+    when cancel is triggered, or once no client has followed the stream for
+    detached_ttl seconds.
+    """
+    last_check = time.monotonic()
+    try:
+        for event in events:
+            store.append(stream_id, event)
+            if cancel.cancelled:
+                break
+            if time.monotonic() - last_check >= check_interval:
+                last_check = time.monotonic()
+                if time.time() - store.last_seen(stream_id) > detached_ttl:
+                    print(f"🔌 No client on stream {stream_id[:8]} for {detached_ttl:g}s, stopping generation")
+                    cancel.cancel("abandoned")
+                    store.append(stream_id, sse_event({'error': 'STREAM_ABANDONED', 'done': True}))
+                    break
+    except Exception as e:
+        print(f"❌ Stream {stream_id[:8]} failed: {str(e)}")
+        store.append(stream_id, sse_event({'error': str(e), 'done': True}))
+    finally:
+        events.close()
+        store.finish(stream_id)
+
+
+def create_stream_store():
+    """Build the stream store selected by STREAM_STORE (memory, sqlite or redis)"""
+    max_events = int(os.getenv("STREAM_BUFFER_EVENTS", "2048"))
+    retention_seconds = float(os.getenv("STREAM_RETENTION_SECONDS", "300"))
+    backend = os.getenv("STREAM_STORE", "memory").lower()
+
+    if backend == "redis":
+        return RedisStreamStore(redis_client_from_env(), max_events, retention_seconds)
+
+    if backend == "sqlite":
+        path = os.getenv("STREAM_DB", "/tmp/fowazz-streams.db")
+        try:
+            return SQLiteStreamStore(path, max_events, retention_seconds)
+        except sqlite3.Error as e:
+            print(f"⚠️ SQLite stream store unavailable, using in-memory store: {str(e)}")
+
+    return MemoryStreamStore(max_events, retention_seconds)
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+Local subscription state, fed by Stripe webhooks.
+
+Plan checks used to resolve the user's token through Supabase and then read
+their subscription row - two round trips, cached per token for a few minutes.
+Stripe already tells us about every subscription change, so POST /webhook keeps
+a local copy of each subscription instead: status, plan_name and website_limit
+(the columns from migration_add_plan_limits.sql), plus the Stripe ids needed
+to tie events to a user. entitlement(user_id) answers from a dict in the
+worker, so it costs microseconds and no network.
+
+Events are verified against STRIPE_WEBHOOK_SECRET before anything is read, and
+every event id is recorded in the same transaction as its update: Stripe's
+retries and duplicate deliveries are acknowledged without being applied twice.
+Stripe doesn't deliver events in order either, so a subscription only takes
+state from an event newer than the one it last applied. `created` only has
+second resolution, so between two events of the same second the one with the
+later lifecycle status wins (STATUS_PRECEDENCE: a cancellation beats an update).
+
+Users are linked to subscriptions by the subscription's metadata.user_id (set
+by create_checkout_session) or, for older subscriptions, by the
+client_reference_id of the checkout.session.completed event. Users the cache
+hasn't heard of return None, and callers fall back to Supabase.
+
+Backends:
+    redis  - shared by every host, for deployments with more than one node.
+             Lookups are memoized per worker for SUBSCRIPTION_CACHE_SYNC_SECONDS.
+    sqlite - one database file shared by every gunicorn worker on a host (default).
+             Each worker mirrors it in memory and picks up rows written by other
+             workers every SUBSCRIPTION_CACHE_SYNC_SECONDS.
+    memory - per-process, only useful for local dev with a single worker
+
+Stripe delivers each webhook to one node only, so a deployment with more than
+one node should use the redis backend. A host-local backend can instead stop
+answering for a user once their row is SUBSCRIPTION_CACHE_MAX_AGE_SECONDS old,
+after which plan checks fall back to Supabase (default 0: rows never expire).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from admission import redis_client_from_env
+
+ACTIVE_STATUSES = ("active", "trialing")
+# Where each status sits in a subscription's lifecycle, for events of the same second
+STATUS_PRECEDENCE = {"incomplete": 0, "trialing": 1, "active": 2, "past_due": 3, "unpaid": 4, "paused": 4,
+                     "incomplete_expired": 5, "canceled": 5}
+STATE_FIELDS = ("status", "plan_name", "website_limit", "current_period_end", "cancel_at_period_end")
+EVENT_RETENTION_SECONDS = 30 * 86400  # Stripe stops retrying after 3 days
+
+# Stripe price id -> (plan_name, website_limit); the prices app.js sells
+DEFAULT_PLAN_PRICES = {
+    "price_1SSHEiRwqmVW0cG8U3nBQcVQ": ("lite", 1),
+    "price_1SSO5TRwqmVW0cG8xKPuCb8N": ("pro", 3),
+    "price_1SSO5uRwqmVW0cG8nFq5mLfM": ("max", 8),
+    "price_1STLCbRwqmVW0cG8FNdijbXX": ("pro", 3),  # discounted upgrade
+    "price_1STLD1RwqmVW0cG8lIpX7UeU": ("max", 8),  # discounted upgrade
+}
+PLAN_WEBSITE_LIMITS = {"lite": 1, "pro": 3, "max": 8}
+
+
+def parse_plan_prices(value):
+    """STRIPE_PLAN_PRICES: "price_x=pro:3,price_y=max:8" (the limit defaults from the plan name)"""
+    prices = {}
+    for item in (value or "").split(","):
+        price_id, _, plan = item.strip().partition("=")
+        if not price_id or not plan:
+            continue
+        plan_name, _, limit = plan.partition(":")
+        plan_name = plan_name.strip().lower()
+        prices[price_id.strip()] = (plan_name, int(limit) if limit.strip() else PLAN_WEBSITE_LIMITS.get(plan_name, 1))
+    return prices
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def user_id_from_jwt(auth_header, secret):
+    """
+    User id (sub) of a Supabase HS256 access token checked against the project's
+    JWT secret, or None - without asking Supabase
+    """
+    if not secret or not auth_header or not auth_header.startswith("Bearer "):
+        return None
+    try:
+        header, payload, signature = auth_header[7:].strip().split(".")
+        if json.loads(_b64decode(header)).get("alg") != "HS256":
+            return None
+        expected = hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if claims.get("exp") and claims["exp"] < time.time():
+        return None
+    return claims.get("sub")
+
+
+class SubscriptionUpdate:
+    """What one Stripe event says about one subscription"""
+
+    def __init__(self, subscription_id, created, state=None, **links):
+        self.subscription_id = subscription_id
+        self.created = created
+        self.state = state  # dict of STATE_FIELDS, or None when the event only links ids
+        self.links = {k: v for k, v in links.items() if v}
+
+
+def update_from_event(event, plan_prices):
+    """SubscriptionUpdate for the Stripe events the cache follows, None for the rest"""
+    obj = event.get("data", {}).get("object", {})
+    created = event.get("created", 0)
+
+    if event.get("type") == "checkout.session.completed":
+        if obj.get("mode") != "subscription" or not obj.get("subscription"):
+            return None
+        return SubscriptionUpdate(obj["subscription"], created, user_id=obj.get("client_reference_id"),
+                                  customer_id=obj.get("customer"))
+
+    if event.get("type") not in ("customer.subscription.created", "customer.subscription.updated",
+                                 "customer.subscription.deleted"):
+        return None
+
+    plan_name = website_limit = None
+    for item in (obj.get("items") or {}).get("data") or []:
+        price = item.get("price") or {}
+        metadata = price.get("metadata") or {}
+        if price.get("id") in plan_prices:
+            plan_name, website_limit = plan_prices[price["id"]]
+        elif metadata.get("plan_name"):
+            plan_name = metadata["plan_name"].lower().strip()
+            website_limit = int(metadata.get("website_limit") or PLAN_WEBSITE_LIMITS.get(plan_name, 1))
+        if plan_name:
+            break
+
+    metadata = obj.get("metadata") or {}
+    status = "canceled" if event["type"] == "customer.subscription.deleted" else obj.get("status")
+    period_end = obj.get("current_period_end") or next(
+        (item.get("current_period_end") for item in (obj.get("items") or {}).get("data") or []), None)
+    return SubscriptionUpdate(
+        obj.get("id"), created,
+        state=dict(status=status, plan_name=plan_name, website_limit=website_limit, current_period_end=period_end,
+                   cancel_at_period_end=bool(obj.get("cancel_at_period_end"))),
+        user_id=metadata.get("user_id") or metadata.get("userId"), customer_id=obj.get("customer"),
+    )
+
+
+def _supersedes(update, row):
+    created = row.get("event_created", 0)
+    if update.created != created:
+        return update.created > created
+    return STATUS_PRECEDENCE.get(update.state.get("status"), 0) >= STATUS_PRECEDENCE.get(row.get("status"), 0)
+
+
+def merge(row, update):
+    """Row after applying update (row may be None); state from events older than the row's is ignored"""
+    row = dict(row or {"subscription_id": update.subscription_id, "event_created": 0})
+    for field, value in update.links.items():
+        row[field] = value
+    if update.state is not None and _supersedes(update, row):
+        for field in STATE_FIELDS:
+            # An event without a known price keeps the plan we already have
+            if update.state.get(field) is not None or field not in ("plan_name", "website_limit"):
+                row[field] = update.state.get(field)
+        row["event_created"] = update.created
+    return row
+
+
+def rank(row):
+    """A user with several subscriptions (upgrade, resubscribe) is entitled by their active, newest one"""
+    return row.get("status") in ACTIVE_STATUSES, row.get("event_created", 0)
+
+
+def entitlement_from_row(row):
+    active = row.get("status") in ACTIVE_STATUSES
+    return {
+        "active": active,
+        "status": row.get("status"),
+        "plan_name": row.get("plan_name") if active else None,
+        "website_limit": (row.get("website_limit") or 0) if active else 0,
+        "current_period_end": row.get("current_period_end"),
+        "cancel_at_period_end": bool(row.get("cancel_at_period_end")),
+    }
+
+
+class MemorySubscriptionCache:
+    def __init__(self, plan_prices=None, max_age=0):
+        self.plan_prices = plan_prices if plan_prices is not None else dict(DEFAULT_PLAN_PRICES)
+        self.max_age = max_age  # seconds a row answers for after it was written (0 = forever)
+        self.rows = {}  # subscription id -> row
+        self.by_user = {}  # user id -> subscription id of their best row
+        self.user_subscriptions = {}
+        self.by_customer = {}
+        self.events = {}  # event id -> received
+        self.lock = threading.Lock()
+
+    def _index(self, row):
+        self.rows[row["subscription_id"]] = row
+        if row.get("customer_id") and row.get("user_id"):
+            self.by_customer[row["customer_id"]] = row["user_id"]
+        user_id = row.get("user_id")
+        if not user_id:
+            return
+        self.user_subscriptions.setdefault(user_id, set()).add(row["subscription_id"])
+        self.by_user[user_id] = max(self.user_subscriptions[user_id], key=lambda sid: rank(self.rows[sid]))
+
+    def _link_customer(self, update):
+        if "user_id" not in update.links and update.links.get("customer_id") in self.by_customer:
+            update.links["user_id"] = self.by_customer[update.links["customer_id"]]
+
+    def apply(self, event_id, update):
+        """'applied', or 'duplicate' if this event id was seen before"""
+        now = time.time()
+        with self.lock:
+            if event_id in self.events:
+                return "duplicate"
+            self.events[event_id] = now
+            if len(self.events) > 100000:
+                cutoff = now - EVENT_RETENTION_SECONDS
+                self.events = {k: v for k, v in self.events.items() if v > cutoff}
+            if update is not None:
+                self._link_customer(update)
+                self._index(dict(merge(self.rows.get(update.subscription_id), update), updated=now))
+            return "applied"
+
+    def entitlement(self, user_id):
+        """{"active", "status", "plan_name", "website_limit", ...} for a user, None if the cache doesn't know them"""
+        row = self.rows.get(self.by_user.get(user_id))
+        # Linked by checkout but no subscription event yet - still unknown
+        if not row or not row.get("status"):
+            return None
+        # A webhook delivered to another node may have changed it since
+        if self.max_age and time.time() - (row.get("updated") or 0) > self.max_age:
+            return None
+        return entitlement_from_row(row)
+
+    def stats(self):
+        return {"subscriptions": len(self.rows), "users": len(self.by_user)}
+
+
+class SQLiteSubscriptionCache(MemorySubscriptionCache):
+    """Rows live in SQLite; the dicts of MemorySubscriptionCache mirror them and answer lookups"""
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    subscription_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    customer_id TEXT,
+    status TEXT,
+    plan_name TEXT,
+    website_limit INTEGER,
+    current_period_end INTEGER,
+    cancel_at_period_end INTEGER NOT NULL DEFAULT 0,
+    event_created INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subscriptions_version ON subscriptions (version);
+CREATE INDEX IF NOT EXISTS subscriptions_customer ON subscriptions (customer_id);
+CREATE TABLE IF NOT EXISTS stripe_events (
+    id TEXT PRIMARY KEY,
+    received REAL NOT NULL
+);
+"""
+    COLUMNS = ("subscription_id", "user_id", "customer_id", "status", "plan_name", "website_limit",
+               "current_period_end", "cancel_at_period_end", "event_created", "updated")
+
+    def __init__(self, path, plan_prices=None, sync_interval=1.0, cleanup_interval=3600, max_age=0):
+        super().__init__(plan_prices, max_age)
+        self.path = path
+        self.sync_interval = sync_interval
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = 0
+        self.synced_version = 0
+        self.next_sync = 0
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        try:
+            # Databases created before rows expired
+            self.db.execute("ALTER TABLE subscriptions ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        self._sync()
+
+    def _sync(self):
+        # Rows written since the last sync, by this worker or any other
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(self.COLUMNS)}, version FROM subscriptions WHERE version > ? ORDER BY version",
+                (self.synced_version,)).fetchall()
+            for values in rows:
+                self._index(dict(zip(self.COLUMNS, values)))
+                self.synced_version = values[-1]
+            self.next_sync = time.monotonic() + self.sync_interval
+
+    def apply(self, event_id, update):
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.db.execute("INSERT OR IGNORE INTO stripe_events (id, received) VALUES (?, ?)",
+                                   (event_id, now)).rowcount == 0:
+                    self.db.execute("ROLLBACK")
+                    return "duplicate"
+                if update is not None:
+                    if "user_id" not in update.links and update.links.get("customer_id"):
+                        linked = self.db.execute(
+                            "SELECT user_id FROM subscriptions WHERE customer_id = ? AND user_id IS NOT NULL LIMIT 1",
+                            (update.links["customer_id"],)).fetchone()
+                        if linked:
+                            update.links["user_id"] = linked[0]
+                    values = self.db.execute(
+                        f"SELECT {', '.join(self.COLUMNS)} FROM subscriptions WHERE subscription_id = ?",
+                        (update.subscription_id,)).fetchone()
+                    row = dict(merge(dict(zip(self.COLUMNS, values)) if values else None, update), updated=now)
+                    row["cancel_at_period_end"] = int(bool(row.get("cancel_at_period_end")))
+                    row["event_created"] = row.get("event_created", 0)
+                    self.db.execute(
+                        f"INSERT OR REPLACE INTO subscriptions ({', '.join(self.COLUMNS)}, version) "
+                        f"VALUES ({', '.join('?' * len(self.COLUMNS))}, "
+                        f"(SELECT COALESCE(MAX(version), 0) + 1 FROM subscriptions))",
+                        [row.get(column) for column in self.COLUMNS])
+                if now - self.last_cleanup > self.cleanup_interval:
+                    self.last_cleanup = now
+                    self.db.execute("DELETE FROM stripe_events WHERE received < ?", (now - EVENT_RETENTION_SECONDS,))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        self._sync()
+        return "applied"
+
+    def entitlement(self, user_id):
+        if time.monotonic() >= self.next_sync:
+            try:
+                self._sync()
+            except sqlite3.Error as e:
+                print(f"⚠️ Subscription cache sync failed: {str(e)}")
+                self.next_sync = time.monotonic() + self.sync_interval
+        return super().entitlement(user_id)
+
+
+class RedisSubscriptionCache:
+    """
+    Each subscription is a Redis hash holding its row as JSON plus a version. An
+    event is applied by a script that checks the version read by this worker, so
+    concurrent webhooks on different hosts can't overwrite each other.
+    """
+
+    APPLY_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+if (redis.call('HGET', KEYS[2], 'version') or '0') ~= ARGV[1] then return -1 end
+redis.call('SET', KEYS[1], 1, 'EX', ARGV[3])
+if ARGV[2] == '' then return 1 end
+redis.call('HSET', KEYS[2], 'row', ARGV[2], 'version', tonumber(ARGV[1]) + 1)
+if ARGV[5] ~= '' then redis.call('SADD', ARGV[4] .. 'user:' .. ARGV[5], ARGV[7]) end
+if ARGV[5] ~= '' and ARGV[6] ~= '' then redis.call('SET', ARGV[4] .. 'customer:' .. ARGV[6], ARGV[5]) end
+return 1
+"""
+
+    def __init__(self, resp_client, plan_prices=None, sync_interval=1.0, prefix="fowazz:subscription:"):
+        self.redis = resp_client
+        self.plan_prices = plan_prices if plan_prices is not None else dict(DEFAULT_PLAN_PRICES)
+        self.sync_interval = sync_interval
+        self.prefix = prefix
+        self.memo = {}  # user id -> (entitlement, expires)
+        self.lock = threading.Lock()
+
+    def apply(self, event_id, update, attempts=5):
+        event_key = self.prefix + "event:" + event_id
+        for _ in range(attempts):
+            row_key, version, row, encoded = self.prefix + "none", b"0", {}, ""
+            if update is not None:
+                if "user_id" not in update.links and update.links.get("customer_id"):
+                    linked = self.redis.execute("GET", self.prefix + "customer:" + update.links["customer_id"])
+                    if linked:
+                        update.links["user_id"] = linked.decode()
+                row_key = self.prefix + update.subscription_id
+                stored, version = self.redis.execute("HMGET", row_key, "row", "version")
+                row = merge(json.loads(stored) if stored else None, update)
+                encoded = json.dumps(row)
+            result = self.redis.execute(
+                "EVAL", self.APPLY_SCRIPT, 2, event_key, row_key, version or b"0", encoded, EVENT_RETENTION_SECONDS,
+                self.prefix, row.get("user_id") or "", row.get("customer_id") or "", row.get("subscription_id") or "",
+            )
+            if result == 0:
+                return "duplicate"
+            if result == 1:
+                with self.lock:
+                    self.memo.pop(row.get("user_id"), None)
+                return "applied"
+        raise RuntimeError(f"subscription {update.subscription_id} kept changing, giving up for now")
+
+    def entitlement(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            memo = self.memo.get(user_id)
+        if memo and memo[1] > now:
+            return memo[0]
+        try:
+            rows = []
+            for subscription_id in self.redis.execute("SMEMBERS", self.prefix + "user:" + user_id) or []:
+                stored = self.redis.execute("HGET", self.prefix + subscription_id.decode(), "row")
+                if stored:
+                    rows.append(json.loads(stored))
+        except (OSError, ConnectionError) as e:
+            print(f"⚠️ Subscription cache lookup failed: {str(e)}")
+            return None
+        row = max(rows, key=rank) if rows else None
+        entitlement = entitlement_from_row(row) if row and row.get("status") else None
+        with self.lock:
+            if len(self.memo) > 10000:
+                self.memo.clear()
+            self.memo[user_id] = (entitlement, now + self.sync_interval)
+        return entitlement
+
+    def stats(self):
+        return {"memoized_users": len(self.memo)}
+
+
+def create_subscription_cache():
+    """Build the cache selected by SUBSCRIPTION_CACHE (sqlite, redis or memory)"""
+    plan_prices = dict(DEFAULT_PLAN_PRICES, **parse_plan_prices(os.getenv("STRIPE_PLAN_PRICES")))
+    backend = os.getenv("SUBSCRIPTION_CACHE", "sqlite").lower()
+    sync_interval = float(os.getenv("SUBSCRIPTION_CACHE_SYNC_SECONDS", "1"))
+    max_age = float(os.getenv("SUBSCRIPTION_CACHE_MAX_AGE_SECONDS", "0"))
+
+    if backend == "redis":
+        return RedisSubscriptionCache(redis_client_from_env(), plan_prices, sync_interval)
+
+    if backend == "sqlite":
+        path = os.getenv("SUBSCRIPTION_CACHE_DB", "/tmp/fowazz-subscriptions.db")
+        try:
+            return SQLiteSubscriptionCache(path, plan_prices, sync_interval=sync_interval, max_age=max_age)
+        except sqlite3.Error as e:
+            print(f"⚠️ SQLite subscription cache unavailable, using in-memory cache: {str(e)}")
+
+    return MemorySubscriptionCache(plan_prices, max_age)
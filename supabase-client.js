@@ -48,6 +48,12 @@ async function initAuth() {
   });
 }
 
+// Auth header for backend calls (lets the server recognise paid plans)
+async function getAuthHeaders() {
+  const { data: { session } } = await supabase.auth.getSession();
+  return session ? { 'Authorization': `Bearer ${session.access_token}` } : {};
+}
+
 // Load user profile data
 async function loadUserProfile() {
   if (!currentUser) return null;
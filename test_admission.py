@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+import pytest
+
+import admission
+from admission import (
+    FCNTL_AVAILABLE, AdmissionQueue, ConnectionCounter, FileLockAdmission, RedisAdmission, RespClient, RespError,
+    redis_client_from_env,
+)
+
+needs_fcntl = pytest.mark.skipif(not FCNTL_AVAILABLE, reason="the file backend needs fcntl")
+
+
+def redis_or_skip():
+    client = redis_client_from_env()
+    client.timeout = 0.5
+    try:
+        client.execute("PING")
+    except (OSError, ConnectionError, RespError):
+        pytest.skip("no Redis server at REDIS_HOST")
+    return client
+
+
+@pytest.fixture(params=["local", "file", "redis"])
+def make_backend(request, tmp_path):
+    """Factory for a backend of one kind (file and redis ones share slots with each other)"""
+    if request.param == "local":
+        return lambda limit, lease_seconds=0.2: ConnectionCounter(limit, lease_seconds)
+    if request.param == "file":
+        if not FCNTL_AVAILABLE:
+            pytest.skip("the file backend needs fcntl")
+        path = str(tmp_path / "admission.slots")
+        return lambda limit, lease_seconds=0.2: FileLockAdmission(path, limit, lease_seconds, keep_limit=True)
+    client = redis_or_skip()
+    key = "fowazz:test:" + os.urandom(4).hex()
+    request.addfinalizer(lambda: client.execute("DEL", key, key + ":limit", key + ":queue", key + ":queue:expiry"))
+    return lambda limit, lease_seconds=0.2: RedisAdmission(client, limit, lease_seconds, key=key, keep_limit=True)
+
+
+def test_acquire_up_to_the_limit_and_release(make_backend):
+    backend = make_backend(2)
+    first, second = backend.try_acquire(), backend.try_acquire()
+    assert first and second and first != second
+    assert backend.try_acquire() is None
+    assert backend.get_count() == 2
+    backend.release(first)
+    assert backend.get_count() == 1
+    assert backend.try_acquire()
+
+
+def test_leases_expire_unless_renewed(make_backend):
+    backend = make_backend(2, lease_seconds=0.3)
+    kept, dropped = backend.try_acquire(), backend.try_acquire()
+    time.sleep(0.2)
+    backend.renew(kept)
+    time.sleep(0.2)
+    assert backend.get_count() == 1
+    assert backend.try_acquire()
+    assert backend.try_acquire() is None
+    backend.release(dropped)  # releasing an expired lease is harmless
+    backend.release(kept)
+
+
+def test_queue_orders_by_priority_then_arrival(make_backend):
+    backend = make_backend(2)
+    held = [backend.try_acquire(), backend.try_acquire()]
+    assert backend.queue_poll("free-1", 2) == (None, 1)
+    assert backend.queue_poll("free-2", 2) == (None, 2)
+    assert backend.queue_poll("paid", 0) == (None, 1)
+    assert backend.queue_poll("free-1", 2) == (None, 2)
+    backend.release(held.pop())
+    # The fast path and anyone but the head have to wait their turn
+    assert backend.try_acquire() is None
+    assert backend.queue_poll("free-1", 2) == (None, 2)
+    lease, position = backend.queue_poll("paid", 0)
+    assert lease and position == 1
+    assert backend.queue_poll("free-1", 2) == (None, 1)
+    backend.queue_leave("free-1")
+    backend.queue_leave("free-2")
+    backend.release(held.pop())
+    assert backend.try_acquire()
+
+
+def test_waiters_that_stop_polling_drop_out(make_backend, monkeypatch):
+    monkeypatch.setattr(admission, "WAITER_TTL_SECONDS", 0.1)
+    backend = make_backend(1, lease_seconds=5)
+    lease = backend.try_acquire()
+    backend.queue_poll("gone", 1)
+    backend.release(lease)
+    assert backend.try_acquire() is None
+    time.sleep(0.15)
+    assert backend.try_acquire()
+
+
+def test_wait_serves_priority_then_arrival(make_backend):
+    queue = AdmissionQueue(make_backend(1, lease_seconds=5), poll_interval=0.01)
+    lease = queue.try_acquire()
+    served = []
+
+    def wait(name, priority, queued):
+        ticket = queue.enqueue(priority)
+        waiter = queue.wait(ticket, 5)
+        next(waiter)  # in the queue now
+        queued.set()
+        for _ in waiter:
+            pass
+        served.append(name)
+        queue.release(ticket.lease)
+
+    threads = []
+    for name, priority in (("free-1", 2), ("free-2", 2), ("paid", 0)):
+        queued = threading.Event()
+        threads.append(threading.Thread(target=wait, args=(name, priority, queued)))
+        threads[-1].start()
+        assert queued.wait(5)
+    assert queue.try_acquire() is None
+    queue.release(lease)
+    for thread in threads:
+        thread.join(10)
+    assert served == ["paid", "free-1", "free-2"]
+
+
+def test_wait_gives_up_at_the_deadline():
+    queue = AdmissionQueue(ConnectionCounter(1), poll_interval=0.01)
+    lease = queue.try_acquire()
+    ticket = queue.enqueue()
+    assert list(queue.wait(ticket, 0.05)) == [1]
+    assert ticket.lease is None and queue.get_waiting() == 0
+    queue.release(lease)
+    assert queue.try_acquire()
+
+
+@needs_fcntl
+def test_priority_holds_across_workers(tmp_path):
+    path = str(tmp_path / "admission.slots")
+    worker_a = AdmissionQueue(FileLockAdmission(path, 1), poll_interval=0.01)
+    worker_b = AdmissionQueue(FileLockAdmission(path, 1), poll_interval=0.01)
+    lease = worker_a.try_acquire()
+    free = worker_a.enqueue(2)
+    assert next(worker_a.wait(free, 5)) == 1
+    paid = worker_b.enqueue(0)
+    waiting = worker_b.wait(paid, 5)
+    assert next(waiting) == 1
+    # worker_b has nobody queued locally, but worker_a does
+    assert worker_b.try_acquire() is None
+    worker_a.release(lease)
+    assert list(waiting) == [] and paid.lease
+
+
+class ScriptlessRedis(RespClient):
+    """Answers EVALSHA only for scripts loaded since the last flush"""
+
+    def __init__(self):
+        super().__init__("localhost")
+        self.loaded = set()
+        self.commands = []
+
+    def execute(self, *args):
+        self.commands.append(args[0])
+        if args[0] == "SCRIPT":
+            self.loaded.add("sha-1")
+            return b"sha-1"
+        if args[1] not in self.loaded:
+            raise RespError("NOSCRIPT No matching script")
+        return 1
+
+
+def test_eval_loads_scripts_once_and_after_a_flush():
+    client = ScriptlessRedis()
+    assert client.eval("return 1", ["key"], []) == 1
+    assert client.eval("return 1", ["key"], []) == 1
+    assert client.commands == ["SCRIPT", "EVALSHA", "EVALSHA"]
+    client.loaded.clear()  # SCRIPT FLUSH or a restarted server
+    assert client.eval("return 1", ["key"], []) == 1
+    assert client.commands[3:] == ["EVALSHA", "SCRIPT", "EVALSHA"]
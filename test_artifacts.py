@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from artifacts import ContinuationStitcher, PatchError, apply_patch
+
+PAGE = "<ul>\n  <li>a</li>\n  <li>b</li>\n</ul>"
+
+
+def patch(search, replace):
+    return f"<<<<<<< SEARCH\n{search}\n=======\n{replace}\n>>>>>>> REPLACE"
+
+
+def test_apply_patch_exact_match():
+    assert apply_patch(PAGE, patch("<li>a</li>", "<li>A</li>")) == "<ul>\n  <li>A</li>\n  <li>b</li>\n</ul>"
+
+
+def test_apply_patch_replaces_only_the_first_match():
+    assert apply_patch("x x", patch("x", "y")) == "y x"
+
+
+def test_apply_patch_line_match_ignores_indentation():
+    body = patch("<li>a</li>\n<li>b</li>", "<li>c</li>")
+    assert apply_patch(PAGE, body) == "<ul>\n<li>c</li>\n</ul>"
+
+
+def test_apply_patch_applies_every_block_in_order():
+    body = patch("<li>a</li>", "<li>b2</li>") + "\n" + patch("<li>b2</li>", "<li>c</li>")
+    assert apply_patch(PAGE, body) == "<ul>\n  <li>c</li>\n  <li>b</li>\n</ul>"
+
+
+def test_apply_patch_empty_replace_deletes_the_lines():
+    body = "<<<<<<< SEARCH\n<li>a</li>\n=======\n>>>>>>> REPLACE"
+    assert apply_patch(PAGE, body) == "<ul>\n  <li>b</li>\n</ul>"
+
+
+def test_apply_patch_empty_replace_inside_a_line():
+    body = "<<<<<<< SEARCH\n<li>a\n=======\n>>>>>>> REPLACE"
+    assert apply_patch(PAGE, body) == "<ul>\n  </li>\n  <li>b</li>\n</ul>"
+
+
+@pytest.mark.parametrize("body", [
+    "no blocks here",
+    patch("   ", "x"),
+    patch("<li>z</li>", "x"),
+])
+def test_apply_patch_errors(body):
+    with pytest.raises(PatchError):
+        apply_patch(PAGE, body)
+
+
+def stitch(previous, continuation, chunk_size=7):
+    stitcher = ContinuationStitcher(previous)
+    output = [stitcher.feed(continuation[i:i + chunk_size]) for i in range(0, len(continuation), chunk_size)]
+    return "".join(output) + stitcher.finish()
+
+
+def test_stitcher_trims_a_restarted_line():
+    previous = "<body>\n  <h1>Welcome to the bakery</h1>\n  <p class=\"intro\">Fresh br"
+    continuation = "  <p class=\"intro\">Fresh bread every morning</p>\n</body>"
+    assert stitch(previous, continuation) == "ead every morning</p>\n</body>"
+
+
+def test_stitcher_trims_several_repeated_lines():
+    previous = "<ul>\n  <li>First item in the list</li>\n  <li>Second it"
+    continuation = "  <li>First item in the list</li>\n  <li>Second item</li>\n</ul>"
+    assert stitch(previous, continuation) == "em</li>\n</ul>"
+
+
+def test_stitcher_keeps_a_repeated_line_after_a_line_boundary():
+    previous = "<main>\n<br class=\"spacer\">\n"
+    continuation = "<br class=\"spacer\">\n<footer>Thanks</footer>\n</main>"
+    assert stitch(previous, continuation) == continuation
+
+
+def test_stitcher_keeps_a_repeat_that_stops_before_the_cut():
+    previous = "<main>\n<br class=\"spacer\">\n<p>Hello there, visit"
+    continuation = "<br class=\"spacer\">\n<p>More text</p>"
+    assert stitch(previous, continuation) == continuation
+
+
+def test_stitcher_plain_continuation_is_untouched():
+    previous = "<p>The quick brown fox jumps ov"
+    assert stitch(previous, "er the lazy dog</p>") == "er the lazy dog</p>"
+
+
+def test_stitcher_drops_reopened_artifact_and_title():
+    previous = "[TITLE:Bakery]\n[ARTIFACT:START:index.html]\n<html>\n<body>\n"
+    continuation = "[TITLE:Bakery]\n[ARTIFACT:START:index.html]\n<p>Menu</p>\n[ARTIFACT:END]"
+    assert stitch(previous, continuation) == "<p>Menu</p>\n[ARTIFACT:END]"
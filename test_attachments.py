@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import base64
+
+import pytest
+
+from attachments import (
+    AttachmentQuotaError, LocalDiskAttachmentStore, expand_attachments, has_inline_attachments, intern_attachments,
+)
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+def image_block(data):
+    return {"type": "image", "source": {"type": "base64", "media_type": "image/png",
+                                        "data": base64.b64encode(data).decode("ascii")}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalDiskAttachmentStore(str(tmp_path), max_bytes=1024, user_quota_bytes=200)
+
+
+def test_intern_stores_inline_files_against_the_owner(store):
+    message = {"role": "user", "content": [{"type": "text", "text": "like this"}, image_block(PNG)]}
+    assert has_inline_attachments(message)
+    interned = intern_attachments(store, message, "user-1")
+    source = interned["content"][1]["source"]
+    assert source["type"] == "attachment" and store.exists(source["digest"])
+    assert not has_inline_attachments(interned)
+    owners = store.db.execute("SELECT owner FROM attachment_owners WHERE digest = ?", (source["digest"],)).fetchall()
+    assert owners == [("user-1",)]
+
+
+def test_intern_respects_the_owner_quota(store):
+    intern_attachments(store, {"role": "user", "content": [image_block(PNG + b"1" * 60)]}, "user-1")
+    with pytest.raises(AttachmentQuotaError):
+        intern_attachments(store, {"role": "user", "content": [image_block(PNG + b"2" * 60)]}, "user-1")
+
+
+def test_expand_round_trips(store):
+    interned = intern_attachments(store, {"role": "user", "content": [image_block(PNG)]}, "user-1")
+    expanded = expand_attachments(store, [interned])
+    assert expanded[0]["content"][0]["source"]["data"] == base64.b64encode(PNG).decode("ascii")
+
+
+def test_expand_replaces_an_evicted_file_with_a_note(store):
+    missing = {"type": "image", "source": {"type": "attachment", "digest": "0" * 64}}
+    expanded = expand_attachments(store, [{"role": "user", "content": [missing, {"type": "text", "text": "hi"}]}])
+    assert expanded[0]["content"] == [
+        {"type": "text", "text": "[image attached earlier - no longer available]"},
+        {"type": "text", "text": "hi"},
+    ]
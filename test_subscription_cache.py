@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from subscription_cache import SQLiteSubscriptionCache, update_from_event
+
+PRO_PRICE = "price_1SSO5TRwqmVW0cG8xKPuCb8N"
+MAX_PRICE = "price_1SSO5uRwqmVW0cG8nFq5mLfM"
+
+
+def subscription_event(kind, created, status="active", price=PRO_PRICE, user_id="user-1"):
+    return {
+        "type": f"customer.subscription.{kind}",
+        "created": created,
+        "data": {"object": {
+            "id": "sub_1", "customer": "cus_1", "status": status, "metadata": {"user_id": user_id},
+            "items": {"data": [{"price": {"id": price}}]},
+        }},
+    }
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SQLiteSubscriptionCache(str(tmp_path / "subscriptions.db"), sync_interval=0)
+
+
+def apply(cache, event_id, event):
+    return cache.apply(event_id, update_from_event(event, cache.plan_prices))
+
+
+def test_apply_stores_the_plan(cache):
+    assert apply(cache, "evt_1", subscription_event("created", 100)) == "applied"
+    entitlement = cache.entitlement("user-1")
+    assert entitlement["active"] and entitlement["plan_name"] == "pro" and entitlement["website_limit"] == 3
+
+
+def test_duplicate_event_is_not_applied_twice(cache):
+    apply(cache, "evt_1", subscription_event("created", 100))
+    apply(cache, "evt_2", subscription_event("updated", 200, price=MAX_PRICE))
+    # A redelivery of the first event must not roll the upgrade back
+    assert apply(cache, "evt_1", subscription_event("created", 100)) == "duplicate"
+    assert cache.entitlement("user-1")["plan_name"] == "max"
+
+
+def test_older_event_arriving_late_is_ignored(cache):
+    apply(cache, "evt_2", subscription_event("deleted", 200))
+    assert apply(cache, "evt_1", subscription_event("updated", 100)) == "applied"
+    assert cache.entitlement("user-1")["active"] is False
+
+
+def test_same_second_cancellation_wins(cache):
+    apply(cache, "evt_2", subscription_event("deleted", 100))
+    apply(cache, "evt_1", subscription_event("updated", 100))
+    assert cache.entitlement("user-1")["status"] == "canceled"
+
+
+def test_other_workers_see_applied_events(cache, tmp_path):
+    other = SQLiteSubscriptionCache(str(tmp_path / "subscriptions.db"), sync_interval=0)
+    apply(cache, "evt_1", subscription_event("created", 100))
+    assert apply(other, "evt_1", subscription_event("created", 100)) == "duplicate"
+    assert other.entitlement("user-1")["plan_name"] == "pro"
+
+
+def test_unknown_user_returns_none(cache):
+    assert cache.entitlement("nobody") is None
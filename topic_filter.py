@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Off-topic filter for /api/message.
+
+Fowazz only builds websites, so a message that is clearly about something else
+(homework, essays, medical advice...) and has no website context is turned away
+before it costs an upstream call. The keyword lists (English and Arabic) are
+compiled once into an Aho-Corasick automaton, so a message is scanned in a single
+pass no matter how many keywords there are, and the scan stops at the first
+website keyword (website context always wins).
+
+Only the first and last TOPIC_SCAN_MAX_CHARS / 2 characters of a message are
+looked at - the request itself is at the start or the end, not in the middle
+of a pasted document. Only that slice is casefolded; Arabic diacritics and
+letter variants (أ/إ/آ, ى, ة...) are folded by the automaton itself while it scans.
+
+The classifier is pluggable with TOPIC_CLASSIFIER:
+
+    keywords         - the automaton below (default)
+    off              - never block
+    module:factory   - factory() returns an object with classify(text) -> "off_topic",
+                       "website" or None, e.g. a small local model
+"""
+import collections
+import importlib
+import os
+
+OFF_TOPIC, WEBSITE = "off_topic", "website"
+
+OFF_TOPIC_KEYWORDS = [
+    # English
+    "homework", "essay", "write my", "do my", "solve this", "math problem",
+    "physics", "chemistry", "biology", "history assignment", "book report",
+    "translate", "summarize this article", "explain quantum", "what is the meaning",
+    "write a poem", "write a story", "write code for", "python script",
+    "help me with my", "my teacher", "my professor", "school project",
+    "dating advice", "relationship", "how to ask out", "legal advice",
+    "medical advice", "diagnose", "symptoms", "should i see a doctor",
+    # Arabic
+    "واجب منزلي", "واجبي", "حل الواجب", "اكتب مقال", "اكتب لي مقال", "مساله رياضيات",
+    "حل المساله", "فيزياء", "كيمياء", "علم الاحياء", "بحث مدرسي", "مشروع مدرسي",
+    "تقرير عن كتاب", "ترجم لي", "لخص هذا", "لخص المقال", "اكتب قصيده", "اكتب قصه",
+    "سكربت بايثون", "كود بايثون", "ساعدني في واجب", "استاذي", "معلمي", "الدكتور في الجامعه",
+    "نصيحه عاطفيه", "علاقه عاطفيه", "استشاره قانونيه", "نصيحه قانونيه", "استشاره طبيه",
+    "نصيحه طبيه", "تشخيص", "اعراض", "هل اذهب للطبيب", "ما معني الحياه",
+]
+
+WEBSITE_KEYWORDS = [
+    # English
+    "website", "web", "page", "site", "html", "css", "design", "build",
+    "create", "landing", "homepage", "portfolio", "business site", "blog",
+    "navigation", "header", "footer", "style", "layout", "responsive",
+    "button", "form", "contact page", "about page", "menu", "link",
+    "color", "font", "image", "section", "background", "card", "deploy",
+    # Arabic
+    # (no 2-3 letter words - they turn up inside unrelated words, e.g. "لون" in "الانفلونزا")
+    "موقع", "صفحه", "ويب", "تصميم", "صمم", "ابني", "بناء", "انشئ", "انشاء", "متجر",
+    "مدونه", "قائمه", "هيدر", "فوتر", "تذييل", "الزر", "ازرار", "نموذج", "اتصل بنا",
+    "من نحن", "اللون", "الوان", "الخطوط", "صوره", "الصور", "القسم", "اقسام", "خلفيه",
+    "بطاقه", "انشر", "النشر", "رابط", "تخطيط", "متجاوب", "معرض اعمال", "بورتفوليو",
+    "شعار", "لوجو",
+]
+
+# Arabic folding: diacritics and tatweel are skipped, alef/ya/ta marbuta/hamza carriers unified
+ARABIC_IGNORED = [chr(code) for code in range(0x064B, 0x0653)] + ["\u0670", "\u0640"]
+ARABIC_VARIANTS = {"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي"}
+_ARABIC_FOLD = {ord(char): None for char in ARABIC_IGNORED}
+_ARABIC_FOLD.update({ord(variant): base for variant, base in ARABIC_VARIANTS.items()})
+
+
+def normalize(text):
+    """Casefold and fold Arabic - what the automaton matches, applied to keywords"""
+    return text.casefold().translate(_ARABIC_FOLD)
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over (keyword, label) pairs, compiled to a full transition
+    table. Text is scanned casefolded but otherwise as is: ignored characters loop
+    back to the same state and letter variants move like their base letter.
+    """
+
+    def __init__(self, keywords):
+        goto = [{}]
+        labels = [frozenset()]
+        for keyword, label in keywords:
+            state = 0
+            for char in normalize(keyword):
+                if char not in goto[state]:
+                    goto.append({})
+                    labels.append(frozenset())
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            labels[state] = labels[state] | {label}
+
+        # Breadth-first: failure links, inherited labels and the full transition for every state,
+        # so scanning is a single dict lookup per character
+        self.transitions = [None] * len(goto)
+        self.transitions[0] = dict(goto[0])
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            labels[state] = labels[state] | labels[fail[state]]
+            transitions = dict(self.transitions[fail[state]])
+            for char, target in goto[state].items():
+                fail[target] = self.transitions[fail[state]].get(char, 0)
+                transitions[char] = target
+                queue.append(target)
+            self.transitions[state] = transitions
+        for state, transitions in enumerate(self.transitions):
+            for variant, base in ARABIC_VARIANTS.items():
+                if base in transitions:
+                    transitions[variant] = transitions[base]
+            for char in ARABIC_IGNORED:
+                transitions[char] = state
+        self.labels = labels
+
+    def scan(self, text, stop=None):
+        """Labels of every keyword in text (casefolded); returns early once `stop` is found"""
+        transitions = self.transitions
+        labels = self.labels
+        found = set()
+        state = 0
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if labels[state]:
+                found |= labels[state]
+                if stop in found:
+                    break
+        return found
+
+
+class KeywordClassifier:
+    def __init__(self, off_topic=OFF_TOPIC_KEYWORDS, website=WEBSITE_KEYWORDS):
+        self.automaton = KeywordAutomaton(
+            [(keyword, OFF_TOPIC) for keyword in off_topic] + [(keyword, WEBSITE) for keyword in website]
+        )
+
+    def classify(self, text):
+        found = self.automaton.scan(text, stop=WEBSITE)
+        if WEBSITE in found:
+            return WEBSITE
+        return OFF_TOPIC if OFF_TOPIC in found else None
+
+
+class TopicFilter:
+    def __init__(self, classifier, max_chars=4000):
+        self.classifier = classifier
+        self.max_chars = max_chars
+
+    def prepare(self, text):
+        """The start and end of text, casefolded - what the classifier gets to see"""
+        if len(text) > self.max_chars:
+            half = self.max_chars // 2
+            text = text[:half] + "\n" + text[-half:]
+        return text.casefold()
+
+    def is_off_topic(self, text):
+        """True if text is clearly not about websites"""
+        if self.classifier is None or not text:
+            return False
+        return self.classifier.classify(self.prepare(text)) == OFF_TOPIC
+
+
+def create_topic_filter():
+    """Topic filter configured from TOPIC_CLASSIFIER / TOPIC_SCAN_MAX_CHARS"""
+    name = os.getenv("TOPIC_CLASSIFIER", "keywords").strip()
+    if name == "off":
+        classifier = None
+    elif name == "keywords":
+        classifier = KeywordClassifier()
+    else:
+        module_name, _, factory = name.partition(":")
+        classifier = getattr(importlib.import_module(module_name), factory or "create_classifier")()
+    return TopicFilter(classifier, max_chars=int(os.getenv("TOPIC_SCAN_MAX_CHARS", "4000")))